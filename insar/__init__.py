@@ -1,7 +1,14 @@
+from . import cache
+from . import catalog
 from . import dem
+from . import download
 from . import eof
 from . import geojson
+from . import geotiff
+from . import igrams
 from . import log
+from . import overviews
+from . import pairs
 from . import parsers
 from . import plotting
 from . import sario
@@ -0,0 +1,600 @@
+"""Manages the directory of downloaded SRTM tiles
+
+Tiles are kept in one cache directory (default ~/.cache/insar), as .hgt
+files or, if downloaded with keep_compressed, as the compressed downloads
+(e.g. N19W156.hgt.gz), along with an index file recording each file's
+size, checksum and last access time. This lets us:
+
+    - tell complete tiles from partial or corrupted ones
+    - cap the total size of the cache, evicting the least recently used tiles
+
+The size cap can be set with max_size, or with the environment variable
+INSAR_CACHE_MAX_SIZE (e.g. "20G"). With neither, the cache is not capped.
+
+Finished DEMs are also kept (see ProductCache), so rerunning `insar dem`
+with the same bounds and rate does not need to stitch and upsample again.
+They are indexed with the tiles, so count towards the same size cap.
+"""
+from __future__ import division
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of one process are kept apart
+    fcntl = None
+
+from insar.log import get_log
+from insar import sario
+
+logger = get_log()
+
+INDEX_NAME = 'index.json'
+# Subdirectory of the cache holding the finished DEMs
+PRODUCT_DIR = 'products'
+MAX_SIZE_ENV = 'INSAR_CACHE_MAX_SIZE'
+# Sizes of uncompressed SRTM1 (3601 x 3601) and SRTM3 (1201 x 1201) int16 tiles
+HGT_SIZES = (2 * 3601 * 3601, 2 * 1201 * 1201)
+
+
+def get_cache_dir():
+    """Find location of directory to store .hgt downloads
+
+    Assuming linux, uses ~/.cache/insar/
+
+    """
+    path = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    path = os.path.join(path, 'insar')  # Make subfolder for our downloads
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def parse_size(size):
+    """Converts a human readable size to number of bytes
+
+    Examples:
+        >>> parse_size('20G')
+        21474836480
+        >>> parse_size('1.5 MB')
+        1572864
+        >>> parse_size(1000)
+        1000
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)B?\s*$', size.upper())
+    if not match:
+        raise ValueError("Invalid size: {}".format(size))
+    number, unit = match.groups()
+    return int(float(number) * 1024**' KMGT'.index(unit or ' '))
+
+
+def format_size(num_bytes):
+    """Converts a number of bytes to human readable size
+
+    Examples:
+        >>> format_size(1000)
+        '1000 B'
+        >>> format_size(25934402)
+        '24.7 MB'
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024
+    else:
+        unit = 'TB'
+    return '{} {}'.format(num_bytes, unit) if unit == 'B' else '{:.1f} {}'.format(num_bytes, unit)
+
+
+def _stored_files(path):
+    """The files of a cache entry: path itself, or the files in a directory by name"""
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    return [path]
+
+
+def _stored_size(path):
+    return sum(os.path.getsize(filename) for filename in _stored_files(path))
+
+
+def _delete(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def checksum(filename, chunk_size=1024 * 1024):
+    """Computes the sha1 hex digest of a file's contents
+
+    For a directory, digests the contents of all its files in name order
+    """
+    sha1 = hashlib.sha1()
+    for path in _stored_files(filename):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def save_json(filename, obj):
+    """Writes obj as json to a temp file, then renames it over filename
+
+    Readers never see a partially written file
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), prefix='.', suffix='.part')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.chmod(temp_path, 0o644)
+    os.rename(temp_path, filename)
+
+
+@contextlib.contextmanager
+def file_lock(lock_path):
+    """Holds an exclusive lock on lock_path (created if missing), across processes
+
+    Blocks until any other holder (process, or thread with its own
+    file_lock) releases it. The lock file is removed on release, so
+    after waiting, the lock is only kept if lock_path is still the file locked.
+
+    Yields:
+        bool: True if the lock was held by someone else, and waited for
+    """
+    waited = False
+    while True:
+        f = open(lock_path, 'a')
+        if fcntl is None:
+            break
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            waited = True
+        # The last holder may have removed (and someone else recreated) lock_path
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(lock_path)):
+                break
+        except OSError:
+            pass
+        f.close()
+    try:
+        yield waited
+    finally:
+        # Removed before unlocking: anyone waiting on it will retry on a new file
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+        f.close()
+
+
+def _hgt_size(filename):
+    """Size of the .hgt data in a file, uncompressing if needed (None if unreadable)"""
+    if sario.get_file_ext(filename) not in sario.COMPRESSED_EXTS:
+        return os.path.getsize(filename)
+    try:
+        with sario.open_compressed_hgt(filename) as (_, num_bytes):
+            return num_bytes
+    except (IOError, OSError, zipfile.BadZipfile, StopIteration):
+        return None
+
+
+class TileCache:
+    """Directory of tiles, with an index of sizes, checksums and access times
+
+    The index is a json file in the cache directory, mapping each tile
+    name to {'size': int, 'checksum': str, 'last_access': float (unix time)}.
+    ProductCache also indexes its DEM directories here (as products/<key>),
+    so pruning evicts whichever tiles or DEMs were used least recently.
+    It is rewritten atomically on each change, so it is safe to read while
+    another process is using the cache, and changes are made holding a
+    lock file (.index.json.lock), so runs sharing the cache don't lose
+    each other's entries.
+
+    Attributes:
+        cache_dir (str): directory holding the tiles (default: get_cache_dir())
+        max_size (int): maximum total bytes of tiles to keep, or None for no cap.
+            Can be a string like '20G' (default: INSAR_CACHE_MAX_SIZE env var)
+
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir or get_cache_dir()
+        if max_size is None:
+            max_size = os.getenv(MAX_SIZE_ENV)
+        self.max_size = parse_size(max_size) if max_size else None
+        self.index_path = os.path.join(self.cache_dir, INDEX_NAME)
+        self._lock_path = os.path.join(self.cache_dir, '.' + INDEX_NAME + '.lock')
+        # Downloads add tiles from multiple threads
+        self._lock = threading.Lock()
+
+    def path(self, tile_name):
+        return os.path.join(self.cache_dir, tile_name)
+
+    def find(self, tile_name):
+        """Finds the stored file for a tile, either the .hgt or compressed .hgt.gz/.hgt.zip
+
+        Returns:
+            str: path to the file, or None if the tile is not stored
+        """
+        index = self.load_index()
+        for name in [tile_name] + [tile_name + ext for ext in sario.COMPRESSED_EXTS]:
+            if self.contains(name, index=index):
+                return self.path(name)
+        return None
+
+    def load_index(self):
+        """Reads the index file into a dict of {tile_name: entry}"""
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        save_json(self.index_path, index)
+
+    def _update_index(self, func):
+        """Applies func to the index dict (modifying in place), then saves
+
+        The index is reread holding the lock, so concurrent changes by
+        other threads or processes are kept
+        """
+        with self._lock, file_lock(self._lock_path):
+            index = self.load_index()
+            result = func(index)
+            self._save_index(index)
+            return result
+
+    def _make_entry(self, tile_name):
+        filename = self.path(tile_name)
+        return {
+            'size': _stored_size(filename),
+            'checksum': checksum(filename),
+            'last_access': time.time(),
+        }
+
+    def contains(self, tile_name, index=None):
+        """Checks that the tile is in the cache and complete
+
+        Indexed tiles must match the recorded size. Tiles from before the index
+        existed are accepted (and added to the index) if they hold a full .hgt size.
+        """
+        filename = self.path(tile_name)
+        if not os.path.exists(filename):
+            return False
+        index = self.load_index() if index is None else index
+        entry = index.get(tile_name)
+        if entry is not None:
+            return _stored_size(filename) == entry['size']
+        elif _hgt_size(filename) in HGT_SIZES:
+            logger.info("Adding existing %s to cache index", tile_name)
+            self.add(tile_name)
+            return True
+        return False
+
+    def add(self, tile_name):
+        """Records a newly saved tile in the index
+
+        Call prune() afterwards to enforce the size cap.
+        """
+        entry = self._make_entry(tile_name)
+
+        def _add(index):
+            index[tile_name] = entry
+
+        self._update_index(_add)
+
+    def touch(self, tile_names):
+        """Marks tiles as just used, so they are evicted last"""
+        now = time.time()
+
+        def _touch(index):
+            for tile_name in tile_names:
+                if tile_name in index:
+                    index[tile_name]['last_access'] = now
+
+        self._update_index(_touch)
+
+    def remove(self, tile_name):
+        """Deletes a tile from the cache directory and index"""
+        _delete(self.path(tile_name))
+
+        def _remove(index):
+            index.pop(tile_name, None)
+
+        self._update_index(_remove)
+
+    def entries(self):
+        """Returns list of (tile_name, entry) pairs, most recently used first"""
+        index = self.load_index()
+        return sorted(index.items(), key=lambda item: item[1]['last_access'], reverse=True)
+
+    def total_size(self):
+        return sum(entry['size'] for entry in self.load_index().values())
+
+    def prune(self, max_size=None, keep=()):
+        """Evicts least recently used tiles until the cache is under max_size
+
+        Args:
+            max_size (int or str): bytes to shrink the cache to (default: self.max_size)
+            keep (iterable[str]): tile names never to evict (e.g. ones about to be stitched)
+
+        Returns:
+            list[str]: names of the removed tiles
+        """
+        max_size = parse_size(max_size) if max_size is not None else self.max_size
+        if max_size is None:
+            return []
+        keep = set(keep)
+
+        def _prune(index):
+            removed = []
+            total = sum(entry['size'] for entry in index.values())
+            by_age = sorted(index.items(), key=lambda item: item[1]['last_access'])
+            for tile_name, entry in by_age:
+                if total <= max_size:
+                    break
+                if tile_name in keep:
+                    continue
+                logger.info("Evicting %s from cache", tile_name)
+                _delete(self.path(tile_name))
+                index.pop(tile_name)
+                total -= entry['size']
+                removed.append(tile_name)
+            return removed
+
+        return self._update_index(_prune)
+
+    def verify(self, remove=True):
+        """Checks the size and checksum of every indexed tile
+
+        Args:
+            remove (bool): delete the tiles which are missing or corrupted
+
+        Returns:
+            list[str]: names of the tiles which failed
+        """
+        bad_tiles = []
+        for tile_name, entry in self.load_index().items():
+            filename = self.path(tile_name)
+            if (not os.path.exists(filename) or _stored_size(filename) != entry['size']
+                    or checksum(filename) != entry['checksum']):
+                logger.warning("%s is missing or corrupted", tile_name)
+                bad_tiles.append(tile_name)
+
+        if remove:
+            for tile_name in bad_tiles:
+                self.remove(tile_name)
+        return sorted(bad_tiles)
+
+
+def _link_or_copy(src, dest):
+    """Hardlinks src to dest if on the same filesystem, otherwise copies"""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class ProductCache:
+    """Finished DEMs, stored under the inputs which made them
+
+    Each product is a directory cache_dir/products/<key>, where the key
+    is a hash of (tile names, bounds, rate, data_source), holding:
+
+        - elevation.dem, elevation.dem.rsc: the final (upsampled) DEM
+        - product.json: the inputs, plus the .rsc of the DEM before upsampling
+
+    Products are made read-only, since they are hardlinked to the outputs.
+    Each is recorded in the TileCache index as products/<key>, so they are
+    listed, verified, and evicted (least recently used first) along with the tiles.
+
+    Attributes:
+        cache_dir (str): same directory as the TileCache (default: get_cache_dir())
+        product_dir (str): subdirectory holding the products
+        tiles (TileCache): the index of cache_dir, with its size cap
+    """
+    DEM_NAME = 'elevation.dem'
+    META_NAME = 'product.json'
+
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir or get_cache_dir()
+        self.product_dir = os.path.join(self.cache_dir, PRODUCT_DIR)
+        self.tiles = TileCache(self.cache_dir, max_size=max_size)
+
+    @staticmethod
+    def entry_name(key):
+        """Name of a product in the TileCache index"""
+        return '{}/{}'.format(PRODUCT_DIR, key)
+
+    @staticmethod
+    def make_key(tile_names, bounds, rate, data_source):
+        """Hashes the inputs that determine a DEM
+
+        Examples:
+            >>> key = ProductCache.make_key(['N19W156.hgt'], (-156, 19, -155.5, 19.5), 2, 'AWS')
+            >>> len(key)
+            40
+            >>> key == ProductCache.make_key(['N19W156.hgt'], (-156, 19, -155.5, 19.5), 3, 'AWS')
+            False
+        """
+        inputs = {
+            'tile_names': sorted(tile_names),
+            # Rounding keeps float noise from the geojson parsing out of the key
+            'bounds': [round(b, 9) for b in bounds],
+            'rate': rate,
+            'data_source': data_source,
+        }
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key, name):
+        return os.path.join(self.product_dir, key, name)
+
+    def load_meta(self, key):
+        try:
+            with open(self._path(key, self.META_NAME)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _record_use(self, key):
+        """Marks a product as just used (indexing it, if saved before products were indexed)"""
+        name = self.entry_name(key)
+        if name in self.tiles.load_index():
+            self.tiles.touch([name])
+        else:
+            self.tiles.add(name)
+
+    def save(self, key, dem_filename, meta):
+        """Stores a finished DEM and its .rsc file
+
+        The product directory is written under a temporary name, then renamed,
+        so a product is either complete or absent. If another process saved
+        the same key first, theirs is kept. Then the cache is pruned to its
+        size cap (see TileCache.prune), keeping this product.
+
+        Args:
+            key (str): output of make_key
+            dem_filename (str): path to the .dem (with a .dem.rsc next to it)
+            meta (dict): json-able description, including 'rate', 'data_source',
+                and 'stitched_rsc' (the .rsc data of the DEM before upsampling)
+        """
+        if self.load_meta(key) is not None:
+            return
+        if not os.path.exists(self.product_dir):
+            os.makedirs(self.product_dir)
+        temp_dir = tempfile.mkdtemp(dir=self.product_dir, prefix='.')
+        try:
+            shutil.copyfile(dem_filename, os.path.join(temp_dir, self.DEM_NAME))
+            shutil.copyfile(dem_filename + '.rsc', os.path.join(temp_dir, self.DEM_NAME + '.rsc'))
+            with open(os.path.join(temp_dir, self.META_NAME), 'w') as f:
+                json.dump(meta, f, indent=2, sort_keys=True)
+            for name in os.listdir(temp_dir):
+                os.chmod(os.path.join(temp_dir, name), 0o444)
+            os.chmod(temp_dir, 0o755)
+            os.rename(temp_dir, os.path.join(self.product_dir, key))
+        except BaseException as e:
+            shutil.rmtree(temp_dir)
+            # Renaming onto a finished product of the same key fails (not empty)
+            if isinstance(e, OSError) and self.load_meta(key) is not None:
+                logger.info("DEM product %s was saved by another process", key)
+                return
+            raise
+        logger.info("Saved DEM product %s", key)
+        name = self.entry_name(key)
+        self.tiles.add(name)
+        self.tiles.prune(keep=[name])
+
+    def fetch(self, key, output_name):
+        """Links (or copies) a cached DEM and .rsc to output_name
+
+        Returns:
+            bool: True if the product was in the cache
+        """
+        if self.load_meta(key) is None:
+            return False
+        logger.info("Using cached DEM product %s", key)
+        _link_or_copy(self._path(key, self.DEM_NAME), output_name)
+        _link_or_copy(self._path(key, self.DEM_NAME + '.rsc'), output_name + '.rsc')
+        self._record_use(key)
+        return True
+
+    def keys(self):
+        if not os.path.exists(self.product_dir):
+            return []
+        return [key for key in os.listdir(self.product_dir) if not key.startswith('.')]
+
+    def find_superset(self, stitched_rsc, rate, data_source, tile_names=None):
+        """Finds a cached DEM on the same grid which covers stitched_rsc
+
+        Args:
+            stitched_rsc (dict): .rsc data of the wanted DEM, before upsampling
+                (from Stitcher.create_dem_rsc)
+            rate (int): upsampling rate of the wanted DEM
+            data_source (str): 'NASA' or 'AWS'
+            tile_names (list[str]): tiles which must have been loaded in the product
+                (rather than filled with zeros outside of a polygon)
+
+        Returns:
+            tuple[str, int, int]: key of the product, and the (row, col) offset of
+                the wanted DEM within the product's stitched grid. None if no match
+        """
+        for key in self.keys():
+            meta = self.load_meta(key)
+            if not meta or meta['rate'] != rate or meta['data_source'] != data_source:
+                continue
+            if tile_names is not None and not set(tile_names) <= set(meta.get('tile_names', [])):
+                continue
+            super_rsc = meta['stitched_rsc']
+            x_step, y_step = super_rsc['X_STEP'], super_rsc['Y_STEP']
+            if not (np.isclose(x_step, stitched_rsc['X_STEP'])
+                    and np.isclose(y_step, stitched_rsc['Y_STEP'])):
+                continue
+            # Both are on the SRTM grid, so the offsets are (nearly) whole pixels
+            row_off = int(round((stitched_rsc['Y_FIRST'] - super_rsc['Y_FIRST']) / y_step))
+            col_off = int(round((stitched_rsc['X_FIRST'] - super_rsc['X_FIRST']) / x_step))
+            if (row_off >= 0 and col_off >= 0
+                    and row_off + stitched_rsc['FILE_LENGTH'] <= super_rsc['FILE_LENGTH']
+                    and col_off + stitched_rsc['WIDTH'] <= super_rsc['WIDTH']):
+                return key, row_off, col_off
+        return None
+
+    def fetch_superset(self, stitched_rsc, rate, data_source, output_name, tile_names=None):
+        """Crops a cached DEM covering the wanted area, and writes it to output_name
+
+        The crop starts on an original SRTM grid point, which the bilinear
+        upsampling keeps at every `rate` pixels, so the interior pixels match
+        upsampling from scratch. The offsets are found by rounding the difference
+        of the X_FIRST/Y_FIRST over the step, which is exact since both are on the
+        SRTM grid.
+
+        Note: the last row and column may differ from a fresh build by 1 (meter)
+        from rounding: upsample_dem computes the edge of a DEM with different
+        float32 arithmetic than the interior points the crop uses.
+
+        Args:
+            stitched_rsc (dict): .rsc data of the wanted DEM, before upsampling
+            rate (int): upsampling rate of the wanted DEM
+            data_source (str): 'NASA' or 'AWS'
+            output_name (str): file to write the cropped DEM (and .rsc) to
+            tile_names (list[str]): tiles which must have been loaded in the product
+
+        Returns:
+            bool: True if a superset was found and cropped
+        """
+        match = self.find_superset(stitched_rsc, rate, data_source, tile_names=tile_names)
+        if match is None:
+            return False
+        key, row_off, col_off = match
+        logger.info("Cropping cached DEM product %s", key)
+
+        super_path = self._path(key, self.DEM_NAME)
+        super_rsc = sario.load_dem_rsc(super_path)
+        rows = (stitched_rsc['FILE_LENGTH'] - 1) * rate + 1
+        cols = (stitched_rsc['WIDTH'] - 1) * rate + 1
+        window = ((row_off * rate, row_off * rate + rows), (col_off * rate, col_off * rate + cols))
+        sario.load_elevation(super_path, window=window).tofile(output_name)
+
+        rsc_data = collections.OrderedDict(super_rsc)
+        rsc_data['FILE_LENGTH'], rsc_data['WIDTH'] = rows, cols
+        rsc_data['X_FIRST'] = stitched_rsc['X_FIRST']
+        rsc_data['Y_FIRST'] = stitched_rsc['Y_FIRST']
+        with open(output_name + '.rsc', 'w') as f:
+            f.write(sario.format_dem_rsc(rsc_data))
+        self._record_use(key)
+        return True
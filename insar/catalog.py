@@ -0,0 +1,254 @@
+"""Catalog of the files in a project directory tree, kept in a small sqlite database
+
+Pipeline steps need to find the same products over and over (Sentinel
+.zips, .geo files, igrams...), which means globbing directories of tens of
+thousands of files and running the filename regexes on all of them each time.
+The catalog stores, for every file under the root directory:
+
+    - directory (relative to root), name, extension, size, and mtime
+    - kind: 'sentinel', 'uavsar', 'igram' (YYYYmmdd_YYYYmmdd.*), or None
+    - parsed metadata: mission, date (Sentinel start time, UAVSAR
+      flight date, or igram master date), date2 (igram slave date),
+      and absolute orbit
+
+refresh() only relists directories whose mtime changed since the last
+refresh (a directory's mtime changes when files are added, removed or
+renamed in it), so on an unchanged tree it costs one stat per directory.
+Files rewritten in place don't change their directory's mtime: use
+refresh(full=True) to restat everything.
+
+Hidden files and directories (starting with '.') are not cataloged.
+The database defaults to .insar_catalog.sqlite in the root directory.
+"""
+from __future__ import division
+import datetime
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from insar.log import get_log
+from insar.parsers import Sentinel, Uavsar
+
+logger = get_log()
+
+DB_NAME = '.insar_catalog.sqlite'
+IGRAM_REGEX = re.compile(r'^(\d{8})_(\d{8})\.')
+# Directories changed this recently may still change within the same mtime tick
+MTIME_SLACK = 2  # seconds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ext TEXT,
+    size INTEGER,
+    mtime REAL,
+    kind TEXT,
+    mission TEXT,
+    date TEXT,
+    date2 TEXT,
+    absolute_orbit INTEGER,
+    PRIMARY KEY (dir, name)
+);
+CREATE INDEX IF NOT EXISTS files_kind ON files (kind, date);
+"""
+COLUMNS = ('dir', 'name', 'ext', 'size', 'mtime', 'kind', 'mission', 'date', 'date2',
+           'absolute_orbit')
+
+
+def _parse_names(names):
+    """Finds the kind and metadata of each file name
+
+    Returns:
+        dict: {name: (kind, mission, date, date2, absolute_orbit)} for
+            the names which are a known product
+    """
+    parsed = {}
+    sentinel = Sentinel.parse_many(n for n in names if n.startswith('S1'))
+    for name, mission, start, orbit in zip(sentinel['filename'], sentinel['mission'],
+                                           sentinel['start_time'].tolist(),
+                                           sentinel['absolute_orbit'].tolist()):
+        parsed[name] = ('sentinel', mission, start.isoformat(), None, orbit)
+
+    uavsar = Uavsar.parse_many(n for n in names if n not in parsed)
+    for name, date_str in zip(uavsar['filename'], uavsar['date']):
+        date = datetime.datetime.strptime(date_str, Uavsar.TIME_FMT).date()
+        parsed[name] = ('uavsar', None, date.isoformat(), None, None)
+
+    for name in names:
+        match = IGRAM_REGEX.match(name)
+        if match and name not in parsed:
+            dates = [datetime.datetime.strptime(d, '%Y%m%d').date().isoformat()
+                     for d in match.groups()]
+            parsed[name] = ('igram', None, dates[0], dates[1], None)
+    return parsed
+
+
+class Catalog(object):
+    """sqlite index of the files under a root directory
+
+    Attributes:
+        root (str): top directory of the project
+        db_path (str): path to the sqlite file (default: root/.insar_catalog.sqlite)
+
+    Example:
+        >>> import tempfile, shutil
+        >>> root = tempfile.mkdtemp()
+        >>> open(os.path.join(root, '20180420_20180502.int'), 'w').close()
+        >>> catalog = Catalog(root)
+        >>> catalog.refresh()
+        1
+        >>> [row['date2'] for row in catalog.products('igram')]
+        ['2018-05-02']
+        >>> catalog.close()
+        >>> shutil.rmtree(root)
+    """
+
+    def __init__(self, root='.', db_path=None):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path or os.path.join(self.root, DB_NAME)
+        # Steps of `insar process` may run in other threads: share one connection, one at a time
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.conn.row_factory = sqlite3.Row
+        # No journal file: it would change the root directory's mtime on every
+        # write. A catalog broken by a crash can be deleted and rebuilt
+        self.conn.execute("PRAGMA journal_mode=MEMORY")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _relpath(self, directory):
+        """Directory key in the database: path relative to root ('.' for root)"""
+        if directory is None:
+            return '.'
+        return os.path.relpath(os.path.abspath(directory), self.root)
+
+    def _scan_dir(self, rel_dir):
+        """Relists one directory, replacing its rows
+
+        Returns:
+            list[str]: relative paths of its subdirectories
+        """
+        abs_dir = os.path.join(self.root, rel_dir)
+        rows, subdirs = [], []
+        for name in os.listdir(abs_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(abs_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # Broken link, or removed while listing
+                continue
+            if os.path.isdir(path):
+                subdirs.append(os.path.normpath(os.path.join(rel_dir, name)))
+            else:
+                ext = os.path.splitext(name)[1]
+                rows.append([rel_dir, name, ext, stat.st_size, stat.st_mtime])
+
+        parsed = _parse_names([row[1] for row in rows])
+        rows = [row + list(parsed.get(row[1], (None, ) * 5)) for row in rows]
+        self.conn.execute("DELETE FROM files WHERE dir = ?", (rel_dir, ))
+        placeholders = ','.join('?' * len(COLUMNS))
+        self.conn.executemany("INSERT INTO files VALUES ({})".format(placeholders), rows)
+        return subdirs
+
+    def refresh(self, full=False):
+        """Updates the catalog with the files currently under root
+
+        Args:
+            full (bool): relist every directory, even ones with unchanged mtimes
+
+        Returns:
+            int: number of directories relisted
+        """
+        with self._lock:
+            return self._refresh(full)
+
+    def _refresh(self, full):
+        known = {}
+        children = {}
+        for row in self.conn.execute("SELECT path, parent, mtime FROM dirs"):
+            known[row['path']] = row['mtime']
+            children.setdefault(row['parent'], []).append(row['path'])
+
+        now = time.time()
+        seen = set()
+        num_scanned = 0
+        stack = ['.']
+        with self.conn:
+            while stack:
+                rel_dir = stack.pop()
+                try:
+                    mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime
+                except OSError:  # Removed since last refresh
+                    continue
+                seen.add(rel_dir)
+                if not full and known.get(rel_dir) == mtime:
+                    stack.extend(children.get(rel_dir, []))
+                    continue
+
+                subdirs = self._scan_dir(rel_dir)
+                num_scanned += 1
+                parent = None if rel_dir == '.' else (os.path.dirname(rel_dir) or '.')
+                # A directory changed within the mtime tick might change again unnoticed
+                recorded = mtime if now - mtime > MTIME_SLACK else None
+                self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                  (rel_dir, parent, recorded))
+                stack.extend(subdirs)
+
+            for rel_dir in set(known) - seen:
+                self.conn.execute("DELETE FROM dirs WHERE path = ?", (rel_dir, ))
+                self.conn.execute("DELETE FROM files WHERE dir = ?", (rel_dir, ))
+        logger.debug("Catalog refresh of %s relisted %s directories", self.root, num_scanned)
+        return num_scanned
+
+    def find(self, pattern='*', directory=None, kind=None):
+        """Glob-style search for files in one directory, like sario.find_files
+
+        Args:
+            pattern (str): glob on the file name (e.g. '*.int')
+            directory (str): directory to search (default: root)
+            kind (str): only return products of this kind (e.g. 'sentinel')
+
+        Returns:
+            list[str]: directory joined with each matching name, sorted by name
+        """
+        query = "SELECT name FROM files WHERE dir = ? AND name GLOB ?"
+        args = [self._relpath(directory), pattern]
+        if kind:
+            query += " AND kind = ?"
+            args.append(kind)
+        with self._lock:
+            rows = self.conn.execute(query + " ORDER BY name", args).fetchall()
+        names = [row['name'] for row in rows]
+        return [os.path.join(directory or self.root, name) for name in names]
+
+    def products(self, kind, directory=None):
+        """Rows of all products of one kind in a directory, in date order
+
+        Args:
+            kind (str): 'sentinel', 'uavsar', or 'igram'
+            directory (str): directory to search (default: root)
+
+        Returns:
+            list[sqlite3.Row]: rows with keys of COLUMNS (dates as iso strings)
+        """
+        query = "SELECT * FROM files WHERE kind = ? AND dir = ? ORDER BY date, date2, name"
+        with self._lock:
+            return self.conn.execute(query, (kind, self._relpath(directory))).fetchall()
@@ -47,11 +47,16 @@ Made for python3, compatible with python2
 """
 from __future__ import division
 try:
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from concurrent.futures import ThreadPoolExecutor
     PARALLEL = True
 except ImportError:  # Python 2 doesn't have this :(
     PARALLEL = False
+try:
+    from insar.engine import get_default_engine
+except (ImportError, SyntaxError):  # Needs python 3.5+
+    get_default_engine = None
 import collections
+import functools
 import getpass
 import io
 import json
@@ -59,14 +64,15 @@ import math
 import netrc
 import os
 import re
-import subprocess
-import sys
+import shutil
+import tempfile
+from contextlib import closing
 import numpy as np
 import requests
 
 import insar
 from insar.log import get_log
-from insar import sario, utils
+from insar import cache, download, sario, utils
 
 try:
     input = raw_input  # Check for python 2
@@ -89,19 +95,6 @@ RSC_KEYS = [
 ]
 
 
-def _get_cache_dir():
-    """Find location of directory to store .hgt downloads
-
-    Assuming linux, uses ~/.cache/insar/
-
-    """
-    path = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
-    path = os.path.join(path, 'insar')  # Make subfolder for our downloads
-    if not os.path.exists(path):
-        os.makedirs(path)
-    return path
-
-
 def _get_username_pass():
     """If netrc is not set up, get command line username and password"""
     print("====================================================================")
@@ -203,6 +196,21 @@ class Tile:
         """
         return int(math.floor(lon)), int(math.floor(lat))
 
+    @staticmethod
+    def srtm1_tile_bounds(tile_name):
+        """The (left, bottom, right, top) lon/lat box that a tile covers
+
+        Examples:
+            >>> Tile.srtm1_tile_bounds('N19W156.hgt')
+            (-156, 19, -155, 20)
+            >>> Tile.srtm1_tile_bounds('S5E6.hgt')
+            (6, -5, 7, -4)
+        """
+        lat_str, lat, lon_str, lon = Tile.get_tile_parts(tile_name)
+        bottom = lat if lat_str == 'N' else -lat
+        left = -lon if lon_str == 'W' else lon
+        return left, bottom, left + 1, bottom + 1
+
     def srtm1_tile_names(self):
         """Iterator over all tiles needed to cover the requested bounds
 
@@ -256,6 +264,17 @@ class Downloader:
         data_source (str): choices: NASA, AWS. See module docstring for explanation of sources
         parallel_ok (bool): true if using python3 or concurrent.futures installed
         cache_dir (str): explcitly specify where to store .hgt files
+        cache (TileCache): index of the downloaded tiles in cache_dir
+        max_workers (int): number of tiles to download at once (if parallel_ok,
+            and within the engine's limits)
+        retries (int): number of times to retry a tile after a temporary failure
+        backoff (float): seconds to wait before the first retry, doubled after each
+        keep_compressed (bool): store tiles in the cache as downloaded (.hgt.zip
+            or .hgt.gz) instead of unzipping to .hgt. Uses about 3x less disk,
+            but stitching is much slower, since each tile is decompressed
+        engine (DownloadEngine): runs the tile downloads (default: the
+            engine.get_default_engine() shared with the orbit downloads)
+        session (requests.Session): shared connection pool for all tile requests
 
     Raises:
         ValueError: if data_source not a valid source string
@@ -274,16 +293,33 @@ class Downloader:
                  data_source='NASA',
                  netrc_file='~/.netrc',
                  parallel_ok=PARALLEL,
-                 cache_dir=None):
+                 cache_dir=None,
+                 max_workers=4,
+                 retries=3,
+                 backoff=1.0,
+                 data_url=None,
+                 keep_compressed=False,
+                 engine=None):
         self.tile_names = tile_names
         self.data_source = data_source
         if data_source not in self.VALID_SOURCES:
             raise ValueError('data_source must be one of: {}'.format(','.join(self.VALID_SOURCES)))
-        self.data_url = self.DATA_URLS[data_source]
+        # data_url can point to a mirror with the same layout as the data_source
+        self.data_url = data_url or self.DATA_URLS[data_source]
         self.compress_type = self.COMPRESS_TYPES[data_source]
         self.netrc_file = os.path.expanduser(netrc_file)
         self.parallel_ok = parallel_ok
-        self.cache_dir = cache_dir or _get_cache_dir()
+        self.cache_dir = cache_dir or cache.get_cache_dir()
+        self.cache = cache.TileCache(self.cache_dir)
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.keep_compressed = keep_compressed
+        if engine is None and parallel_ok and get_default_engine is not None:
+            engine = get_default_engine()
+        self.engine = engine
+        self.session = engine.session if engine else download.make_session(pool_size=max_workers)
+        self.username = self.password = None
 
     def _get_netrc_file(self):
         return Netrc(self.netrc_file)
@@ -361,43 +397,75 @@ class Downloader:
                 ext=self.compress_type)
         return url
 
-    def _download_hgt_tile(self, url):
-        """Example from https://lpdaac.usgs.gov/data_access/daac2disk "command line tips" """
+    def _download_hgt_tile(self, url, headers=None):
+        """Example from https://lpdaac.usgs.gov/data_access/daac2disk "command line tips"
+
+        Args:
+            url (str): address of the tile
+            headers (dict): extra request headers (e.g. Range, to resume)
+
+        Returns:
+            requests.Response: opened with stream=True, so body has not been read yet
+        """
         # Using AWS or a netrc file are the easy cases
         logger.info("Downloading {}".format(url))
-        if self.data_source == 'AWS':
-            response = requests.get(url)
-        elif self.data_source == 'NASA' and self._has_nasa_netrc():
-            logger.info("Using netrc file: %s", self.netrc_file)
-            response = requests.get(url)
-        else:
+        if self.data_source == 'NASA' and self.username and not self._has_nasa_netrc():
             # NASA without a netrc file needs special auth session handling
-            with requests.Session() as session:
-                session.auth = (self.username, self.password)
-                r1 = session.request('get', url)
+            auth = (self.username, self.password)
+            with closing(self.session.get(
+                    url, auth=auth, stream=True, timeout=download.TIMEOUT)) as r1:
                 # NASA then redirects to
                 # urs.earthdata.nasa.gov/oauth/authorize?scope=uid&app_type=401&client_id=...
-                response = session.get(r1.url, auth=(self.username, self.password))
+                redirect_url = r1.url
+            response = self.session.get(
+                redirect_url, auth=auth, headers=headers, stream=True, timeout=download.TIMEOUT)
+        else:
+            if self.data_source == 'NASA':
+                logger.info("Using netrc file: %s", self.netrc_file)
+            response = self.session.get(
+                url, headers=headers, stream=True, timeout=download.TIMEOUT)
 
         # Now check response for auth issues/ errors
         if response.status_code == 404:
             logger.error("Cannot find url: check latitudes/ longitudes of input bounding box.")
-        response.raise_for_status()
         return response
 
+    def _compressed_name(self, tile_name):
+        return '{}.{}'.format(tile_name, self.compress_type)
+
     def _unzip_file(self, filepath):
-        """Unzips in place the .hgt files downloaded"""
-        ext = sario.get_file_ext(filepath)
-        if ext == '.gz':
-            unzip_cmd = ['gunzip']
-        elif ext == '.zip':
-            # -o forces overwrite without prompt, -d specifices unzip directory
-            unzip_cmd = 'unzip -o -d {}'.format(self.cache_dir).split(' ')
-        subprocess.check_call(unzip_cmd + [filepath])
+        """Unzips in place the .hgt file downloaded, then removes the compressed file
+
+        The .hgt is extracted to a temporary file and renamed when complete
+        """
+        # Both N19W156.hgt.gz and N19W156.hgt.zip hold N19W156.hgt
+        hgt_path = os.path.splitext(filepath)[0]
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                with sario.open_compressed_hgt(filepath) as (f_in, _):
+                    shutil.copyfileobj(f_in, f_out, download.CHUNK_SIZE)
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, hgt_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        os.remove(filepath)
+
+    def _in_cache(self, tile_name, index=None):
+        # Tiles from older versions may have been unzipped to a plain .hgt
+        return any(
+            self.cache.contains(name, index=index)
+            for name in (tile_name, self._compressed_name(tile_name)))
 
     def download_and_save(self, tile_name):
         """Download and save one single tile
 
+        The compressed tile is streamed to disk (retrying temporary
+        failures, and resuming a partial file from an earlier attempt),
+        then unzipped in place, unless keep_compressed
+        (sario.load_elevation also reads .hgt.gz/.zip)
+
         Args:
             tile_name (str): string name of tile
             e.g. N06W001.SRTMGL1.hgt.zip (usgs) or N19/N19W156.gz (aws)
@@ -405,24 +473,35 @@ class Downloader:
         Returns:
             None
         """
-        # keep all in one folder, compressed
-        local_filename = os.path.join(self.cache_dir, tile_name)
-        if os.path.exists(local_filename):
-            logger.info("{} already exists, skipping.".format(local_filename))
-        else:
-            # On AWS these are gzipped: download, then unzip
-            local_filename += '.{}'.format(self.compress_type)
-            with open(local_filename, 'wb') as f:
-                url = self._form_tile_url(tile_name)
-                response = self._download_hgt_tile(url)
-                f.write(response.content)
-                logger.info("Writing to {}".format(local_filename))
-            logger.info("Unzipping {}".format(local_filename))
-            self._unzip_file(local_filename)
+        # keep all in one folder
+        if self._in_cache(tile_name):
+            logger.info("{} already exists, skipping.".format(tile_name))
+            return
+
+        local_filename = self.cache.path(self._compressed_name(tile_name))
+        url = self._form_tile_url(tile_name)
+
+        def _download():
+            headers = download.range_headers(local_filename)
+            with closing(self._download_hgt_tile(url, headers=headers)) as response:
+                return download.save_response(response, local_filename)
+
+        with download.lock_partial(local_filename) as waited:
+            if waited and self._in_cache(tile_name):
+                logger.info("{} was downloaded by another process.".format(tile_name))
+                return
+            num_bytes = download.retry(_download, retries=self.retries, backoff=self.backoff)
+            logger.info("Wrote {} bytes to {}".format(num_bytes, local_filename))
+            if self.keep_compressed:
+                self.cache.add(self._compressed_name(tile_name))
+            else:
+                logger.info("Unzipping {}".format(local_filename))
+                self._unzip_file(local_filename)
+                self.cache.add(tile_name)
 
     def _all_files_exist(self):
-        filepaths = [os.path.join(self.cache_dir, tile_name) for tile_name in self.tile_names]
-        return all(os.path.exists(f) for f in filepaths)
+        index = self.cache.load_index()
+        return all(self._in_cache(tile_name, index=index) for tile_name in self.tile_names)
 
     def download_all(self):
         """Downloads and saves all tiles from tile list"""
@@ -431,20 +510,20 @@ class Downloader:
         ):
             self.handle_credentials()
 
-        if self.parallel_ok:
-            with ThreadPoolExecutor(max_workers=4) as executor:
-                future_to_tile = {
-                    executor.submit(self.download_and_save, tile): tile
-                    for tile in self.tile_names
-                }
-                for future in as_completed(future_to_tile):
-                    future.result()
-                    logger.info('Finished {}'.format(future_to_tile[future]))
-
+        if self.parallel_ok and self.engine is not None:
+            self.engine.run([(self._form_tile_url(tile_name),
+                              functools.partial(self.download_and_save, tile_name))
+                             for tile_name in self.tile_names],
+                            limit=self.max_workers)
         else:
             for tile_name in self.tile_names:
                 self.download_and_save(tile_name)
 
+        # Make room under the cache's size cap, without evicting the tiles we need now
+        stored_names = self.tile_names + [self._compressed_name(t) for t in self.tile_names]
+        self.cache.touch(stored_names)
+        self.cache.prune(keep=stored_names)
+
 
 class Stitcher:
     """Class to combine separate .hgt tiles into one .dem file
@@ -454,30 +533,80 @@ class Stitcher:
             E.g.: ['N19W156.hgt', 'N19W155.hgt']
         num_pixels (int): size of the squares of the .hgt files
             Assumes 3601 for SRTM1 (SRTM3, 3 degree not implemented/tested)
+        cache_dir (str): directory containing the .hgt tiles (default: cache.get_cache_dir())
+        parallel_ok (bool): load tiles with multiple threads
+        bounds (tuple[float]): optional (left, bot, right, top) lon/lat box to crop to.
+            If given, only the parts of each tile inside the bounds are read,
+            and shape/create_dem_rsc describe the cropped DEM
+        needed_tiles (list[str]): optional subset of tile_names to load (e.g. the
+            ones touching a polygon). The rest are not read, and are filled with 0
 
     """
 
-    def __init__(self, tile_names, num_pixels=3601):
+    def __init__(self,
+                 tile_names,
+                 num_pixels=3601,
+                 cache_dir=None,
+                 parallel_ok=PARALLEL,
+                 bounds=None,
+                 needed_tiles=None):
         """List should come from Tile.srtm1_tile_names()"""
         self.tile_file_list = list(tile_names)
         # Assuming SRTMGL1: 3601 x 3601 squares
         self.num_pixels = num_pixels
+        self.cache_dir = cache_dir
+        self.parallel_ok = parallel_ok
+        self.bounds = bounds
+        self.needed_tiles = set(needed_tiles) if needed_tiles is not None else None
 
     @property
     def shape(self):
         """Number of rows/columns in pixels for stitched .dem
 
         Uses the blockshape property, along with num_pixels property
-        Returned as a tuple
+        Returned as a tuple. If bounds were given, this is the cropped shape.
 
         Examples:
             >>> s = Stitcher(['N19W156.hgt', 'N19W155.hgt'])
             >>> s.shape
             (3601, 7201)
+            >>> s = Stitcher(['N19W156.hgt', 'N19W155.hgt'], bounds=(-155.5, 19.2, -154.5, 19.5))
+            >>> s.shape
+            (1081, 3601)
         """
+        (row_start, row_end), (col_start, col_end) = self.crop_window
+        return (row_end - row_start, col_end - col_start)
+
+    @property
+    def full_shape(self):
+        """Number of rows/columns in pixels for all tiles stitched (before any crop)"""
         blockrows, blockcols = self.blockshape
         return (self._total_length(blockrows), self._total_length(blockcols))
 
+    @property
+    def crop_window(self):
+        """Rows and cols of the full stitched tiles that are kept after cropping to bounds
+
+        Returns:
+            tuple: ((row_start, row_end), (col_start, col_end)), end exclusive
+        """
+        nrows, ncols = self.full_shape
+        if not self.bounds:
+            return ((0, nrows), (0, ncols))
+
+        rsc_data = self._full_dem_rsc()
+        indexes, _ = find_bounding_idxs(
+            self.bounds,
+            rsc_data['X_STEP'],
+            rsc_data['Y_STEP'],
+            rsc_data['X_FIRST'],
+            rsc_data['Y_FIRST'],
+        )
+        left_idx, bot_idx, right_idx, top_idx = indexes
+        # Clamp to the tile area, as slicing the full stitched array would
+        return ((min(max(top_idx, 0), nrows), min(max(bot_idx, 0), nrows)),
+                (min(max(left_idx, 0), ncols), min(max(right_idx, 0), ncols)))
+
     def _total_length(self, numblocks):
         """Computes the total number of pixels in one dem from numblocks"""
         return numblocks * (self.num_pixels - 1) + 1
@@ -560,30 +689,101 @@ class Stitcher:
         nrows, ncols = self.blockshape
         return np.array(self.tile_file_list).reshape((nrows, ncols))
 
-    def load_and_stitch(self):
+    def _tile_slices(self, block_row, block_col):
+        """Finds where one tile's data goes in the stitched DEM
+
+        Adjacent SRTM tiles share their edge row/column, so all tiles except
+        the top row (left column) skip their first row (column).
+
+        Returns:
+            tuple: (window, out_rows, out_cols), where window is the
+                ((row_start, row_end), (col_start, col_end)) to read from the tile,
+                out_rows/out_cols are the slices of the stitched DEM to fill
+
+        Examples:
+            >>> s = Stitcher(['N19W156.hgt', 'N19W155.hgt'])
+            >>> s._tile_slices(0, 1)
+            (((0, 3601), (1, 3601)), slice(0, 3601, None), slice(3601, 7201, None))
+        """
+        n = self.num_pixels
+        row_skip = 0 if block_row == 0 else 1
+        col_skip = 0 if block_col == 0 else 1
+        row_start = block_row * (n - 1) + row_skip
+        col_start = block_col * (n - 1) + col_skip
+        window = ((row_skip, n), (col_skip, n))
+        out_rows = slice(row_start, row_start + n - row_skip)
+        out_cols = slice(col_start, col_start + n - col_skip)
+        return window, out_rows, out_cols
+
+    def _load_tile(self, tile_path, window, out_view):
+        """Reads one tile's window straight into its place in the output"""
+        # Converts byte order and clips voids in the same pass as the copy
+        sario.load_elevation(tile_path, window=window, out=out_view)
+
+    def load_and_stitch(self, outfile=None):
         """Function to load combine .hgt tiles
 
-        Uses hstack first on rows, then vstacks rows together.
-        Also handles the deleting of overlapped rows/columns of SRTM tiles
-        TODO: break this up to more testable chunks
+        The output array is allocated once (or memory mapped to `outfile`),
+        and each tile is copied directly into its place, with the
+        overlapping rows/columns of SRTM tiles only copied once.
+        If bounds were given, only the window of each tile inside the bounds is
+        read, and tiles entirely outside are skipped. Tiles not in needed_tiles
+        are left as zeros.
+        Tiles are loaded in parallel if parallel_ok.
+
+        Args:
+            outfile (str): optional filename to memory map the stitched DEM to,
+                to keep memory use flat for very large DEMs
 
         Returns:
-            ndarray: the stitched .hgt tiles in 2D np.array
+            ndarray: the stitched .hgt tiles in 2D np.array (np.memmap if outfile)
         """
-        row_list = []
-        # ncols in the number of .hgt blocks wide
-        _, ncols = self.blockshape
-        flist = self._create_file_array()
-        for idx, row in enumerate(flist):
-            cur_row = np.hstack(sario.load_file(os.path.join(_get_cache_dir(), f)) for f in row)
-            # Delete columns: 3601*[1, 2,... not-including last column]
-            delete_cols = self.num_pixels * np.arange(1, ncols)
-            cur_row = np.delete(cur_row, delete_cols, axis=1)
-            if idx > 0:
-                # For all except first block-row, delete repeated first row of data
-                cur_row = np.delete(cur_row, 0, axis=0)
-            row_list.append(cur_row)
-        return np.vstack(row_list)
+        if outfile:
+            # New memmaps start as all zeros
+            stitched = np.memmap(outfile, dtype=sario.INT_16_LE, mode='w+', shape=self.shape)
+        elif self.needed_tiles is not None:
+            stitched = np.zeros(self.shape, dtype=sario.INT_16_LE)
+        else:
+            stitched = np.empty(self.shape, dtype=sario.INT_16_LE)
+
+        (crop_row_start, crop_row_end), (crop_col_start, crop_col_end) = self.crop_window
+        tile_cache = cache.TileCache(self.cache_dir)
+        jobs = []
+        for (block_row, block_col), tile_name in np.ndenumerate(self._create_file_array()):
+            window, out_rows, out_cols = self._tile_slices(block_row, block_col)
+            (tile_row_start, _), (tile_col_start, _) = window
+            # Intersect the tile's place in the full DEM with the crop
+            row_start, row_end = max(out_rows.start, crop_row_start), min(out_rows.stop, crop_row_end)
+            col_start, col_end = max(out_cols.start, crop_col_start), min(out_cols.stop, crop_col_end)
+            if row_start >= row_end or col_start >= col_end:
+                logger.debug("Skipping %s: outside of bounds", tile_name)
+                continue
+            if self.needed_tiles is not None and tile_name not in self.needed_tiles:
+                logger.debug("Skipping %s: not needed, filling with zeros", tile_name)
+                continue
+
+            # Shift to the tile's own pixel indexes to read, and the crop's to write
+            row_offset = tile_row_start - out_rows.start
+            col_offset = tile_col_start - out_cols.start
+            window = ((row_start + row_offset, row_end + row_offset),
+                      (col_start + col_offset, col_end + col_offset))
+            out_view = stitched[row_start - crop_row_start:row_end - crop_row_start,
+                                col_start - crop_col_start:col_end - crop_col_start]
+            tile_path = tile_cache.find(tile_name)
+            if tile_path is None:
+                raise ValueError("{} not found in {}".format(tile_name, tile_cache.cache_dir))
+            jobs.append((tile_path, window, out_view))
+
+        if self.parallel_ok and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for future in [executor.submit(self._load_tile, *job) for job in jobs]:
+                    future.result()
+        else:
+            for job in jobs:
+                self._load_tile(*job)
+
+        tile_cache.touch([os.path.basename(job[0]) for job in jobs])
+        return stitched
 
     def _find_step_sizes(self, ndigits=12):
         """Calculates the step size for the dem.rsc
@@ -604,10 +804,34 @@ class Stitcher:
         step_size = utils.floor_float(1 / (self.num_pixels - 1), ndigits)
         return (step_size, -1 * step_size)
 
+    def _full_dem_rsc(self):
+        """The .dem.rsc values for all tiles stitched, before any cropping"""
+        # Use an OrderedDict for the key/value pairs so writing to file easy
+        rsc_dict = collections.OrderedDict.fromkeys(RSC_KEYS)
+        rsc_dict.update({
+            'X_UNIT': 'degrees',
+            'Y_UNIT': 'degrees',
+            'Z_OFFSET': 0,
+            'Z_SCALE': 1,
+            'PROJECTION': 'LL',
+        })
+
+        # Remove paths from tile filenames, if they exist
+        x_first, y_first = self.start_lon_lat(self.tile_file_list[0])
+        nrows, ncols = self.full_shape
+        # TODO: figure out where to generalize for SRTM3
+        rsc_dict.update({'WIDTH': ncols, 'FILE_LENGTH': nrows})
+        rsc_dict.update({'X_FIRST': x_first, 'Y_FIRST': y_first})
+
+        x_step, y_step = self._find_step_sizes()
+        rsc_dict.update({'X_STEP': x_step, 'Y_STEP': y_step})
+        return rsc_dict
+
     def create_dem_rsc(self):
         """Takes a list of the SRTM1 tile names and outputs .dem.rsc file values
 
         See module docstring for example .dem.rsc file.
+        If bounds were given, the values describe the cropped DEM.
 
         Args:
             srtm1_tile_list (list[str]): names of tiles (e.g. N19W156)
@@ -622,26 +846,17 @@ class Stitcher:
             >>> s.create_dem_rsc()
             OrderedDict([('WIDTH', 7201), ('FILE_LENGTH', 3601), ('X_FIRST', -156.0), ('Y_FIRST', 20.0), ('X_STEP', 0.000277777777), ('Y_STEP', -0.000277777777), ('X_UNIT', 'degrees'), ('Y_UNIT', 'degrees'), ('Z_OFFSET', 0), ('Z_SCALE', 1), ('PROJECTION', 'LL')])
         """
+        rsc_dict = self._full_dem_rsc()
+        if not self.bounds:
+            return rsc_dict
 
-        # Use an OrderedDict for the key/value pairs so writing to file easy
-        rsc_dict = collections.OrderedDict.fromkeys(RSC_KEYS)
-        rsc_dict.update({
-            'X_UNIT': 'degrees',
-            'Y_UNIT': 'degrees',
-            'Z_OFFSET': 0,
-            'Z_SCALE': 1,
-            'PROJECTION': 'LL',
-        })
-
-        # Remove paths from tile filenames, if they exist
-        x_first, y_first = self.start_lon_lat(self.tile_file_list[0])
+        (row_start, _), (col_start, _) = self.crop_window
         nrows, ncols = self.shape
-        # TODO: figure out where to generalize for SRTM3
-        rsc_dict.update({'WIDTH': ncols, 'FILE_LENGTH': nrows})
-        rsc_dict.update({'X_FIRST': x_first, 'Y_FIRST': y_first})
-
-        x_step, y_step = self._find_step_sizes()
-        rsc_dict.update({'X_STEP': x_step, 'Y_STEP': y_step})
+        # Adjust the .dem.rsc data to reflect new top-left corner and new shape
+        rsc_dict['X_FIRST'] = rsc_dict['X_FIRST'] + rsc_dict['X_STEP'] * col_start
+        rsc_dict['Y_FIRST'] = rsc_dict['Y_FIRST'] + rsc_dict['Y_STEP'] * row_start
+        rsc_dict['FILE_LENGTH'] = nrows
+        rsc_dict['WIDTH'] = ncols
         return rsc_dict
 
 
@@ -703,6 +918,180 @@ def upsample_dem_rsc(rate=None, rsc_dict=None, rsc_filepath=None):
     return outstring
 
 
+def _bilinear_rows(dem, row_start, row_end, rate):
+    """Bilinear upsampling of the cells starting on rows row_start to row_end
+
+    Reproduces the float32 arithmetic of upsample.c exactly, so that output
+    matches it bit-for-bit: each cell's corners h1 (top left), h2 (top right),
+    h3 (bottom left), h4 (bottom right) give the value at (x, y) as
+        a00 + a10*x + a01*y + a11*x*y, truncated towards zero to an int16
+    The last column (with no cell to the right) is interpolated in 1D.
+
+    Returns:
+        ndarray: int16, shape (rate * (row_end - row_start), 1 + (ncols - 1) * rate)
+    """
+    f32 = np.float32
+    block = dem[row_start:row_end + 1].astype(np.int32)
+    ncols = block.shape[1]
+    h1, h2 = block[:-1, :-1], block[:-1, 1:]
+    h3, h4 = block[1:, :-1], block[1:, 1:]
+    # Add a trailing axis so the `rate` sub-pixel positions broadcast along columns
+    a00 = h1.astype(f32)[..., np.newaxis]
+    a10 = (h2 - h1).astype(f32)[..., np.newaxis]
+    a01 = (h3 - h1).astype(f32)[..., np.newaxis]
+    a11 = (h1 - h2 - h3 + h4).astype(f32)[..., np.newaxis]
+    # Distance across the 1x1 cell of each new point
+    steps = np.arange(rate, dtype=f32) / f32(rate)
+
+    nrows = row_end - row_start
+    out = np.empty((nrows, rate, _up_size(ncols, rate)), dtype=sario.INT_16_LE)
+    col_left, col_right = block[:-1, -1].astype(f32), block[1:, -1].astype(f32)
+    a10_x = a10 * steps
+    a11_x = a11 * steps
+    for bi, y in enumerate(steps):
+        # Same order of operations as upsample.c, all in float32
+        interp = ((a00 + a10_x) + a01 * y) + a11_x * y
+        out[:, bi, :-1] = interp.reshape((nrows, -1))
+        out[:, bi, -1] = y * col_right + (f32(1) - y) * col_left
+    return out.reshape((nrows * rate, -1))
+
+
+def _bilinear_last_row(dem, rate):
+    """Upsamples the last row of the dem with 1D interpolation, like upsample.c"""
+    f32 = np.float32
+    last_row = dem[-1].astype(f32)
+    h1, h2 = last_row[:-1, np.newaxis], last_row[1:, np.newaxis]
+    x = np.arange(rate, dtype=f32) / f32(rate)
+    interp = x * h2 + (f32(1) - x) * h1
+    return np.append(interp.reshape(-1), last_row[-1]).astype(sario.INT_16_LE)
+
+
+def _cubic_weights(t):
+    """Keys cubic convolution weights (a = -0.5) for points at -1, 0, 1, 2 from t
+
+    Args:
+        t (ndarray): positions between 0 and 1 from the left point
+
+    Returns:
+        ndarray: shape (len(t), 4), weights for each of the 4 neighbors
+
+    Example:
+        >>> print(_cubic_weights(np.array([0.0, 0.5])))
+        [[ 0.      1.      0.      0.    ]
+         [-0.0625  0.5625  0.5625 -0.0625]]
+    """
+    t = np.asarray(t, dtype=np.float64)[:, np.newaxis]
+    dist = np.abs(t - np.arange(-1, 3))
+    a = -0.5
+    near = (a + 2) * dist**3 - (a + 3) * dist**2 + 1
+    far = a * dist**3 - 5 * a * dist**2 + 8 * a * dist - 4 * a
+    return np.where(dist <= 1, near, np.where(dist < 2, far, 0))
+
+
+def _cubic_positions(size, rate):
+    """Index of the left neighbor, and fractional position, for each upsampled point"""
+    new_points = np.arange(_up_size(size, rate))
+    idxs = np.minimum(new_points // rate, size - 1)
+    return idxs, (new_points - idxs * rate) / rate
+
+
+def _bicubic_rows(dem, row_start, row_end, rate):
+    """Bicubic upsampling of output rows rate*row_start up to rate*row_end
+
+    Edges are handled by repeating the border pixels
+    """
+    nrows, ncols = dem.shape
+    row_idxs, row_t = _cubic_positions(nrows, rate)
+    out_rows = slice(rate * row_start, min(rate * row_end, len(row_idxs)))
+    row_idxs, row_t = row_idxs[out_rows], row_t[out_rows]
+    col_idxs, col_t = _cubic_positions(ncols, rate)
+
+    # First interpolate each new row from the 4 original rows around it.
+    # Each neighbor is added in turn, so no (rows, cols, 4) array is made
+    neighbors = np.clip(row_idxs[:, np.newaxis] + np.arange(-1, 3), 0, nrows - 1)
+    weights = _cubic_weights(row_t)
+    rows_interp = np.zeros((len(row_idxs), ncols))
+    for k in range(4):
+        rows_interp += weights[:, k, np.newaxis] * dem[neighbors[:, k]]
+    # Then interpolate along the columns of each new row
+    neighbors = np.clip(col_idxs[:, np.newaxis] + np.arange(-1, 3), 0, ncols - 1)
+    weights = _cubic_weights(col_t)
+    out = np.zeros((len(row_idxs), len(col_idxs)))
+    for k in range(4):
+        out += weights[:, k] * rows_interp[:, neighbors[:, k]]
+    info = np.iinfo(sario.INT_16_LE)
+    return np.clip(np.round(out), info.min, info.max).astype(sario.INT_16_LE)
+
+
+def upsample_dem(dem, rate, outfile=None, method='bilinear', block_rows=256, parallel_ok=PARALLEL):
+    """Upsamples a DEM by an integer rate, in place of the upsample.c program
+
+    Works on blocks of rows at a time, so the output can be streamed to a
+    memory mapped .dem file without holding the whole upsampled grid in memory.
+    The 'bilinear' method gives the same output as upsample.c bit-for-bit.
+
+    Example: 3 points at x = (0, 1, 2), rate = 2 becomes 5 points:
+        x = (0, .5, 1, 1.5, 2)
+
+    Args:
+        dem (ndarray): 2D int16 array of heights (may be a np.memmap)
+        rate (int): positive integer rate to upsample by
+        outfile (str): optional name of .dem file to write (as memory map)
+        method (str): 'bilinear' or 'bicubic'
+        block_rows (int): number of upsampled rows to make at a time (rounded
+            down to whole original rows), which bounds the memory per block
+        parallel_ok (bool): process blocks of rows in parallel with threads
+
+    Returns:
+        ndarray: upsampled int16 DEM of shape (1 + (rows - 1) * rate, 1 + (cols - 1) * rate)
+            (a np.memmap of outfile, if given)
+
+    Raises:
+        ValueError: if method is not 'bilinear' or 'bicubic'
+
+    Example:
+        >>> dem = np.array([[0, 4], [8, 12]], dtype='<i2')
+        >>> print(upsample_dem(dem, 2))
+        [[ 0  2  4]
+         [ 4  6  8]
+         [ 8 10 12]]
+    """
+    if method not in ('bilinear', 'bicubic'):
+        raise ValueError("method must be 'bilinear' or 'bicubic'")
+    nrows, ncols = dem.shape
+    out_shape = (_up_size(nrows, rate), _up_size(ncols, rate))
+    if outfile:
+        upsampled = np.memmap(outfile, dtype=sario.INT_16_LE, mode='w+', shape=out_shape)
+    else:
+        upsampled = np.empty(out_shape, dtype=sario.INT_16_LE)
+
+    # Blocks of original rows: the upsampled block is `rate` times larger
+    block_rows = max(block_rows // rate, 1)
+
+    def _upsample_block(row_start):
+        row_end = min(row_start + block_rows, nrows - 1)
+        if method == 'bilinear':
+            block = _bilinear_rows(dem, row_start, row_end, rate)
+        else:
+            block = _bicubic_rows(dem, row_start, row_end, rate)
+        upsampled[rate * row_start:rate * row_end] = block
+
+    # Each block of cells fills its own rows of the output: the final row is done after
+    block_starts = range(0, nrows - 1, block_rows)
+    if parallel_ok and len(block_starts) > 1:
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_upsample_block, block_starts))
+    else:
+        for row_start in block_starts:
+            _upsample_block(row_start)
+
+    if method == 'bilinear':
+        upsampled[-1] = _bilinear_last_row(dem, rate)
+    else:
+        upsampled[-1] = _bicubic_rows(dem, nrows - 1, nrows, rate)
+    return upsampled
+
+
 def find_bounding_idxs(bounds, x_step, y_step, x_first, y_first):
     """Finds the indices of stitched dem to crop bounding box
     Also finds the new x_start and y_start after cropping.
@@ -794,14 +1183,53 @@ def create_kml(rsc_data, tif_filename, title="Title", desc="Description"):
     return output
 
 
-def main(geojson, data_source, rate, output_name):
+def save_polygon_mask(geojson_obj, dem_filename):
+    """Saves a mask of the DEM pixels inside the geojson polygon
+
+    Saved to <dem_filename without extension>_mask.npy (e.g. elevation_mask.npy)
+    as a boolean array the same shape as the DEM, True inside the polygon.
+    Use insar.geojson.rasterize directly for a mask on other grids (e.g. igrams)
+
+    Returns:
+        str: name of the saved mask file
+    """
+    mask_filename = '{}_mask.npy'.format(os.path.splitext(dem_filename)[0])
+    mask = insar.geojson.rasterize(geojson_obj, sario.load_dem_rsc(dem_filename))
+    logger.info("Saving mask of polygon (%s of %s pixels inside) to %s", np.count_nonzero(mask),
+                mask.size, mask_filename)
+    np.save(mask_filename, mask)
+    return mask_filename
+
+
+def main(geojson,
+         data_source,
+         rate,
+         output_name,
+         max_workers=4,
+         use_cache=True,
+         superset_ok=False,
+         keep_compressed=False,
+         engine=None):
     """Function for entry point to create a DEM with `insar dem`
 
+    Only the SRTM tiles which touch the geojson polygon are downloaded; the
+    rest of the bounding box is filled with zeros. A mask of the pixels
+    inside the polygon is saved as <output_name without .dem>_mask.npy
+
+    Finished DEMs are saved in a ProductCache, so running again with the
+    same bounds, rate, and data source links the saved DEM to output_name
+
     Args:
         geojson (str, open file): either name of geojson file or pre-opened file
         data_source (str): 'NASA' or 'AWS', where to download .hgt tiles from
         rate (int): rate to upsample DEM (positive int)
         output_name (str): name of file to save final DEM (usually elevation.dem)
+        max_workers (int): number of tiles to download at once
+        use_cache (bool): look for (and save) the finished DEM in the product cache
+        superset_ok (bool): if no exact match is cached, crop a cached DEM
+            which covers the bounds (with same rate and data source)
+        keep_compressed (bool): store downloaded tiles compressed (see Downloader)
+        engine (DownloadEngine): runs the tile downloads (see Downloader)
     """
     geojson_file = geojson if isinstance(geojson, io.IOBase) else open(geojson, 'r')
     geojson_obj = json.load(geojson_file)
@@ -810,26 +1238,42 @@ def main(geojson, data_source, rate, output_name):
     logger.info("Bounds: %s", " ".join(str(b) for b in bounds))
 
     tile_names = list(insar.dem.Tile(*bounds).srtm1_tile_names())
-    d = insar.dem.Downloader(tile_names, data_source=data_source)
-    d.download_all()
-
-    s = insar.dem.Stitcher(tile_names)
-    stitched_dem = s.load_and_stitch()
-
-    # Now create corresponding rsc file
+    needed_tiles = [
+        t for t in tile_names
+        if insar.geojson.intersects_box(geojson_obj, Tile.srtm1_tile_bounds(t))
+    ]
+    if len(needed_tiles) < len(tile_names):
+        logger.info("Polygon only touches %s of %s tiles in bounding box", len(needed_tiles),
+                    len(tile_names))
+    # Only the parts of each tile within the bounds are loaded
+    s = insar.dem.Stitcher(tile_names, bounds=bounds, needed_tiles=needed_tiles)
+    # Now create corresponding rsc file, with new top-left corner and shape after cropping
     rsc_dict = s.create_dem_rsc()
 
-    # Cropping: get very close to the bounds asked for:
-    logger.info("Cropping stitched DEM to boundaries")
-    stitched_dem, new_starts, new_sizes = insar.dem.crop_stitched_dem(bounds, stitched_dem,
-                                                                      rsc_dict)
-    new_x_first, new_y_first = new_starts
-    new_rows, new_cols = new_sizes
-    # Now adjust the .dem.rsc data to reflect new top-left corner and new shape
-    rsc_dict['X_FIRST'] = new_x_first
-    rsc_dict['Y_FIRST'] = new_y_first
-    rsc_dict['FILE_LENGTH'] = new_rows
-    rsc_dict['WIDTH'] = new_cols
+    products = cache.ProductCache()
+    key = products.make_key(needed_tiles, bounds, rate, data_source)
+    if use_cache:
+        found = products.fetch(key, output_name)
+        if not found and superset_ok:
+            found = products.fetch_superset(
+                rsc_dict, rate, data_source, output_name, tile_names=needed_tiles)
+        if found:
+            save_polygon_mask(geojson_obj, output_name)
+            return
+
+    # Cached products are hardlinked read-only: replace, don't overwrite
+    for filename in (output_name, output_name + '.rsc'):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    d = insar.dem.Downloader(
+        needed_tiles,
+        data_source=data_source,
+        max_workers=max_workers,
+        keep_compressed=keep_compressed,
+        engine=engine)
+    d.download_all()
+    stitched_dem = s.load_and_stitch()
 
     # Upsampling:
     rsc_filename = output_name + '.rsc'
@@ -840,38 +1284,26 @@ def main(geojson, data_source, rate, output_name):
         logger.info("Writing .dem.rsc file to %s", rsc_filename)
         with open(rsc_filename, "w") as f:
             f.write(sario.format_dem_rsc(rsc_dict))
-        sys.exit(0)
-
-    logger.info("Upsampling by {}".format(rate))
-    dem_filename_small = output_name.replace(".dem", "_small.dem")
-    rsc_filename_small = rsc_filename.replace(".dem.rsc", "_small.dem.rsc")
-
-    logger.info("Writing non-upsampled dem temporarily to %s", dem_filename_small)
-    stitched_dem.tofile(dem_filename_small)
-    logger.info("Writing non-upsampled dem.rsc temporarily to %s", rsc_filename_small)
-    with open(rsc_filename_small, "w") as f:
-        f.write(sario.format_dem_rsc(rsc_dict))
-
-    # Now upsample this block
-    nrows, ncols = stitched_dem.shape
-    upsample_path = 'bin/upsample' if os.path.exists('bin/upsample') else 'upsample'
-    upsample_cmd = [
-        utils.which(upsample_path), dem_filename_small,
-        str(rate),
-        str(ncols),
-        str(nrows), output_name
-    ]
-    logger.info("Upsampling using %s:", upsample_cmd[0])
-    logger.info(' '.join(upsample_cmd))
-    subprocess.check_call(upsample_cmd)
-
-    # Redo a new .rsc file for it
-    logger.info("Writing new upsampled dem to %s", rsc_filename)
-    with open(rsc_filename, "w") as f:
-        upsampled_rsc = insar.dem.upsample_dem_rsc(rate=rate, rsc_dict=rsc_dict)
-        f.write(upsampled_rsc)
-
-    # Clean up the _small versions of dem and dem.rsc
-    logger.info("Cleaning up %s and %s", dem_filename_small, rsc_filename_small)
-    os.remove(dem_filename_small)
-    os.remove(rsc_filename_small)
+    else:
+        logger.info("Upsampling by {}".format(rate))
+        logger.info("Writing upsampled DEM to %s", output_name)
+        upsampled = upsample_dem(stitched_dem, rate, outfile=output_name)
+        upsampled.flush()
+        del upsampled
+
+        # Redo a new .rsc file for it
+        logger.info("Writing new upsampled dem to %s", rsc_filename)
+        with open(rsc_filename, "w") as f:
+            upsampled_rsc = insar.dem.upsample_dem_rsc(rate=rate, rsc_dict=rsc_dict)
+            f.write(upsampled_rsc)
+
+    save_polygon_mask(geojson_obj, output_name)
+    if use_cache:
+        meta = {
+            'tile_names': needed_tiles,
+            'bounds': list(bounds),
+            'rate': rate,
+            'data_source': data_source,
+            'stitched_rsc': rsc_dict,
+        }
+        products.save(key, output_name, meta)
@@ -0,0 +1,236 @@
+"""Helpers for HTTP downloads shared by the DEM tile and orbit file downloaders
+
+Downloads are streamed in chunks to a partial file next to the final
+destination (.<name>.part), and only renamed into place once complete
+and checked against any expected size and checksum, so a killed run
+never leaves a truncated file behind that looks finished.
+Connection errors, timeouts, and server errors are retried with
+exponential backoff, and a retry (or a later run) resumes a partial
+file with an HTTP Range request where the server supports it.
+The partial file is locked while in use (see lock_partial), so other
+processes downloading the same file wait, then find it finished.
+"""
+import os
+import time
+import hashlib
+from contextlib import closing
+import requests
+from requests.adapters import HTTPAdapter
+
+from insar.cache import file_lock
+from insar.log import get_log
+
+logger = get_log()
+
+CHUNK_SIZE = 1024 * 1024  # bytes
+TIMEOUT = 60  # seconds to wait for a connection or for data
+# Status codes worth retrying: throttling or temporary server trouble
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def make_session(pool_size=10):
+    """Creates a requests Session that can keep pool_size connections open per host
+
+    One Session should be shared across threads/downloads to the same host
+    so connections are reused instead of reopened for every file.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class ValidationError(requests.RequestException):
+    """A finished download doesn't match its expected size or checksum"""
+
+
+def is_retryable(error):
+    """Checks if an exception from a request is likely temporary
+
+    Examples:
+        >>> is_retryable(requests.ConnectionError())
+        True
+        >>> response = requests.Response()
+        >>> response.status_code = 404
+        >>> is_retryable(requests.HTTPError(response=response))
+        False
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ValidationError)):
+        return True
+    elif isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRY_STATUS_CODES
+    return False
+
+
+def retry(func, retries=3, backoff=1.0):
+    """Calls func(), retrying temporary HTTP failures with exponential backoff
+
+    Args:
+        func (callable): function with no arguments to run
+        retries (int): number of retries after the first attempt
+        backoff (float): seconds to wait before first retry, doubled after each
+
+    Returns:
+        the output of func()
+
+    Raises:
+        the last exception, if all attempts fail or the error is not retryable
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except requests.RequestException as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            wait = backoff * 2**attempt
+            logger.warning("Request failed (%s), retrying in %.1f seconds", e, wait)
+            time.sleep(wait)
+
+
+def partial_path(filename):
+    """Path of the partial file used while downloading filename
+
+    Examples:
+        >>> print(partial_path('/data/N19W156.hgt.zip'))
+        /data/.N19W156.hgt.zip.part
+    """
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, '.' + basename + '.part')
+
+
+def lock_partial(filename):
+    """Locks the partial file of filename against other processes/threads
+
+    Hold this around the whole download (requests and save_response): two
+    downloads appending to the same partial file would interleave their bytes.
+
+    Yields:
+        bool: True if another download held the lock, and was waited for.
+            Check if filename exists before downloading it again.
+    """
+    return file_lock(partial_path(filename) + '.lock')
+
+
+def range_headers(filename):
+    """Request headers to resume a partial download of filename (empty if none exists)"""
+    part = partial_path(filename)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    return {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+
+def sha1_of(filename, chunk_size=CHUNK_SIZE):
+    """hashlib sha1 object of a file's contents, read in chunks (call .hexdigest() for a str)"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1
+
+
+def save_response(response, filename, chunk_size=CHUNK_SIZE, size=None, sha1=None):
+    """Streams the body of a response into filename
+
+    Data is written to partial_path(filename), then renamed to filename
+    once the full body has arrived and matches size and sha1 (if passed).
+    A 206 (partial content) response is appended to the existing partial
+    file, so requests made with range_headers resume where the last one stopped.
+    If the transfer breaks, the partial file is kept to resume later.
+    Call this holding lock_partial(filename).
+
+    Args:
+        response (requests.Response): response from a request made with stream=True
+        filename (str): final path of the file
+        chunk_size (int): number of bytes to read and write at a time
+        size (int): expected number of bytes of the whole file
+        sha1 (str): expected sha1 hex digest of the whole file
+
+    Returns:
+        int: number of bytes in the file
+
+    Raises:
+        ValidationError: if the finished file has the wrong size or checksum,
+            or the partial file can't be resumed (the partial file is
+            removed so the next attempt starts over)
+    """
+    part = partial_path(filename)
+    if response.status_code == 416 and os.path.exists(part):
+        # Range not satisfiable: the partial file is bad, so start over
+        os.remove(part)
+        raise ValidationError("Could not resume {}".format(filename))
+    response.raise_for_status()
+    if response.status_code == 206 and os.path.exists(part):
+        logger.info("Resuming %s from byte %s", filename, os.path.getsize(part))
+        mode, num_bytes = 'ab', os.path.getsize(part)
+        hasher = sha1_of(part) if sha1 else None
+    else:
+        mode, num_bytes = 'wb', 0
+        hasher = hashlib.sha1() if sha1 else None
+
+    with open(part, mode) as f:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+            num_bytes += len(chunk)
+
+    error = None
+    if size is not None and num_bytes != int(size):
+        error = "{} has {} bytes, expected {}".format(filename, num_bytes, size)
+    elif sha1 and hasher.hexdigest() != sha1.lower():
+        error = "{} has sha1 {}, expected {}".format(filename, hasher.hexdigest(), sha1)
+    if error:
+        os.remove(part)
+        raise ValidationError(error)
+
+    os.chmod(part, 0o644)
+    os.rename(part, filename)
+    return num_bytes
+
+
+def download_file(url,
+                  filename,
+                  session=None,
+                  retries=3,
+                  backoff=1.0,
+                  size=None,
+                  sha1=None,
+                  resume=True,
+                  **request_kwargs):
+    """Downloads url to filename, streaming with retries and an atomic rename
+
+    Args:
+        url (str): address of the file
+        filename (str): path to save the file to
+        session (requests.Session): session to use (default: new make_session())
+        retries (int): number of retries for temporary failures
+        backoff (float): seconds to wait before first retry, doubled after each
+        size (int): expected number of bytes, checked before the rename
+        sha1 (str): expected sha1 hex digest, checked before the rename
+        resume (bool): continue a partial file left by an earlier attempt
+        request_kwargs: extra arguments for session.get (e.g. auth)
+
+    Returns:
+        int: number of bytes in the file
+
+    If another process is already downloading filename, waits for it to
+    finish, and doesn't download it again if it succeeded.
+    """
+    session = session or make_session()
+    request_kwargs.setdefault('timeout', TIMEOUT)
+    base_headers = request_kwargs.pop('headers', {})
+
+    def _download():
+        headers = dict(base_headers)
+        if resume:
+            headers.update(range_headers(filename))
+        elif os.path.exists(partial_path(filename)):
+            os.remove(partial_path(filename))
+        with closing(session.get(url, stream=True, headers=headers, **request_kwargs)) as response:
+            return save_response(response, filename, size=size, sha1=sha1)
+
+    with lock_partial(filename) as waited:
+        if waited and os.path.exists(filename):
+            logger.info("%s was downloaded by another process", filename)
+            return os.path.getsize(filename)
+        return retry(_download, retries=retries, backoff=backoff)
@@ -0,0 +1,231 @@
+"""Download engine: runs many blocking downloads from one asyncio event loop
+
+The DEM tile and orbit file downloaders both submit their work here as
+(url, function) jobs. Each function does one blocking download (see
+insar.download) in a worker thread, while the event loop enforces:
+
+    - max_workers: total downloads running at once
+    - per_host: downloads running at once to the same host
+    - rate_limit: new requests started per second to the same host
+
+One engine (and its requests Session, so its open connections) is
+shared between the DEM and orbit downloads, keeping the limits global:
+get_default_engine() gives the one they use unless passed another.
+Its event loop, worker threads and per-host limits last between runs.
+
+Requires Python 3.5+ (async/await): callers fall back to downloading
+one at a time if this module can't be imported.
+"""
+import asyncio
+import threading
+import time
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from insar import download
+from insar.log import get_log
+
+logger = get_log()
+
+MAX_WORKERS = 20
+PER_HOST = 8
+# New requests per second to any one host
+RATE_LIMIT = 10
+
+
+def log_progress(num_done, num_jobs, url):
+    """Default progress report: logs each finished job"""
+    logger.info("Finished %s (%s/%s)", url, num_done, num_jobs)
+
+
+class DownloadEngine(object):
+    """Runs download jobs concurrently, with per-host limits and rate limiting
+
+    The engine keeps one event loop (in a background thread), one pool
+    of worker threads, and one semaphore per host for its whole life, so
+    the limits hold across all run() calls, including calls made at the
+    same time from different threads.
+
+    Attributes:
+        max_workers (int): most jobs running at once in total
+        per_host (int): most jobs running at once for any one host
+        rate_limit (float): most new jobs started per second for any one host
+            (None for no limit)
+        progress (callable): called as progress(num_done, num_jobs, url)
+            after each job finishes (default: log_progress)
+        session (requests.Session): session for jobs to share, so
+            connections to each host are reused between jobs
+
+    Example:
+        >>> engine = DownloadEngine(max_workers=2)
+        >>> engine.run([('http://a.com/1', lambda: 1), ('http://b.com/2', lambda: 2)])
+        [1, 2]
+        >>> engine.close()
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, per_host=PER_HOST, rate_limit=RATE_LIMIT,
+                 progress=log_progress):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.rate_limit = rate_limit
+        self.progress = progress
+        self.session = download.make_session(pool_size=per_host)
+        # Earliest time the next request to each host may start
+        self._next_start = {}
+        self._rate_lock = threading.Lock()
+        # Started on the first run(): only used from the loop's thread
+        self._loop = None
+        self._thread = None
+        self._executor = None
+        self._host_limits = {}
+        # Task lists of the run() calls in progress, for cancel()
+        self._runs = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """Starts the event loop thread and worker pool, if not running yet"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name='DownloadEngine', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def _reserve_start(self, host):
+        """Seconds to wait before starting a request to host to keep under rate_limit"""
+        if not self.rate_limit:
+            return 0
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + 1.0 / self.rate_limit
+            return start - now
+
+    async def _run_job(self, url, func, limit, counts):
+        host = urlparse(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        async with limit, self._host_limits[host]:
+            await asyncio.sleep(self._reserve_start(host))
+            job = self._executor.submit(func)
+            try:
+                result = await asyncio.wrap_future(job, loop=self._loop)
+            except asyncio.CancelledError:
+                # Cancels the job if it's still queued. If it's running, let it
+                # finish, so run() never returns with downloads still going
+                finished = asyncio.wrap_future(job, loop=self._loop)
+                while not finished.done():
+                    try:
+                        await asyncio.wait([finished])
+                    except asyncio.CancelledError:
+                        pass  # Cancelled again (e.g. by cancel() and a failed job)
+                raise
+        counts['done'] += 1
+        if self.progress:
+            self.progress(counts['done'], counts['total'], url)
+        return result
+
+    async def _run_all(self, jobs, tasks, limit):
+        # One limit for this call's jobs, within the engine-wide ones
+        limit = asyncio.Semaphore(limit or len(jobs))
+        counts = {'done': 0, 'total': len(jobs)}
+        tasks.extend(
+            asyncio.ensure_future(self._run_job(url, func, limit, counts)) for url, func in jobs)
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # One failure (or a cancel) stops the jobs which haven't started
+            self._cancel_tasks(tasks)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    @staticmethod
+    def _cancel_tasks(tasks):
+        for task in tasks:
+            task.cancel()
+
+    def run(self, jobs, limit=None):
+        """Runs all jobs, returning once they finish
+
+        Safe to call from several threads at once: the jobs of all calls
+        share the engine's limits.
+
+        Args:
+            jobs (iterable[tuple[str, callable]]): (url, func) pairs, where
+                func() does the blocking download of url. The url's host
+                decides which per-host limit applies
+            limit (int): optional, most of these jobs running at once
+                (on top of max_workers and per_host)
+
+        Returns:
+            list: the return values of each func, in the order of jobs
+
+        Raises:
+            The first exception from a job (the rest are cancelled), or
+            asyncio.CancelledError if cancel() was called
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        loop = self._start()
+        tasks = []
+        with self._lock:
+            self._runs.append(tasks)
+        future = asyncio.run_coroutine_threadsafe(self._run_all(jobs, tasks, limit), loop)
+        try:
+            return future.result()
+        except futures.CancelledError:
+            raise asyncio.CancelledError()
+        except KeyboardInterrupt:
+            # Let running downloads stop on their own: they leave resumable partial files
+            loop.call_soon_threadsafe(self._cancel_tasks, tasks)
+            futures.wait([future])
+            raise
+        finally:
+            with self._lock:
+                self._runs.remove(tasks)
+
+    def cancel(self):
+        """Stops jobs which haven't started yet, and makes run() raise CancelledError
+
+        Applies to every run() in progress. Jobs already downloading finish
+        first. Safe to call from any thread.
+        """
+        with self._lock:
+            loop, runs = self._loop, list(self._runs)
+        if loop is not None:
+            for tasks in runs:
+                loop.call_soon_threadsafe(self._cancel_tasks, tasks)
+
+    def close(self):
+        """Stops the event loop thread and worker pool (a later run() starts new ones)"""
+        with self._lock:
+            loop, thread, executor = self._loop, self._thread, self._executor
+            self._loop = self._thread = self._executor = None
+            self._host_limits = {}
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        executor.shutdown(wait=True)
+
+
+_default_engine = None
+_default_lock = threading.Lock()
+
+
+def get_default_engine():
+    """The engine shared by all downloads of this process (made on first use)
+
+    The DEM and orbit downloaders use it unless passed another engine, so
+    MAX_WORKERS, PER_HOST and RATE_LIMIT limit all of their downloads together.
+    """
+    global _default_engine
+    with _default_lock:
+        if _default_engine is None:
+            _default_engine = DownloadEngine()
+        return _default_engine
@@ -24,20 +24,24 @@ API documentation: https://qc.sentinel1.eo.esa.int/doc/api/
 See insar.parsers for Sentinel file naming description
 """
 try:
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-    CONCURRENT = True
-    MAX_WORKERS = 20
-except ImportError:  # Python 2 doesn't have this :(
-    CONCURRENT = False
+    from insar.engine import get_default_engine
+except (ImportError, SyntaxError):  # Needs python 3.5+
+    get_default_engine = None
 
 import os
+import re
 import sys
+import bisect
 import itertools
+import json
+import functools
+import threading
 import requests
 
 from datetime import timedelta
 from dateutil.parser import parse
 import insar.sario
+from insar import cache, download
 from insar.log import get_log, log_runtime
 from insar.parsers import Sentinel
 
@@ -45,9 +49,18 @@ logger = get_log()
 
 BASE_URL = "https://qc.sentinel1.eo.esa.int/api/v1/?product_type=AUX_POEORB&validity_start__lt={start_date}&validity_stop__gt={stop_date}"
 DATE_FMT = "%Y-%m-%d"  # Used in sentinel API url
-
-
-def download_eofs(orbit_dts, missions=None, save_dir="."):
+# Mission, validity start and validity stop from an orbit file name
+EOF_REGEX = re.compile(r'^(S1[AB])_OPER_AUX_\w+_OPOD_\d{8}T\d{6}_'
+                       r'V(\d{8}T\d{6})_(\d{8}T\d{6})\.EOF$')
+ORBIT_STORE_ENV = 'INSAR_ORBIT_STORE'
+MAX_WORKERS = 20  # Orbit files to download at once
+# Retries for each orbit file download, and seconds to wait before the first
+RETRIES = 3
+BACKOFF = 1.0
+
+
+def download_eofs(orbit_dts, missions=None, save_dir=".", batch=True, orbit_store=None,
+                  engine=None):
     """Downloads and saves EOF files for specific dates
 
     Args:
@@ -55,6 +68,14 @@ def download_eofs(orbit_dts, missions=None, save_dir="."):
         missions (list[str]): optional, to specify S1A or S1B
             No input downloads both, must be same len as orbit_dts
         save_dir (str): directory to save the EOF files into
+        batch (bool): search for the orbits of all dates with one query
+            over the whole date span, then match dates locally (see OrbitIndex).
+            If False, searches separately for each date
+        orbit_store (OrbitStore): optional, shared store of orbit files.
+            Dates with a stored orbit are linked into save_dir without any
+            network access; the rest are downloaded into the store, then linked
+        engine (DownloadEngine): optional, runs the downloads (default: the
+            engine.get_default_engine() shared with the DEM tile downloads)
 
     Returns:
         None
@@ -67,21 +88,33 @@ def download_eofs(orbit_dts, missions=None, save_dir="."):
         raise ValueError('missions argument must be "S1A" or "S1B"')
     if missions and len(missions) != len(orbit_dts):
         raise ValueError("missions arg must be same length as orbit_dts")
+    orbit_dts = [parse(dt) if isinstance(dt, str) else dt for dt in orbit_dts]
+    if orbit_store is not None:
+        missing_dts, missing_missions = orbit_store.link_all(orbit_dts, missions, save_dir)
+        if not missing_dts:
+            return
+        logger.info("%s dates not in orbit store %s, downloading", len(missing_dts),
+                    orbit_store.store_dir)
+        download_eofs(missing_dts, missing_missions if missions else None,
+                      orbit_store.store_dir, batch, engine=engine)
+        orbit_store.scan()
+        orbit_store.link_all(missing_dts, missing_missions, save_dir)
+        return
+
     if not missions:
         missions = itertools.repeat(None)
-
-    if CONCURRENT:
-        # Download and save all links in parallel
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Make a dict to refer back to which date is finished downloading
-            future_to_date = {
-                executor.submit(_download_and_write, mission, dt, save_dir): dt
-                for mission, dt in zip(missions, orbit_dts)
-            }
-            for future in as_completed(future_to_date):
-                future.result()
-                dt = future_to_date[future]
-                logger.info('Finished {}'.format(dt.date()))
+    if engine is None and get_default_engine is not None:
+        engine = get_default_engine()
+
+    if batch:
+        index = OrbitIndex(query_orbits(min(orbit_dts), max(orbit_dts))) if orbit_dts else None
+        links = find_eof_links(orbit_dts, missions, index=index)
+        _download_links(links, save_dir, index=index, engine=engine)
+    elif engine is not None:
+        # Search and download each date in parallel
+        engine.run([(_search_url(dt), functools.partial(_download_and_write, mission, dt, save_dir))
+                    for mission, dt in zip(missions, orbit_dts)],
+                   limit=MAX_WORKERS)
     else:
         # Fall back for python 2:
         for mission, dt in zip(missions, orbit_dts):
@@ -89,6 +122,14 @@ def download_eofs(orbit_dts, missions=None, save_dir="."):
             logger.info('Finished {}'.format(dt.date()))
 
 
+def _search_url(start_date):
+    """API url listing the orbits covering the whole day of start_date"""
+    return BASE_URL.format(
+        start_date=start_date.strftime(DATE_FMT),
+        stop_date=(start_date + timedelta(days=1)).strftime(DATE_FMT),
+    )
+
+
 def eof_list(start_date):
     """Download the list of .EOF files for a specific date
 
@@ -105,10 +146,7 @@ def eof_list(start_date):
     if isinstance(start_date, str):
         start_date = parse(start_date)
 
-    url = BASE_URL.format(
-        start_date=start_date.strftime(DATE_FMT),
-        stop_date=(start_date + timedelta(days=1)).strftime(DATE_FMT),
-    )
+    url = _search_url(start_date)
     logger.info("Searching for EOFs at {}".format(url))
     response = requests.get(url)
     response.raise_for_status()
@@ -120,6 +158,279 @@ def eof_list(start_date):
     return [result['remote_url'] for result in response.json()['results']]
 
 
+def query_orbits(start_date, stop_date, session=None):
+    """Searches for all EOF files valid at any time between two dates
+
+    Follows the 'next' links of the API to get every page of results
+
+    Args:
+        start_date (datetime): first date of the span (only the day is used)
+        stop_date (datetime): last date of the span (only the day is used)
+        session (requests.Session): optional, session to reuse
+
+    Returns:
+        list[dict]: results from the API, with 'remote_url', 'validity_start',
+            and 'validity_stop' keys (among others)
+    """
+    session = session or download.make_session()
+    # Orbits overlapping [start day, day after stop day]
+    url = BASE_URL.format(
+        start_date=(stop_date + timedelta(days=1)).strftime(DATE_FMT),
+        stop_date=start_date.strftime(DATE_FMT),
+    )
+    results = []
+    while url:
+        logger.info("Searching for EOFs at {}".format(url))
+        response = download.retry(lambda: _get_page(session, url))
+        page = response.json()
+        results.extend(page['results'])
+        url = page.get('next')
+    return results
+
+
+def _get_page(session, url):
+    response = session.get(url, timeout=download.TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+class OrbitIndex(object):
+    """Interval index of orbit validity windows, to match dates to EOFs locally
+
+    Args:
+        results (list[dict]): API results, as returned by query_orbits
+
+    Example:
+        >>> url = 'S1A_OPER_AUX_POEORB_OPOD_20180522T120730_V20180501T225942_20180503T005942.EOF'
+        >>> results = [{'remote_url': url, 'validity_start': '2018-05-01T22:59:42',
+        ...             'validity_stop': '2018-05-03T00:59:42'}]
+        >>> index = OrbitIndex(results)
+        >>> index.find(parse('2018-05-02T04:30:26'), 'S1A') == url
+        True
+        >>> print(index.find(parse('2018-05-02T04:30:26'), 'S1B'))
+        None
+    """
+
+    def __init__(self, results):
+        orbits = []
+        for result in results:
+            url = result['remote_url']
+            orbits.append((parse(result['validity_start']), parse(result['validity_stop']),
+                           url.split('/')[-1][:3], url))
+        # Full results, to look up expected 'size' and 'hash' of each url
+        self.results = {result['remote_url']: result for result in results}
+        self.orbits = sorted(set(orbits))
+        self.starts = [orbit[0] for orbit in self.orbits]
+        # Longest validity window bounds how far back a covering orbit can start
+        self.max_duration = max([stop - start for start, stop, _, _ in orbits] or [timedelta(0)])
+
+    def __len__(self):
+        return len(self.orbits)
+
+    def covering(self, dt, mission=None):
+        """All orbits (start, stop, mission, url) with validity windows containing dt"""
+        last = bisect.bisect_right(self.starts, dt)
+        first = bisect.bisect_left(self.starts, dt - self.max_duration)
+        return [
+            orbit for orbit in self.orbits[first:last]
+            if orbit[1] > dt and (mission is None or orbit[2] == mission)
+        ]
+
+    def find(self, dt, mission):
+        """Url of the orbit for mission valid at dt, or None if there is none
+
+        If windows overlap, the orbit with dt furthest from its ends is used
+        """
+        matches = self.covering(dt, mission)
+        if not matches:
+            return None
+        best = max(matches, key=lambda orbit: min(dt - orbit[0], orbit[1] - dt))
+        return best[3]
+
+
+class OrbitStore(object):
+    """Directory of orbit files shared across projects, with an index of validity windows
+
+    The index is a json file in the store mapping each file name to
+    {'mission': str, 'validity_start': str, 'validity_stop': str, 'size': int},
+    so lookups need neither the network nor a listing of the directory.
+
+    Attributes:
+        store_dir (str): directory holding the orbit files
+            (default: INSAR_ORBIT_STORE env var, or orbits/ in the cache directory)
+    """
+    INDEX_NAME = 'orbits.json'
+
+    def __init__(self, store_dir=None):
+        store_dir = store_dir or os.getenv(ORBIT_STORE_ENV)
+        self.store_dir = store_dir or os.path.join(cache.get_cache_dir(), 'orbits')
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        self.index_path = os.path.join(self.store_dir, self.INDEX_NAME)
+        self._lock = threading.Lock()
+        self._orbit_index = None
+
+    def path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def load_index(self):
+        """Reads the index file into a dict of {file name: entry}"""
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _make_entry(filename):
+        """Index entry for an orbit file, or None if the name isn't an EOF name"""
+        match = EOF_REGEX.match(os.path.basename(filename))
+        if not match:
+            return None
+        mission, start, stop = match.groups()
+        return {
+            'mission': mission,
+            'validity_start': parse(start).isoformat(),
+            'validity_stop': parse(stop).isoformat(),
+            'size': os.path.getsize(filename),
+        }
+
+    def scan(self):
+        """Adds orbit files in the store directory missing from the index
+
+        Also drops index entries whose files were deleted
+
+        Returns:
+            list[str]: names of the newly indexed files
+        """
+        with self._lock:
+            index = self.load_index()
+            names = set(os.listdir(self.store_dir))
+            added = []
+            for name in sorted(names - set(index)):
+                entry = self._make_entry(self.path(name))
+                if entry is not None:
+                    index[name] = entry
+                    added.append(name)
+            for name in set(index) - names:
+                index.pop(name)
+            cache.save_json(self.index_path, index)
+            self._orbit_index = None
+        return added
+
+    def orbit_index(self):
+        """OrbitIndex of the stored files, for interval lookups by date"""
+        if self._orbit_index is None:
+            results = [
+                dict(entry, remote_url=self.path(name))
+                for name, entry in self.load_index().items()
+            ]
+            self._orbit_index = OrbitIndex(results)
+        return self._orbit_index
+
+    def find(self, dt, mission):
+        """Path to the stored orbit for mission valid at dt, or None"""
+        path = self.orbit_index().find(dt, mission)
+        return path if path and os.path.exists(path) else None
+
+    def link_all(self, orbit_dts, missions, save_dir="."):
+        """Symlinks the stored orbit of each date into save_dir
+
+        Args:
+            orbit_dts (list[datetime]): dates of Sentinel products
+            missions (list[str]): S1A or S1B for each date (None/empty for both)
+            save_dir (str): directory to make the links in
+
+        Returns:
+            tuple[list, list]: dates and missions which had no stored orbit
+        """
+        missing_dts, missing_missions = [], []
+        for mission, dt in zip(missions or itertools.repeat(None), orbit_dts):
+            paths = [self.find(dt, m) for m in ([mission] if mission else ['S1A', 'S1B'])]
+            if not all(paths):
+                missing_dts.append(dt)
+                missing_missions.append(mission)
+            for path in filter(None, paths):
+                _symlink(path, save_dir)
+        return missing_dts, missing_missions
+
+
+def _symlink(path, save_dir):
+    """Links path into save_dir (if not already there)"""
+    link_name = os.path.join(save_dir, os.path.basename(path))
+    if os.path.lexists(link_name):
+        return
+    logger.info("Linking %s from orbit store", os.path.basename(path))
+    os.symlink(os.path.abspath(path), link_name)
+
+
+def find_eof_links(orbit_dts, missions=None, index=None):
+    """Finds the EOF urls for many dates with one (paginated) API query
+
+    Args:
+        orbit_dts (list[datetime]): dates of Sentinel products
+        missions (list[str]): optional, S1A or S1B for each date.
+            If not passed, the orbits of both missions are returned for each date
+        index (OrbitIndex): optional, already queried orbits covering the dates
+
+    Returns:
+        list[str]: urls of the EOF files, without duplicates
+    """
+    if not orbit_dts:
+        return []
+    if index is None:
+        index = OrbitIndex(query_orbits(min(orbit_dts), max(orbit_dts)))
+    logger.info("Found %s EOFs for %s dates", len(index), len(orbit_dts))
+
+    links = []
+    for mission, dt in zip(missions or itertools.repeat(None), orbit_dts):
+        found = [index.find(dt, m) for m in ([mission] if mission else ['S1A', 'S1B'])]
+        found = [link for link in found if link]
+        if not found:
+            logger.warning('No EOF files found for {}'.format(dt.strftime(DATE_FMT)))
+            logger.warning('Skipping {}'.format(dt.strftime(DATE_FMT)))
+        links.extend(link for link in found if link not in links)
+    return links
+
+
+def _download_links(links, save_dir=".", index=None, engine=None):
+    """Downloads all EOF urls in links, in parallel if an engine is passed
+
+    If the OrbitIndex the links came from is passed, each file is checked
+    against the 'size' and 'hash' (sha1) the API listed for it
+    """
+    session = engine.session if engine else download.make_session(pool_size=1)
+
+    def _download(link):
+        result = index.results.get(link, {}) if index else {}
+        _download_link(link, save_dir, session, size=result.get('size'), sha1=result.get('hash'))
+
+    if engine is not None:
+        engine.run([(link, functools.partial(_download, link)) for link in links],
+                   limit=MAX_WORKERS)
+    else:
+        for link in links:
+            _download(link)
+            logger.info('Finished {}'.format(link.split('/')[-1]))
+
+
+def _download_link(link, save_dir=".", session=None, size=None, sha1=None):
+    """Saves one EOF url into save_dir, unless it is already there
+
+    The file is streamed to a partial file, resumed if a partial file was
+    left by an earlier run, then checked against size and sha1 (if known)
+    before being renamed into place. See insar.download
+    """
+    fname = os.path.join(save_dir, link.split('/')[-1])
+    if os.path.isfile(fname):
+        logger.info("%s already exists, skipping download.", link)
+        return
+
+    logger.info("Downloading %s to %s", link, fname)
+    download.download_file(
+        link, fname, session=session, retries=RETRIES, backoff=BACKOFF, size=size, sha1=sha1)
+
+
 def _download_and_write(mission, dt, save_dir="."):
     """Wrapper function to run the link downloading in parallel
 
@@ -143,54 +454,64 @@ def _download_and_write(mission, dt, save_dir="."):
 
     assert len(cur_links) < 2
     for link in cur_links:
-        fname = os.path.join(save_dir, link.split('/')[-1])
-        if os.path.isfile(fname):
-            logger.info("%s already exists, skipping download.", link)
-            return
+        _download_link(link, save_dir)
 
-        logger.info("Downloading %s", link)
-        response = requests.get(link)
-        response.raise_for_status()
-        logger.info("Saving to %s", fname)
-        with open(fname, 'wb') as f:
-            f.write(response.content)
 
+def find_sentinel_products(startpath='./', catalog=None):
+    """Parse the startpath directory for any Sentinel 1 products' date and mission
+
+    If a Catalog (insar.catalog) is passed, it is refreshed and queried
+    instead of listing and parsing the directory
+    """
+    if catalog is not None:
+        catalog.refresh()
+        rows = catalog.products('sentinel', directory=startpath)
+        start_times = [parse(row['date']) for row in rows]
+        products = zip(start_times, [row['mission'] for row in rows])
+    else:
+        filenames = insar.sario.find_files(startpath, "S1*")
+        table = Sentinel.parse_many(filenames)
+        for filename in sorted(set(filenames) - set(table['filename'])):
+            logger.info('Skipping {}'.format(filename))  # Doesn't match a sentinel file
+        products = zip(table['start_time'].tolist(), table['mission'])
 
-def find_sentinel_products(startpath='./'):
-    """Parse the startpath directory for any Sentinel 1 products' date and mission"""
     orbit_dts = []
     missions = []
-    for filename in insar.sario.find_files(startpath, "S1*"):
-        try:
-            parser = Sentinel(filename)
-        except ValueError:  # Doesn't match a sentinel file
-            logger.info('Skipping {}'.format(filename))
-            continue
-
-        if parser.start_time in orbit_dts:  # start_time is a datetime
+    seen = set()
+    for start_time, mission in products:
+        if start_time in seen:  # start_time is a datetime
             continue
+        seen.add(start_time)
         logger.info("Downloading precise orbits for {} on {}".format(
-            parser.mission, parser.start_time.strftime('%Y-%m-%d')))
-        orbit_dts.append(parser.start_time)
-        missions.append(parser.mission)
+            mission, start_time.strftime('%Y-%m-%d')))
+        orbit_dts.append(start_time)
+        missions.append(mission)
 
     return orbit_dts, missions
 
 
 @log_runtime
-def main(path='.', mission=None, date=None):
-    """Function used for entry point to download eofs"""
+def main(path='.', mission=None, date=None, orbit_store=None, catalog=None, engine=None):
+    """Function used for entry point to download eofs
+
+    If orbit_store (a directory) is passed, or INSAR_ORBIT_STORE is set, orbits
+    are looked up there first, and new downloads are saved there, then linked
+    to the current directory.
+    If catalog (an insar.catalog.Catalog) is passed, products are found through it.
+    engine (a DownloadEngine) runs the downloads (default: the shared engine)
+    """
     if (mission and not date):
         logger.error("Must specify date if specifying mission.")
         sys.exit(1)
     if not date:
         # No command line args given: search current directory
-        orbit_dts, missions = find_sentinel_products(path)
+        orbit_dts, missions = find_sentinel_products(path, catalog=catalog)
         if not orbit_dts:
             logger.info("No Sentinel products found in directory %s, exiting", path)
             sys.exit(0)
     if date:
         orbit_dts = [date]
-        missions = list(mission) if mission else []
+        missions = [mission] if mission else []
 
-    download_eofs(orbit_dts, missions=missions)
+    store = OrbitStore(orbit_store) if orbit_store or os.getenv(ORBIT_STORE_ENV) else None
+    download_eofs(orbit_dts, missions=missions, orbit_store=store, engine=engine)
@@ -3,11 +3,15 @@ Takes in a geojson polygon, outputs bounds to use for dem download
 Used with http://geojson.io to get a quick geojson polygon
 Coordinates are (lon, lat)
 Output: left, bottom, right, top (floats)
+
+Also finds whether the polygon touches a lon/lat box (e.g. an SRTM tile),
+and rasterizes the polygon to a mask on a DEM or igram grid.
 """
 
 import sys
 import itertools
 import json
+import numpy as np
 
 
 def read_json(input_string):
@@ -57,6 +61,140 @@ def parse_coordinates(geojson):
     return geojson['coordinates'][0]
 
 
+def parse_rings(geojson):
+    """Finds all rings of a geojson polygon: the outer boundary, then any holes
+
+    Args:
+        geojson (dict): loaded geojson dict (Polygon, Feature, or FeatureCollection)
+
+    Returns:
+        list[list]: coordinates of each ring of the polygon
+    """
+    if geojson.get('type') == 'FeatureCollection':
+        geojson = geojson['features'][0]['geometry']
+    elif geojson.get('type') == 'Feature':
+        geojson = geojson['geometry']
+    assert geojson['type'] == 'Polygon', 'Must use polygon geojson'
+    return geojson['coordinates']
+
+
+def _edges(geojson):
+    """Array of polygon edges, one row of (x0, y0, x1, y1) per edge, for all rings"""
+    edges = []
+    for ring in parse_rings(geojson):
+        ring = np.asarray(ring, dtype=float)[:, :2]
+        # geojson rings should repeat the first point, but close them regardless
+        edges.append(np.hstack((ring, np.roll(ring, -1, axis=0))))
+    return np.vstack(edges)
+
+
+def contains_point(geojson, lon, lat):
+    """Checks if a point is inside the polygon (even-odd rule, so holes are outside)
+
+    Examples:
+        >>> square = {'type': 'Polygon', 'coordinates': [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]]}
+        >>> contains_point(square, 1, 1), contains_point(square, 3, 1)
+        (True, False)
+    """
+    x0, y0, x1, y1 = _edges(geojson).T
+    crosses = (y0 <= lat) != (y1 <= lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (lat - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.count_nonzero(crosses & (x_cross > lon)) % 2)
+
+
+def intersects_box(geojson, box):
+    """Checks if the polygon overlaps a (left, bottom, right, top) box
+
+    Either some edge of the polygon passes through the box (found by clipping
+    all edges to the box at once), or the box is entirely inside the polygon.
+
+    Examples:
+        >>> triangle = {'type': 'Polygon', 'coordinates': [[[0, 0], [3, 0], [0, 3], [0, 0]]]}
+        >>> intersects_box(triangle, (0.5, 0.5, 1, 1))
+        True
+        >>> intersects_box(triangle, (2, 2, 3, 3))
+        False
+        >>> intersects_box(triangle, (-1, -1, 4, 4))
+        True
+    """
+    left, bottom, right, top = box
+    x0, y0, x1, y1 = _edges(geojson).T
+    dx, dy = x1 - x0, y1 - y0
+    # Liang-Barsky clipping: segment is x0 + t*dx, for t in [0, 1]
+    t_enter, t_exit = np.zeros(len(x0)), np.ones(len(x0))
+    inside = np.ones(len(x0), dtype=bool)
+    for p, q in ((-dx, x0 - left), (dx, right - x0), (-dy, y0 - bottom), (dy, top - y0)):
+        parallel = p == 0
+        inside &= ~(parallel & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = q / p
+        t_enter = np.where(~parallel & (p < 0), np.maximum(t_enter, t), t_enter)
+        t_exit = np.where(~parallel & (p > 0), np.minimum(t_exit, t), t_exit)
+    if np.any(inside & (t_enter <= t_exit)):
+        return True
+    return contains_point(geojson, (left + right) / 2.0, (bottom + top) / 2.0)
+
+
+def rasterize(geojson, rsc_data):
+    """Makes a mask of the pixels inside the polygon on a .rsc grid
+
+    Pixels are points at X_FIRST + col * X_STEP, Y_FIRST + row * Y_STEP.
+    Uses the even-odd rule, so holes in the polygon are outside.
+
+    For every polygon edge, finds each row it crosses and the column where
+    it crosses. Each crossing flips inside/outside for all pixels to its
+    right, so the mask is the parity of the running count of crossings.
+
+    Args:
+        geojson (dict): loaded geojson dict (Polygon, Feature, or FeatureCollection)
+        rsc_data (dict): data from .rsc file (WIDTH, FILE_LENGTH, X/Y_FIRST, X/Y_STEP)
+
+    Returns:
+        ndarray: boolean mask of shape (FILE_LENGTH, WIDTH), True inside the polygon
+
+    Examples:
+        >>> square = {'type': 'Polygon', 'coordinates': [[[1, 1], [3, 1], [3, 3], [1, 3], [1, 1]]]}
+        >>> rsc_data = {'WIDTH': 5, 'FILE_LENGTH': 4, 'X_FIRST': 0.5, 'Y_FIRST': 3.5,
+        ...             'X_STEP': 1.0, 'Y_STEP': -1.0}
+        >>> print(rasterize(square, rsc_data).astype(int))
+        [[0 0 0 0 0]
+         [0 1 1 0 0]
+         [0 1 1 0 0]
+         [0 0 0 0 0]]
+    """
+    nrows, ncols = rsc_data['FILE_LENGTH'], rsc_data['WIDTH']
+    x_first, y_first = rsc_data['X_FIRST'], rsc_data['Y_FIRST']
+    x_step, y_step = rsc_data['X_STEP'], rsc_data['Y_STEP']
+
+    x0, y0, x1, y1 = _edges(geojson).T
+    not_flat = y0 != y1
+    x0, y0, x1, y1 = x0[not_flat], y0[not_flat], x1[not_flat], y1[not_flat]
+    # Each edge covers rows with ymin <= y < ymax (so shared vertices count once)
+    row_a = (np.minimum(y0, y1) - y_first) / y_step
+    row_b = (np.maximum(y0, y1) - y_first) / y_step
+    if y_step < 0:
+        row_start, row_end = np.floor(row_b) + 1, np.floor(row_a) + 1
+    else:
+        row_start, row_end = np.ceil(row_a), np.ceil(row_b)
+    row_start = np.clip(row_start, 0, nrows).astype(int)
+    row_end = np.clip(row_end, 0, nrows).astype(int)
+    counts = np.maximum(row_end - row_start, 0)
+
+    # Expand to one entry per (edge, row) crossing
+    edge_idxs = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = row_start[edge_idxs] + offsets
+    x0, y0, x1, y1 = x0[edge_idxs], y0[edge_idxs], x1[edge_idxs], y1[edge_idxs]
+    x_cross = x0 + (y_first + rows * y_step - y0) * (x1 - x0) / (y1 - y0)
+
+    # Pixels strictly right of the crossing are flipped
+    cols = np.clip(np.floor((x_cross - x_first) / x_step) + 1, 0, ncols).astype(int)
+    flips = np.zeros((nrows, ncols + 1), dtype=np.int32)
+    np.add.at(flips, (rows, cols), 1)
+    return (np.cumsum(flips, axis=1)[:, :ncols] % 2).astype(bool)
+
+
 def bounding_box(geojson):
     """From a geojson object, compute bounding lon/lats
 
@@ -0,0 +1,428 @@
+"""Writes tiled, georeferenced GeoTIFFs of SAR products without external programs
+
+Replaces the `dishgtfile` and `dismphfile` conversions, which always write
+to a fixed dishgt.tif/dismph.tif in the current directory (so could not be
+run in parallel) and needed one subprocess launch per file.
+
+Images are written as tiled (default 256x256), little-endian TIFFs with
+internal overviews (reduced resolution copies, each half the size of the last),
+so that viewers like QGIS or Google Earth only read what they display.
+Files larger than 4 GB are written as BigTIFF.
+
+Georeferencing comes from a dem.rsc file: the GeoTIFF tags give the lat/lon
+of the first pixel (X_FIRST, Y_FIRST) and the pixel spacing (X_STEP, Y_STEP)
+on the WGS84 (EPSG:4326) grid.
+
+.int files are colored with phase as hue and amplitude as brightness (like dismph).
+.unw files are colored by unwrapped phase, cycling through the colors every
+`max_height` (the dishgt "contour interval"), with amplitude as brightness.
+"""
+from __future__ import division
+import os
+import struct
+import zlib
+import multiprocessing as mp
+from contextlib import closing
+import numpy as np
+from matplotlib.colors import hsv_to_rgb
+
+from insar import sario
+from insar.log import get_log
+
+logger = get_log()
+
+TILE_SIZE = 256
+# TIFF header max offset before needing the 64-bit offsets of BigTIFF
+CLASSIC_MAX_BYTES = 2**32 - 2**20
+
+# TIFF field types: (type code, struct format char)
+SHORT = (3, 'H')
+LONG = (4, 'I')
+DOUBLE = (12, 'd')
+LONG8 = (16, 'Q')
+
+# Tag numbers used (must be written to the IFD in sorted order)
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+SAMPLES_PER_PIXEL = 277
+PLANAR_CONFIG = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+GEO_KEY_DIRECTORY = 34735
+
+# SampleFormat codes for numpy dtype kinds
+SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+
+
+def geokeys(rsc_data):
+    """Creates the GeoTIFF georeferencing tags from .rsc data
+
+    Coordinates in the .rsc file refer to pixel centers, so the
+    raster type is set to PixelIsPoint
+
+    Args:
+        rsc_data (dict): output of sario.load_dem_rsc
+
+    Returns:
+        dict: tag number -> (field type, list of values)
+
+    Example:
+        >>> rsc_data = {'X_FIRST': -156.0, 'Y_FIRST': 20.0, 'X_STEP': 0.5, 'Y_STEP': -0.5}
+        >>> tags = geokeys(rsc_data)
+        >>> tags[MODEL_PIXEL_SCALE][1]
+        [0.5, 0.5, 0.0]
+        >>> tags[MODEL_TIEPOINT][1]
+        [0.0, 0.0, 0.0, -156.0, 20.0, 0.0]
+    """
+    # Header: KeyDirectoryVersion, KeyRevision, MinorRevision, NumberOfKeys
+    # Then each key: KeyID, TIFFTagLocation (0 = value inline), Count, Value
+    key_directory = [
+        1, 1, 0, 3,
+        1024, 0, 1, 2,  # GTModelTypeGeoKey: ModelTypeGeographic
+        1025, 0, 1, 2,  # GTRasterTypeGeoKey: RasterPixelIsPoint
+        2048, 0, 1, 4326,  # GeographicTypeGeoKey: WGS84
+    ]  # yapf: disable
+    return {
+        MODEL_PIXEL_SCALE: (DOUBLE, [rsc_data['X_STEP'], -rsc_data['Y_STEP'], 0.0]),
+        MODEL_TIEPOINT: (DOUBLE, [0.0, 0.0, 0.0, rsc_data['X_FIRST'], rsc_data['Y_FIRST'], 0.0]),
+        GEO_KEY_DIRECTORY: (SHORT, key_directory),
+    }
+
+
+def _downsample2(image):
+    """Averages 2x2 blocks of an image (rows, cols, samples) to make the next overview
+
+    Odd numbers of rows or cols are padded by repeating the edge
+    """
+    rows, cols = image.shape[:2]
+    pad = ((0, rows % 2), (0, cols % 2), (0, 0))
+    image = np.pad(image, pad, mode='edge').astype(np.float32)
+    small = (image[::2, ::2] + image[1::2, ::2] + image[::2, 1::2] + image[1::2, 1::2]) / 4
+    return small
+
+
+class _TiledTiffWriter(object):
+    """Writes tiles of one or more images, then the IFDs describing them
+
+    Tile data is written first, in order, as strips of rows come in.
+    All IFDs (one per image: full resolution then each overview) are
+    written at the end once the tile offsets are known.
+    """
+
+    def __init__(self, filename, bigtiff=False, compress=False, tile_size=TILE_SIZE):
+        self.filename = filename
+        self.bigtiff = bigtiff
+        self.compress = compress
+        self.tile_size = tile_size
+        self.offset_type = LONG8 if bigtiff else LONG
+        self.ifds = []
+        self.f = open(filename, 'wb')
+        # Placeholder header: first IFD offset is filled in during close
+        self.header_size = 16 if bigtiff else 8
+        self.f.write(b'\x00' * self.header_size)
+
+    def write_image(self, strips, shape, dtype, extra_tags=None, is_overview=False):
+        """Writes the tiles for one image from an iterator of row strips
+
+        Args:
+            strips (iterable[ndarray]): each is (tile_size, cols, samples), except
+                possibly the last, which can be shorter
+            shape (tuple[int]): rows, cols, samples of the full image
+            dtype (np.dtype): data type of the image
+            extra_tags (dict): any other tags to add to this image's IFD
+            is_overview (bool): mark the image as reduced resolution
+        """
+        rows, cols, samples = shape
+        dtype = np.dtype(dtype).newbyteorder('<')
+        ts = self.tile_size
+        tiles_across = int(np.ceil(cols / ts))
+        offsets, byte_counts = [], []
+        for strip in strips:
+            strip = np.asarray(strip, dtype=dtype).reshape((-1, cols, samples))
+            padded = np.zeros((ts, tiles_across * ts, samples), dtype=dtype)
+            padded[:strip.shape[0], :cols] = strip
+            # (ts, across, ts, samples) -> (across, ts, ts, samples), one tile per first index
+            tiles = padded.reshape((ts, tiles_across, ts, samples)).transpose(1, 0, 2, 3)
+            for tile in tiles:
+                data = tile.tobytes()
+                if self.compress:
+                    data = zlib.compress(data, 6)
+                offsets.append(self.f.tell())
+                byte_counts.append(len(data))
+                self.f.write(data)
+
+        tags = {
+            NEW_SUBFILE_TYPE: (LONG, [1 if is_overview else 0]),
+            IMAGE_WIDTH: (LONG, [cols]),
+            IMAGE_LENGTH: (LONG, [rows]),
+            BITS_PER_SAMPLE: (SHORT, [8 * dtype.itemsize] * samples),
+            COMPRESSION: (SHORT, [8 if self.compress else 1]),
+            PHOTOMETRIC: (SHORT, [2 if samples == 3 else 1]),
+            SAMPLES_PER_PIXEL: (SHORT, [samples]),
+            PLANAR_CONFIG: (SHORT, [1]),
+            TILE_WIDTH: (LONG, [ts]),
+            TILE_LENGTH: (LONG, [ts]),
+            TILE_OFFSETS: (self.offset_type, offsets),
+            TILE_BYTE_COUNTS: (self.offset_type, byte_counts),
+            SAMPLE_FORMAT: (SHORT, [SAMPLE_FORMATS[dtype.kind]] * samples),
+        }
+        tags.update(extra_tags or {})
+        self.ifds.append(tags)
+
+    def _pack_ifd(self, tags, ifd_offset, next_offset):
+        """Formats one IFD, with any values too big to fit inline placed after it"""
+        if self.bigtiff:
+            count_fmt, entry_fmt, inline_size, next_fmt = '<Q', '<HHQ', 8, '<Q'
+        else:
+            count_fmt, entry_fmt, inline_size, next_fmt = '<H', '<HHI', 4, '<I'
+        ifd_size = (struct.calcsize(count_fmt) + len(tags) *
+                    (struct.calcsize(entry_fmt) + inline_size) + struct.calcsize(next_fmt))
+
+        entries = struct.pack(count_fmt, len(tags))
+        extra = b''
+        for tag in sorted(tags):
+            (type_code, fmt), values = tags[tag]
+            data = struct.pack('<{}{}'.format(len(values), fmt), *values)
+            entries += struct.pack(entry_fmt, tag, type_code, len(values))
+            if len(data) <= inline_size:
+                entries += data.ljust(inline_size, b'\x00')
+            else:
+                value_offset = ifd_offset + ifd_size + len(extra)
+                entries += struct.pack('<Q' if self.bigtiff else '<I', value_offset)
+                extra += data
+                if len(extra) % 2:  # Keep offsets on word boundaries
+                    extra += b'\x00'
+        entries += struct.pack(next_fmt, next_offset)
+        return entries + extra
+
+    def close(self):
+        """Writes all IFDs, linked in order, and points the header at the first"""
+        self.f.seek(0, 2)
+        if self.f.tell() % 2:
+            self.f.write(b'\x00')
+        first_ifd = self.f.tell()
+        ifd_offset = first_ifd
+        for idx, tags in enumerate(self.ifds):
+            # Pack once to find the length, then again with the real next IFD offset
+            ifd_bytes = self._pack_ifd(tags, ifd_offset, 0)
+            is_last = idx == len(self.ifds) - 1
+            next_offset = 0 if is_last else ifd_offset + len(ifd_bytes)
+            self.f.write(self._pack_ifd(tags, ifd_offset, next_offset))
+            ifd_offset += len(ifd_bytes)
+
+        self.f.seek(0)
+        if self.bigtiff:
+            self.f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, first_ifd))
+        else:
+            self.f.write(b'II' + struct.pack('<HI', 42, first_ifd))
+        self.f.close()
+
+
+def write_strips(filename,
+                 strips,
+                 shape,
+                 dtype,
+                 rsc_data=None,
+                 tile_size=TILE_SIZE,
+                 overviews=True,
+                 compress=False):
+    """Streams row strips of an image into a tiled GeoTIFF
+
+    Only the first overview (half size) is held in memory while writing.
+
+    Args:
+        filename (str): name of .tif file to write
+        strips (iterable[ndarray]): blocks of `tile_size` rows of the image,
+            in order, each with shape (rows, cols) or (rows, cols, samples)
+        shape (tuple[int]): (rows, cols) or (rows, cols, samples) of full image
+        dtype (np.dtype): data type of the image
+        rsc_data (dict): output of sario.load_dem_rsc, used to georeference
+        tile_size (int): width and height of each tile (multiple of 16)
+        overviews (bool): add internal overviews, halving the size until
+            the image fits in one tile
+        compress (bool): use deflate (zlib) compression on each tile
+
+    Returns:
+        str: the filename written
+    """
+    rows, cols = shape[:2]
+    samples = shape[2] if len(shape) > 2 else 1
+    dtype = np.dtype(dtype)
+    bigtiff = rows * cols * samples * dtype.itemsize * 4 // 3 > CLASSIC_MAX_BYTES
+
+    overview_strips = []
+
+    def _save_overview_strips(strips):
+        for strip in strips:
+            strip = np.asarray(strip).reshape((-1, cols, samples))
+            if overviews:
+                overview_strips.append(_downsample2(strip))
+            yield strip
+
+    writer = _TiledTiffWriter(filename, bigtiff=bigtiff, compress=compress, tile_size=tile_size)
+    extra_tags = geokeys(rsc_data) if rsc_data and 'X_FIRST' in rsc_data else None
+    writer.write_image(
+        _save_overview_strips(strips), (rows, cols, samples), dtype, extra_tags=extra_tags)
+
+    overview = np.concatenate(overview_strips, axis=0) if overview_strips else None
+    while overview is not None and max(rows, cols) > tile_size:
+        rows, cols = overview.shape[:2]
+        if np.issubdtype(dtype, np.integer):
+            level = np.round(overview).astype(dtype)
+        else:
+            level = overview.astype(dtype)
+        level_strips = (level[r:r + tile_size] for r in range(0, rows, tile_size))
+        writer.write_image(level_strips, level.shape, dtype, is_overview=True)
+        overview = _downsample2(overview)
+
+    writer.close()
+    return filename
+
+
+def save_geotiff(filename, image, rsc_data=None, **kwargs):
+    """Saves a 2D (or 3D RGB, shape (rows, cols, 3)) array as a tiled GeoTIFF
+
+    Array may be a np.memmap: it is read one strip at a time.
+    See write_strips for keyword arguments.
+    """
+    tile_size = kwargs.get('tile_size', TILE_SIZE)
+    strips = (image[r:r + tile_size] for r in range(0, image.shape[0], tile_size))
+    return write_strips(filename, strips, image.shape, image.dtype, rsc_data=rsc_data, **kwargs)
+
+
+def _scale_amplitude(amp, amp_mean, exponent=0.3):
+    """Scales amplitude to (0, 1) brightness with a power law stretch, like dismph"""
+    brightness = np.power(np.abs(amp), exponent)
+    return np.clip(brightness / (2 * amp_mean), 0, 1) if amp_mean > 0 else brightness
+
+
+def _sample_amplitude_mean(amp_rows, exponent=0.3, num_samples=200):
+    """Estimates the mean of the stretched amplitude from evenly spaced rows"""
+    step = max(1, len(amp_rows) // num_samples)
+    sample = np.power(np.abs(amp_rows[::step]), exponent)
+    sample = sample[sample > 0]
+    return float(np.mean(sample)) if sample.size else 0.0
+
+
+def color_phase(phase, brightness, cycle=2 * np.pi):
+    """Makes an RGB image with hue from phase, value from brightness
+
+    Args:
+        phase (ndarray): wrapped or unwrapped phase, or heights
+        brightness (ndarray): same shape as phase, values 0 to 1
+        cycle (float): amount of phase to go through one full color cycle
+
+    Returns:
+        ndarray: uint8 array of shape (rows, cols, 3)
+    """
+    hue = np.mod(phase, cycle) / cycle
+    hsv = np.stack((hue, np.ones_like(hue), brightness), axis=-1)
+    return (255 * hsv_to_rgb(hsv)).astype(np.uint8)
+
+
+def int_to_tif(filename, rsc_data, outname=None, **kwargs):
+    """Converts a .int complex interferogram to a phase-colored GeoTIFF
+
+    Args:
+        filename (str): path to .int file
+        rsc_data (dict): output of sario.load_dem_rsc for the igram
+        outname (str): name of .tif to write. Defaults to replacing the .int extension with .tif
+        kwargs: passed to write_strips
+
+    Returns:
+        str: the name of the .tif file written
+    """
+    rows, cols = rsc_data['FILE_LENGTH'], rsc_data['WIDTH']
+    outname = outname or os.path.splitext(filename)[0] + '.tif'
+    igram = np.memmap(filename, dtype=np.complex64, mode='r', shape=(rows, cols))
+    amp_mean = _sample_amplitude_mean(igram)
+    tile_size = kwargs.get('tile_size', TILE_SIZE)
+
+    def _strips():
+        for r in range(0, rows, tile_size):
+            block = igram[r:r + tile_size]
+            yield color_phase(np.angle(block), _scale_amplitude(block, amp_mean))
+
+    return write_strips(outname, _strips(), (rows, cols, 3), np.uint8, rsc_data=rsc_data, **kwargs)
+
+
+def unw_to_tif(filename, rsc_data, max_height=10, outname=None, **kwargs):
+    """Converts a .unw file (stacked amplitude/unwrapped phase) to a colored GeoTIFF
+
+    Args:
+        filename (str): path to .unw file
+        rsc_data (dict): output of sario.load_dem_rsc for the igram
+        max_height (float): amount of phase for one color cycle (contour interval)
+        outname (str): name of .tif to write. Defaults to filename + '.tif'
+        kwargs: passed to write_strips
+
+    Returns:
+        str: the name of the .tif file written
+    """
+    rows, cols = rsc_data['FILE_LENGTH'], rsc_data['WIDTH']
+    outname = outname or filename + '.tif'
+    data = np.memmap(filename, dtype=sario.FLOAT_32_LE, mode='r', shape=(rows, 2 * cols))
+    amp_mean = _sample_amplitude_mean(data[:, :cols])
+    tile_size = kwargs.get('tile_size', TILE_SIZE)
+
+    def _strips():
+        for r in range(0, rows, tile_size):
+            block = data[r:r + tile_size]
+            amp, height = block[:, :cols], block[:, cols:]
+            yield color_phase(height, _scale_amplitude(amp, amp_mean), cycle=float(max_height))
+
+    return write_strips(outname, _strips(), (rows, cols, 3), np.uint8, rsc_data=rsc_data, **kwargs)
+
+
+# Keywords of unw_to_tif which int_to_tif doesn't take
+UNW_ONLY_KWARGS = ('max_height', )
+
+
+def _convert_one(args):
+    """Wrapper for convert_files multiprocessing: (filename, rsc_data, kwargs)"""
+    filename, rsc_data, kwargs = args
+    ext = sario.get_file_ext(filename)
+    if ext == '.int':
+        # Options only for .unw files don't apply
+        int_kwargs = {k: v for k, v in kwargs.items() if k not in UNW_ONLY_KWARGS}
+        return int_to_tif(filename, rsc_data, **int_kwargs)
+    elif ext == '.unw':
+        return unw_to_tif(filename, rsc_data, **kwargs)
+    else:
+        raise ValueError("Can only convert .int or .unw files to .tif: {}".format(filename))
+
+
+def convert_files(filenames, rsc_data, processes=None, **kwargs):
+    """Converts many .int or .unw files to GeoTIFFs in parallel
+
+    Each file is written to its own .tif, so files can be done concurrently.
+
+    Args:
+        filenames (list[str]): .int or .unw files, all sharing one dem.rsc
+        rsc_data (dict): output of sario.load_dem_rsc for the igrams
+        processes (int): number of worker processes (default: number of CPUs)
+        kwargs: passed to int_to_tif/unw_to_tif (e.g. compress). Options only
+            unw_to_tif takes (max_height) are only passed for .unw files
+
+    Returns:
+        list[str]: names of the .tif files written
+    """
+    jobs = [(f, rsc_data, kwargs) for f in filenames]
+    if processes == 1 or len(jobs) < 2:
+        return [_convert_one(job) for job in jobs]
+
+    with closing(mp.Pool(processes=processes)) as pool:
+        outnames = []
+        for outname in pool.imap(_convert_one, jobs):
+            logger.info("Wrote %s", outname)
+            outnames.append(outname)
+    return outnames
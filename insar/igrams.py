@@ -0,0 +1,263 @@
+"""Forms interferograms and correlation files from pairs of geocoded SLCs
+
+Replaces the ps_sbas_igrams.py script: for each pair in an sbas_list,
+the two .geo files are cross multiplied, multilooked, and saved as
+
+    20180420_20180502.int: complex64 igram, mean of slc1 * conj(slc2) over each look
+    20180420_20180502.cc: float32 rows of amplitude, then rows of correlation
+        (the layout sario.load_stacked and snaphu read). The amplitude is the
+        geometric mean of the two SLCs' multilooked amplitudes, and the
+        correlation = |sum(slc1 * conj(slc2))| / sqrt(sum(|slc1|^2) * sum(|slc2|^2))
+
+along with dem.rsc for the multilooked size and intlist naming every igram.
+
+The .geo files are memory mapped and processed in row strips: each
+strip of each SLC is read (and its power multilooked) once, then shared
+by every pair using that SLC, and the pairs of a strip run in parallel.
+Memory use depends on the strip size, not on the size or number of files.
+"""
+from __future__ import division
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import insar.sario
+from insar.download import partial_path
+from insar.log import get_log, log_runtime
+from insar.parsers import Sentinel
+from insar.utils import take_looks
+
+logger = get_log()
+
+# Memory for the strips of all SLCs read at once: sets the rows per strip
+STRIP_MEMORY = 2**28
+
+
+def read_sbas_list(filename):
+    """Reads the pairs of .geo files from an sbas_list
+
+    Each line starts with two .geo paths (the rest, e.g. the baselines,
+    is ignored). Relative paths are relative to the sbas_list's directory.
+
+    Returns:
+        list[tuple(str, str)]: (master, slave) .geo paths
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    pairs = []
+    with open(filename) as f:
+        for line in f:
+            words = line.split()
+            if len(words) >= 2:
+                pairs.append(tuple(os.path.normpath(os.path.join(dirname, w)) for w in words[:2]))
+    return pairs
+
+
+def igram_name(geo1, geo2):
+    """Name of the igram of two .geo files, without extension
+
+    Examples:
+        >>> igram_name('S1A_IW_SLC__1SDV_20180420T043026_20180420T043054_021546_025211_81BE.geo',
+        ...            'S1B_IW_SLC__1SDV_20180502T043026_20180502T043054_021721_025793_5C18.geo')
+        '20180420_20180502'
+    """
+    dates = [Sentinel(os.path.basename(g)).start_time.strftime('%Y%m%d') for g in (geo1, geo2)]
+    return '_'.join(dates)
+
+
+def looked_rsc(rsc_data, looks, xsize=None, ysize=None):
+    """The .rsc data of igrams made from a (cropped) grid with looks
+
+    X_FIRST and Y_FIRST are kept, as ps_sbas_igrams.py wrote them, so that
+    with looks = the DEM upsampling rate the igrams line up with the original DEM
+
+    Examples:
+        >>> rsc = looked_rsc({'WIDTH': 7, 'FILE_LENGTH': 5, 'X_STEP': 0.5, 'Y_STEP': -0.5}, 2)
+        >>> print(rsc['WIDTH'], rsc['FILE_LENGTH'], rsc['X_STEP'], rsc['Y_STEP'])
+        3 2 1.0 -1.0
+    """
+    out = rsc_data.copy()
+    out['WIDTH'] = (xsize or rsc_data['WIDTH']) // looks
+    out['FILE_LENGTH'] = (ysize or rsc_data['FILE_LENGTH']) // looks
+    out['X_STEP'] = rsc_data['X_STEP'] * looks
+    out['Y_STEP'] = rsc_data['Y_STEP'] * looks
+    return out
+
+
+def is_done(geo1, geo2, intfile, ccfile, shape):
+    """True if the .int and .cc exist, are newer than both .geo files, and have shape
+
+    Args:
+        shape (tuple[int, int]): (rows, cols) of the igrams being made.
+            Both files hold 8 bytes per pixel (complex64, or amp and cor float32)
+    """
+    try:
+        oldest_out = min(os.path.getmtime(intfile), os.path.getmtime(ccfile))
+        sizes = [os.path.getsize(intfile), os.path.getsize(ccfile)]
+    except OSError:
+        return False
+    if sizes != [shape[0] * shape[1] * 8] * 2:
+        return False
+    return oldest_out >= max(os.path.getmtime(geo1), os.path.getmtime(geo2))
+
+
+def strip_rows(num_slcs, cols, looks, memory=STRIP_MEMORY):
+    """Rows per strip so that a strip of num_slcs SLCs fits in memory bytes
+
+    Always a multiple of looks (at least one look)
+
+    Examples:
+        >>> strip_rows(10, 1000, 3, memory=10 * 1000 * 8 * 100)
+        99
+        >>> strip_rows(1000, 10000, 5, memory=1)
+        5
+    """
+    rows = memory // (num_slcs * cols * np.dtype(np.complex64).itemsize)
+    return max(rows // looks, 1) * looks
+
+
+def _look(image, looks):
+    if looks == 1:
+        return image
+    return take_looks(image, looks, looks, edges='trim', strip_rows=image.shape[0])
+
+
+def _read_strip(slc, row_start, row_end, xsize, looks):
+    """One strip of a memory mapped SLC, and its multilooked power"""
+    strip = np.asarray(slc[row_start:row_end, :xsize])
+    return strip, _look(np.abs(strip)**2, looks)
+
+
+def _pair_strip(strip1, strip2, looks):
+    """Multilooked igram, and the stacked amplitude/correlation rows, of one strip"""
+    slc1, power1 = strip1
+    slc2, power2 = strip2
+    igram = _look(slc1 * np.conj(slc2), looks).astype(np.complex64)
+    power = np.sqrt(power1 * power2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cor = np.where(power > 0, np.abs(igram) / power, 0)
+    cc = np.hstack((np.sqrt(power), cor)).astype(insar.sario.FLOAT_32_LE)
+    return igram, cc
+
+
+def _write_rows(filename, data, offset):
+    with open(filename, 'r+b') as f:
+        f.seek(offset)
+        data.tofile(f)
+
+
+def _save_text(filename, text):
+    """Writes text to filename atomically, through its partial file"""
+    with open(partial_path(filename), 'w') as f:
+        f.write(text)
+    os.rename(partial_path(filename), filename)
+
+
+@log_runtime
+def form_igrams(sbas_file,
+                rsc_file,
+                looks=1,
+                xsize=None,
+                ysize=None,
+                outdir=None,
+                max_workers=None,
+                memory=STRIP_MEMORY,
+                overwrite=False):
+    """Makes the .int and .cc of every pair in an sbas_list
+
+    Args:
+        sbas_file (str): path to the sbas_list (see read_sbas_list)
+        rsc_file (str): .rsc of the .geo files (e.g. elevation.dem.rsc)
+        looks (int): number of rows and cols averaged into each igram pixel
+        xsize (int): number of .geo columns to use (default: all)
+        ysize (int): number of .geo rows to use (default: all)
+            Leftover rows/cols which don't fill a full look are dropped
+        outdir (str): where to write the igrams (default: sbas_file's directory)
+        max_workers (int): pairs processed at once (default: number of cpus)
+        memory (int): bytes of SLC strips to hold at once (see strip_rows)
+        overwrite (bool): remake igrams which are newer than their .geo files
+
+    Returns:
+        list[str]: paths of the .int files made (skipped ones not included)
+    """
+    outdir = outdir or os.path.dirname(os.path.abspath(sbas_file))
+    rsc_data = insar.sario.load_dem_rsc(rsc_file)
+    xsize = xsize or rsc_data['WIDTH']
+    ysize = ysize or rsc_data['FILE_LENGTH']
+    xsize, ysize = xsize - xsize % looks, ysize - ysize % looks
+    igram_rsc = looked_rsc(rsc_data, looks, xsize, ysize)
+    out_cols = igram_rsc['WIDTH']
+
+    pairs = read_sbas_list(sbas_file)
+    names = [igram_name(geo1, geo2) for geo1, geo2 in pairs]
+    shape = (igram_rsc['FILE_LENGTH'], igram_rsc['WIDTH'])
+    rsc_path = os.path.join(outdir, 'dem.rsc')
+    rsc_text = insar.sario.format_dem_rsc(igram_rsc)
+    if os.path.exists(rsc_path):
+        with open(rsc_path) as f:
+            # Igrams of another grid can have the same size (e.g. a different
+            # crop with the same number of pixels, or other X_STEP)
+            if f.read() != rsc_text:
+                logger.info("%s changed: remaking all igrams", rsc_path)
+                overwrite = True
+    with open(os.path.join(outdir, 'intlist'), 'w') as f:
+        f.write(''.join(name + '.int\n' for name in names))
+
+    jobs = []
+    for (geo1, geo2), name in zip(pairs, names):
+        intfile, ccfile = [os.path.join(outdir, name + ext) for ext in ('.int', '.cc')]
+        if not overwrite and is_done(geo1, geo2, intfile, ccfile, shape):
+            logger.info("Skipping %s: up to date", intfile)
+            continue
+        jobs.append((geo1, geo2, intfile, ccfile))
+    if not jobs:
+        _save_text(rsc_path, rsc_text)
+        return []
+
+    slcs = {}
+    for geo1, geo2, _, _ in jobs:
+        for geo in (geo1, geo2):
+            if geo not in slcs:
+                slcs[geo] = insar.sario.memmap_complex(geo, rsc_data=rsc_data)
+                if slcs[geo].shape[0] < ysize or slcs[geo].shape[1] < xsize:
+                    raise ValueError("{} is {}, smaller than {} x {}".format(
+                        geo, slcs[geo].shape, ysize, xsize))
+    for _, _, intfile, ccfile in jobs:
+        for filename in (intfile, ccfile):
+            open(partial_path(filename), 'wb').close()
+
+    rows_per_strip = strip_rows(len(slcs), xsize, looks, memory)
+    logger.info("Forming %d igrams from %d SLCs, %d rows at a time", len(jobs), len(slcs),
+                rows_per_strip)
+    pool = ThreadPool(processes=max_workers)
+    try:
+        for row_start in range(0, ysize, rows_per_strip):
+            row_end = min(row_start + rows_per_strip, ysize)
+            # Each SLC's strip is read once, and used by all its pairs
+            strips = dict(
+                zip(slcs,
+                    pool.map(lambda geo: _read_strip(slcs[geo], row_start, row_end, xsize, looks),
+                             slcs)))
+            out_row = row_start // looks
+
+            def _run(job):
+                geo1, geo2, intfile, ccfile = job
+                igram, cc = _pair_strip(strips[geo1], strips[geo2], looks)
+                _write_rows(partial_path(intfile), igram, out_row * out_cols * 8)
+                _write_rows(partial_path(ccfile), cc, out_row * 2 * out_cols * 4)
+
+            pool.map(_run, jobs)
+            logger.debug("Finished rows %d to %d of %d", row_start, row_end, ysize)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    for _, _, intfile, ccfile in jobs:
+        for filename in (intfile, ccfile):
+            os.rename(partial_path(filename), filename)
+    # Last, so a run stopped early still sees the old grid and remakes all igrams
+    _save_text(rsc_path, rsc_text)
+    return [job[2] for job in jobs]
@@ -0,0 +1,208 @@
+"""Overview pyramids: smaller, block averaged copies of rasters for fast viewing
+
+Each level is the previous one averaged over 2x2 blocks, and is stored
+in a folder next to the raster, named by its reduction factor:
+
+    elevation.dem
+    elevation.dem.ovr/2/elevation.dem      (with elevation.dem.rsc)
+    elevation.dem.ovr/4/elevation.dem
+    ...
+    deformation.npy.ovr/2/deformation.npy  (3D stacks: each layer is reduced)
+
+Levels are made until the image fits in min_size pixels. A viewer can
+then load the smallest level still as large as the screen, instead of
+the full (possibly hundreds of millions of pixels) raster.
+"""
+from __future__ import division
+import os
+import numpy as np
+
+from insar import sario, utils
+from insar.log import get_log
+
+logger = get_log()
+
+OVERVIEW_EXT = '.ovr'
+# Stop making levels once the image fits in this many rows and cols
+MIN_SIZE = 256
+# Rows, cols of screen pixels to fill when picking a level
+DISPLAY_SHAPE = (1200, 1600)
+
+
+def overview_path(filename, factor):
+    """Path to the level of filename reduced by factor
+
+    Examples:
+        >>> print(overview_path('/data/elevation.dem', 4))
+        /data/elevation.dem.ovr/4/elevation.dem
+    """
+    return os.path.join(filename + OVERVIEW_EXT, str(factor), os.path.basename(filename))
+
+
+def _find_rsc(filename):
+    """The .rsc file describing filename: filename.rsc, or any .rsc in its directory"""
+    if os.path.exists(filename + '.rsc'):
+        return filename + '.rsc'
+    rsc_files = sario.find_files(os.path.dirname(os.path.abspath(filename)), '*.rsc')
+    return rsc_files[0] if rsc_files else None
+
+
+def _load(filename, mmap=False):
+    if sario.get_file_ext(filename) == '.npy':
+        return np.load(filename, mmap_mode='r' if mmap else None)
+    elif mmap and sario.get_file_ext(filename) in sario.ELEVATION_EXTS:
+        return sario.load_elevation(filename, dtype=None)
+    return sario.load_file(filename)
+
+
+def _save_level(filename, image, rsc_data, factor):
+    """Writes one level, and a .rsc with the reduced size and larger steps"""
+    outname = overview_path(filename, factor)
+    if not os.path.exists(os.path.dirname(outname)):
+        os.makedirs(os.path.dirname(outname))
+
+    if sario.get_file_ext(filename) == '.npy':
+        np.save(outname, image)
+    else:
+        sario.save(outname, image)
+
+    if rsc_data is not None:
+        level_rsc = rsc_data.copy()
+        level_rsc['FILE_LENGTH'], level_rsc['WIDTH'] = image.shape[-2:]
+        for first, step in (('X_FIRST', 'X_STEP'), ('Y_FIRST', 'Y_STEP')):
+            if first in level_rsc:
+                # New pixels are at the center of the averaged blocks
+                level_rsc[first] += rsc_data[step] * (factor - 1) / 2
+                level_rsc[step] = rsc_data[step] * factor
+        with open(outname + '.rsc', 'w') as f:
+            f.write(sario.format_dem_rsc(level_rsc))
+    return outname
+
+
+def build_overviews(filename, min_size=MIN_SIZE):
+    """Writes the overview levels for a raster until it fits in min_size pixels
+
+    Works for .npy arrays (2D or 3D stacks), and any format which
+    sario can both load and save (e.g. .dem, .int, .geo, .amp).
+
+    Args:
+        filename (str): path to the raster
+        min_size (int): stop once rows and cols are both below this
+
+    Returns:
+        list[str]: paths of the levels written, largest first
+    """
+    image = _load(filename, mmap=True)
+    rsc_file = None if sario.get_file_ext(filename) == '.npy' else _find_rsc(filename)
+    rsc_data = sario.load_dem_rsc(rsc_file) if rsc_file else None
+
+    outnames = []
+    factor = 1
+    while max(image.shape[-2:]) > min_size:
+        image = utils.take_looks(image, 2, 2)
+        factor *= 2
+        logger.info("Writing %s overview of %s: shape %s", factor, filename, image.shape)
+        outnames.append(_save_level(filename, image, rsc_data, factor))
+    return outnames
+
+
+def list_factors(filename):
+    """Reduction factors of the levels which exist for filename, ascending"""
+    ovr_dir = filename + OVERVIEW_EXT
+    if not os.path.isdir(ovr_dir):
+        return []
+    factors = [int(d) for d in os.listdir(ovr_dir) if d.isdigit()]
+    return sorted(f for f in factors if os.path.exists(overview_path(filename, f)))
+
+
+def pick_factor(shape, factors, display_shape=DISPLAY_SHAPE):
+    """Picks the largest level which is still at least the display size
+
+    Args:
+        shape (tuple[int]): rows, cols of the full resolution raster
+        factors (list[int]): available reduction factors
+        display_shape (tuple[int]): rows, cols of screen pixels to fill
+
+    Returns:
+        int: the reduction factor to use (1 for full resolution)
+
+    Examples:
+        >>> pick_factor((10000, 8000), [2, 4, 8, 16])
+        8
+        >>> pick_factor((1000, 800), [2, 4])
+        1
+        >>> pick_factor((100000, 100000), [2, 4])
+        4
+    """
+    best = 1
+    for factor in sorted(factors):
+        rows, cols = -(-shape[0] // factor), -(-shape[1] // factor)
+        # Keep reducing while the level still fills the display
+        if rows < display_shape[0] and cols < display_shape[1]:
+            break
+        best = factor
+    return best
+
+
+def _can_mmap(filename):
+    return sario.get_file_ext(filename) in ['.npy'] + sario.ELEVATION_EXTS
+
+
+def full_shape(filename):
+    """Rows, cols of a raster, without loading it"""
+    if _can_mmap(filename):
+        return _load(filename, mmap=True).shape[-2:]
+    rsc_data = sario.load_dem_rsc(_find_rsc(filename))
+    return (rsc_data['FILE_LENGTH'], rsc_data['WIDTH'])
+
+
+def preview_looks(shape, display_shape=DISPLAY_SHAPE):
+    """Looks to take on a raster of shape so it still fills display_shape
+
+    Examples:
+        >>> preview_looks((10000, 8000), (1200, 1600))
+        5
+        >>> preview_looks((1000, 8000), (1200, 1600))
+        1
+    """
+    return max(1, min(shape[0] // display_shape[0], shape[1] // display_shape[1]))
+
+
+def load_overview(filename, display_shape=DISPLAY_SHAPE, mmap=False):
+    """Loads the level of a raster that best fits the display
+
+    If no level was made that fits, a raster larger than the display is
+    multilooked down to it while reading (see utils.take_looks).
+
+    Args:
+        filename (str): path to the full resolution raster
+        display_shape (tuple[int]): rows, cols of screen pixels to fill
+        mmap (bool): memory map the raster if it is returned at full resolution
+
+    Returns:
+        tuple[ndarray, int]: the image, and its reduction factor (1 if full resolution)
+    """
+    factors = list_factors(filename)
+    shape = full_shape(filename)
+    factor = pick_factor(shape, factors, display_shape) if factors else 1
+    if factor > 1:
+        logger.info("Loading %s overview of %s", factor, filename)
+        return _load(overview_path(filename, factor)), factor
+
+    looks = preview_looks(shape, display_shape)
+    if looks > 1:
+        logger.info("Taking %s looks of %s for display", looks, filename)
+        return utils.take_looks(_load(filename, mmap=True), looks, looks), looks
+    return _load(filename, mmap=mmap), 1
+
+
+def load_window(filename, window):
+    """Loads a full resolution window ((row_start, row_end), (col_start, col_end))
+
+    .npy and elevation files are memory mapped, so only the window is read
+    """
+    (row_start, row_end), (col_start, col_end) = window
+    if sario.get_file_ext(filename) in sario.ELEVATION_EXTS:
+        return sario.load_elevation(filename, window=window)
+    image = _load(filename, mmap=_can_mmap(filename))
+    return np.array(image[..., row_start:row_end, col_start:col_end])
@@ -0,0 +1,322 @@
+"""Selects the small baseline pairs of .geo files to make into igrams
+
+Replaces the sbas_list.py script. Every pair of acquisitions whose
+temporal baseline (days) is at most max_temporal, and whose spatial
+baseline (meters) is at most max_spatial, becomes an igram.
+
+The spatial baseline comes from the precise orbit (.EOF) files: the
+satellite position at the middle of each acquisition is interpolated
+from the orbit state vectors, and the baseline of a pair is the distance
+between the two positions across the flight direction (the part along
+track only reflects the timing of the frames). It is the full
+cross-track distance, so it is at least the perpendicular baseline.
+Pairs with an acquisition missing its orbit file get a spatial baseline
+of 0, with a warning.
+
+Baselines of all pairs are computed at once with numpy, so choosing
+among thousands of acquisitions takes well under a second, and the
+output only depends on the file names and orbits.
+
+Files written to the igrams directory:
+    sbas_list: "../geo1 ../geo2 temporal spatial" for each pair
+    intlist: the name of each igram (20180420_20180502.int)
+    geolist: the .geo files used in any pair, in date order
+"""
+from __future__ import division
+import datetime
+import os
+import re
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+import insar.sario
+from insar.eof import EOF_REGEX
+from insar.log import get_log, log_runtime
+from insar.parsers import Sentinel
+
+logger = get_log()
+
+# Time, position and velocity of one orbit state vector in a .EOF file
+OSV_REGEX = re.compile(
+    r'<UTC>UTC=([\d\-T:.]+)</UTC>.*?'
+    r'<X unit="m">([-+\d.]+)</X>\s*<Y unit="m">([-+\d.]+)</Y>\s*<Z unit="m">([-+\d.]+)</Z>\s*'
+    r'<VX unit="m/s">([-+\d.]+)</VX>\s*<VY unit="m/s">([-+\d.]+)</VY>\s*'
+    r'<VZ unit="m/s">([-+\d.]+)</VZ>', re.DOTALL)
+
+
+def read_orbit(eof_file):
+    """Reads the state vectors of a precise orbit file
+
+    Returns:
+        times (ndarray[datetime64[us]]): time of each state vector (UTC)
+        positions (ndarray): (n, 3) positions, meters (Earth fixed)
+        velocities (ndarray): (n, 3) velocities, m/s
+    """
+    with open(eof_file) as f:
+        rows = OSV_REGEX.findall(f.read())
+    if not rows:
+        raise ValueError("No orbit state vectors found in {}".format(eof_file))
+    times = np.array([row[0] for row in rows], dtype='datetime64[us]')
+    values = np.array([row[1:] for row in rows], dtype=float)
+    return times, values[:, :3], values[:, 3:]
+
+
+def interpolate_orbit(times, positions, velocities, dts):
+    """Position and velocity at each time of dts, by cubic Hermite interpolation
+
+    Args:
+        times, positions, velocities: outputs of read_orbit
+        dts (ndarray[datetime64]): times to interpolate at, within the orbit
+
+    Returns:
+        tuple(ndarray, ndarray): (len(dts), 3) positions and velocities
+
+    Examples:
+        >>> times = np.array(['2018-04-20T00:00:00', '2018-04-20T00:00:10'], dtype='datetime64[us]')
+        >>> pos, vel = np.array([[0., 0, 0], [10, 0, 0]]), np.array([[1., 0, 0], [1, 0, 0]])
+        >>> p, v = interpolate_orbit(times, pos, vel, np.array(['2018-04-20T00:00:04'], 'M8[us]'))
+        >>> print(p, v)
+        [[4. 0. 0.]] [[1. 0. 0.]]
+    """
+    seconds = (times - times[0]) / np.timedelta64(1, 's')
+    t = (np.asarray(dts, dtype='datetime64[us]') - times[0]) / np.timedelta64(1, 's')
+    if np.any(t < seconds[0]) or np.any(t > seconds[-1]):
+        raise ValueError("Times are outside of the orbit's state vectors")
+    idx = np.clip(np.searchsorted(seconds, t, side='right') - 1, 0, len(seconds) - 2)
+    h = (seconds[idx + 1] - seconds[idx])[:, np.newaxis]
+    s = (t - seconds[idx])[:, np.newaxis] / h
+    p0, p1 = positions[idx], positions[idx + 1]
+    v0, v1 = velocities[idx] * h, velocities[idx + 1] * h
+
+    pos = ((2 * s**3 - 3 * s**2 + 1) * p0 + (s**3 - 2 * s**2 + s) * v0 +
+           (-2 * s**3 + 3 * s**2) * p1 + (s**3 - s**2) * v1)
+    vel = ((6 * s**2 - 6 * s) * p0 + (3 * s**2 - 4 * s + 1) * v0 + (-6 * s**2 + 6 * s) * p1 +
+           (3 * s**2 - 2 * s) * v1) / h
+    return pos, vel
+
+
+def _orbit_files(eof_files):
+    """(mission, validity start, validity stop, path) of each .EOF file name"""
+    orbits = []
+    for eof_file in eof_files:
+        match = EOF_REGEX.match(os.path.basename(eof_file))
+        if match:
+            mission, start, stop = match.groups()
+            start, stop = [np.datetime64(datetime.datetime.strptime(t, '%Y%m%dT%H%M%S'))
+                           for t in (start, stop)]
+            orbits.append((mission, start, stop, eof_file))
+    return orbits
+
+
+def orbit_positions(missions, dts, eof_files):
+    """Satellite position and velocity at each acquisition time
+
+    Args:
+        missions (list[str]): 'S1A' or 'S1B' for each acquisition
+        dts (ndarray[datetime64]): time of each acquisition
+        eof_files (list[str]): paths of the available .EOF files
+
+    Returns:
+        tuple(ndarray, ndarray): (n, 3) positions and velocities,
+            rows of nan for acquisitions without an orbit file
+    """
+    dts = np.asarray(dts, dtype='datetime64[us]')
+    positions = np.full((len(dts), 3), np.nan)
+    velocities = np.full((len(dts), 3), np.nan)
+    orbits = _orbit_files(eof_files)
+    eof_missions = np.array([orbit[0] for orbit in orbits])
+    starts = np.array([orbit[1] for orbit in orbits], dtype='datetime64[us]')
+    stops = np.array([orbit[2] for orbit in orbits], dtype='datetime64[us]')
+    # Read each orbit file once, for all the acquisitions it covers
+    by_file = {}
+    for num, (mission, dt) in enumerate(zip(missions, dts)):
+        matches = np.flatnonzero((eof_missions == mission) & (starts <= dt) & (dt <= stops))
+        if len(matches):
+            by_file.setdefault(orbits[matches[0]][3], []).append(num)
+    for eof_file, nums in sorted(by_file.items()):
+        pos, vel = interpolate_orbit(*read_orbit(eof_file), dts=dts[nums])
+        positions[nums], velocities[nums] = pos, vel
+    return positions, velocities
+
+
+def cross_track_offsets(positions, velocities):
+    """Positions relative to the first acquisition, minus their along-track part
+
+    Acquisitions with nan positions keep nan offsets
+    """
+    known = np.flatnonzero(~np.isnan(positions[:, 0]))
+    offsets = np.full_like(positions, np.nan)
+    if not len(known):
+        return offsets
+    ref = known[0]
+    along = velocities[ref] / np.linalg.norm(velocities[ref])
+    diffs = positions[known] - positions[ref]
+    offsets[known] = diffs - np.outer(diffs.dot(along), along)
+    return offsets
+
+
+def select_pairs(dates, offsets=None, max_temporal=500, max_spatial=500, connect=False):
+    """Chooses the pairs of acquisitions within the baseline limits
+
+    Args:
+        dates (list[date]): date of each acquisition, in increasing order
+        offsets (ndarray): (n, 3) cross-track offsets in meters (see cross_track_offsets),
+            or None to only use the temporal baseline. Pairs with a row of nans
+            (no orbit) get a spatial baseline of 0
+        max_temporal (float): longest temporal baseline, in days
+        max_spatial (float): longest spatial baseline, in meters
+        connect (bool): if the chosen pairs leave the acquisitions in
+            separate groups, add the pairs of consecutive dates joining them
+
+    Returns:
+        list[tuple(int, int, int, float)]: (first index, second index,
+            temporal baseline, spatial baseline), sorted by index
+
+    Examples:
+        >>> import datetime
+        >>> dates = [datetime.date(2018, 4, d) for d in (1, 13, 25)]
+        >>> select_pairs(dates, max_temporal=12)
+        [(0, 1, 12, 0.0), (1, 2, 12, 0.0)]
+        >>> offsets = np.array([[0, 0, 0], [0, 300, 400], [0, 0, 10]])
+        >>> select_pairs(dates, offsets, max_temporal=30, max_spatial=100)
+        [(0, 2, 24, 10.0)]
+        >>> select_pairs(dates, offsets, max_temporal=30, max_spatial=100, connect=True)
+        [(0, 1, 12, 500.0), (0, 2, 24, 10.0)]
+    """
+    num = len(dates)
+    days = np.array([d.toordinal() for d in dates])
+    if offsets is None:
+        offsets = np.zeros((num, 3))
+    # Dates are sorted, so the partners of each acquisition are one range of later ones
+    lo = np.searchsorted(days, days, side='right')
+    hi = np.searchsorted(days, days + max_temporal, side='right')
+    counts = hi - lo
+    first = np.repeat(np.arange(num), counts)
+    second = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+    spatial = _spatial_baselines(offsets, first, second)
+    keep = spatial <= max_spatial
+    first, second, spatial = first[keep], second[keep], spatial[keep]
+
+    if connect and num > 1:
+        extra = _connecting_pairs(first, second, num)
+        if extra:
+            logger.info("Adding %d pairs to connect the network", len(extra))
+            new_first, new_second = np.array(extra).T
+            first = np.concatenate((first, new_first))
+            second = np.concatenate((second, new_second))
+            spatial = np.concatenate((spatial, _spatial_baselines(offsets, new_first, new_second)))
+        order = np.lexsort((second, first))
+        first, second, spatial = first[order], second[order], spatial[order]
+
+    temporal = days[second] - days[first]
+    return list(zip(first.tolist(), second.tolist(), temporal.tolist(), spatial.tolist()))
+
+
+def _spatial_baselines(offsets, first, second):
+    return np.nan_to_num(np.linalg.norm(offsets[second] - offsets[first], axis=1))
+
+
+def _find(parents, node):
+    """Root of node in a union-find forest, compressing the path"""
+    root = node
+    while parents[root] != root:
+        root = parents[root]
+    while parents[node] != root:
+        parents[node], node = root, parents[node]
+    return root
+
+
+def _connecting_pairs(first, second, num):
+    """Pairs of consecutive acquisitions needed to join all into one network"""
+    graph = sparse.coo_matrix((np.ones(len(first)), (first, second)), shape=(num, num))
+    _, labels = connected_components(graph, directed=False)
+    # Union-find of the groups, as pairs join them
+    parents = list(range(labels.max() + 1))
+    extra = []
+    for i in range(num - 1):
+        root1, root2 = _find(parents, labels[i]), _find(parents, labels[i + 1])
+        if root1 != root2:
+            parents[root1] = root2
+            extra.append((i, i + 1))
+    return extra
+
+
+def _find_products(path, catalog):
+    """The .geo and .EOF files in path"""
+    if catalog is not None:
+        catalog.refresh()
+        return catalog.find('*.geo', directory=path), catalog.find('*.EOF', directory=path)
+    return (sorted(insar.sario.find_files(path, '*.geo')),
+            sorted(insar.sario.find_files(path, '*.EOF')))
+
+
+def write_lists(outdir, geo_files, pairs):
+    """Writes sbas_list, intlist and geolist for pairs of geo_files
+
+    Paths in sbas_list and geolist are relative to outdir
+    """
+    relpaths = [os.path.relpath(os.path.abspath(g), os.path.abspath(outdir)) for g in geo_files]
+    names = [Sentinel(os.path.basename(g)).start_time.strftime('%Y%m%d') for g in geo_files]
+    used = sorted(set(i for i, _, _, _ in pairs) | set(j for _, j, _, _ in pairs))
+    with open(os.path.join(outdir, 'sbas_list'), 'w') as f:
+        for i, j, temporal, spatial in pairs:
+            f.write('{} {} {:.1f} {:.6f}\n'.format(relpaths[i], relpaths[j], temporal, spatial))
+    with open(os.path.join(outdir, 'intlist'), 'w') as f:
+        f.write(''.join('{}_{}.int\n'.format(names[i], names[j]) for i, j, _, _ in pairs))
+    with open(os.path.join(outdir, 'geolist'), 'w') as f:
+        f.write(''.join(relpaths[i] + '\n' for i in used))
+
+
+@log_runtime
+def create_sbas_list(path='.',
+                     outdir='igrams',
+                     max_temporal=500,
+                     max_spatial=500,
+                     connect=False,
+                     catalog=None):
+    """Finds the .geo files in path, and writes the lists of pairs to outdir
+
+    Args:
+        path (str): directory with the .geo and .EOF files
+        outdir (str): directory to write sbas_list, intlist and geolist
+        max_temporal (float): longest temporal baseline, in days
+        max_spatial (float): longest spatial baseline, in meters
+        connect (bool): add pairs needed to connect the network (see select_pairs)
+        catalog (insar.catalog.Catalog): find the files through the catalog
+            instead of listing path
+
+    Returns:
+        list[tuple]: the chosen pairs of .geo paths, with their baselines
+    """
+    geo_files, eof_files = _find_products(path, catalog)
+    table = Sentinel.parse_many(geo_files)
+    mid_times = table['start_time'] + (table['stop_time'] - table['start_time']) / 2
+    # Date order, with the name breaking ties
+    order = sorted(range(len(table['filename'])),
+                   key=lambda k: (mid_times[k], os.path.basename(table['filename'][k])))
+
+    geos, missions, dts, dates = [], [], [], []
+    for k in order:
+        date = mid_times[k].astype(datetime.datetime).date()
+        if dates and dates[-1] == date:
+            logger.warning("Skipping %s: %s is already used for %s", table['filename'][k], geos[-1],
+                           date)
+            continue
+        geos.append(table['filename'][k])
+        missions.append(table['mission'][k])
+        dts.append(mid_times[k])
+        dates.append(date)
+
+    positions, velocities = orbit_positions(missions, np.array(dts), eof_files)
+    missing = [g for g, p in zip(geos, positions) if np.isnan(p[0])]
+    if missing:
+        logger.warning("No orbit file for %d of %d .geo files, using spatial baselines of 0: %s",
+                       len(missing), len(geos), ', '.join(missing))
+    offsets = cross_track_offsets(positions, velocities)
+
+    pairs = select_pairs(dates, offsets, max_temporal, max_spatial, connect=connect)
+    logger.info("Chose %d pairs from %d .geo files", len(pairs), len(geos))
+    write_lists(outdir, geos, pairs)
+    return [(geos[i], geos[j], temporal, spatial) for i, j, temporal, spatial in pairs]
@@ -2,20 +2,38 @@
 Utilities for parsing file names of SAR products for relevant info.
 
 """
+import collections
 import re
 from datetime import datetime
+import numpy as np
 
 
 class Base(object):
     """Base parser to illustrate expected interface/ minimum data available
+
+    The filename is parsed once on creation, and the fields are kept,
+    so properties don't rerun the regex. To parse many files at once
+    into columns, use parse_many.
     """
     FILE_REGEX = None
     TIME_FMT = None
     _FIELD_MEANINGS = None
+    # Parsers are made for every file in large directories: keep them small
+    __slots__ = ('filename', '_fields')
 
     def __init__(self, filename):
         self.filename = filename
-        self.full_parse()  # Run a parse to check validity of filename
+        self._fields = self.full_parse()  # Also checks validity of filename
+
+    @classmethod
+    def _pattern(cls):
+        """FILE_REGEX compiled once per class"""
+        if cls.__dict__.get('_compiled') is None:
+            if not cls.FILE_REGEX:
+                raise NotImplementedError("Must define class FILE_REGEX to parse")
+            cls._compiled = re.compile(cls.FILE_REGEX)
+            cls._field_index = {name: idx for idx, name in enumerate(cls._FIELD_MEANINGS)}
+        return cls._compiled
 
     def full_parse(self):
         """Returns all parts of the data contained in filename
@@ -26,10 +44,7 @@ class Base(object):
         Raises:
             ValueError: if filename string is invalid
         """
-        if not self.FILE_REGEX:
-            raise NotImplementedError("Must define class FILE_REGEX to parse")
-
-        match = re.search(self.FILE_REGEX, self.filename)
+        match = self._pattern().search(self.filename)
         if not match:
             raise ValueError('Invalid {} filename: {}'.format(self.__class__.__name__,
                                                               self.filename))
@@ -43,8 +58,34 @@ class Base(object):
 
     def _get_field(self, fieldname):
         """Pick a specific field based on its name"""
-        idx = self.field_meanings.index(fieldname)
-        return self.full_parse()[idx]
+        return self._fields[self._field_index[fieldname]]
+
+    @classmethod
+    def parse_many(cls, filenames):
+        """Parses many file names at once into columns
+
+        File names which don't match are left out (see the 'filename' column)
+
+        Args:
+            filenames (iterable[str]): names or paths of products
+
+        Returns:
+            OrderedDict[str, ndarray]: the 'filename' column, then one
+                column of strings per field in field_meanings
+        """
+        search = cls._pattern().search
+        names, rows = [], []
+        for filename in filenames:
+            match = search(filename)
+            if match:
+                names.append(filename)
+                rows.append(match.groups())
+
+        table = collections.OrderedDict([('filename', np.array(names, dtype=object))])
+        columns = zip(*rows) if rows else [()] * len(cls._FIELD_MEANINGS)
+        for name, column in zip(cls._FIELD_MEANINGS, columns):
+            table[name] = np.array(column, dtype=object)
+        return table
 
 
 class Sentinel(Base):
@@ -78,6 +119,7 @@ class Sentinel(Base):
     Attributes:
         filename (str) name of the sentinel data product
     """
+    __slots__ = ()
     FILE_REGEX = r'(S1A|S1B)_([\w\d]{2})_([\w_]{3})([FHM_])_(\d)([SA])([SDHV]{2})_([T\d]{15})_([T\d]{15})_(\d{6})_([\d\w]{6})_([\d\w]{4})'
     TIME_FMT = '%Y%m%dT%H%M%S'
     _FIELD_MEANINGS = ('mission', 'beam', 'product type', 'resolution class', 'product level',
@@ -179,6 +221,38 @@ class Sentinel(Base):
         """Alias for relative orbit number"""
         return self.relative_orbit
 
+    @classmethod
+    def parse_many(cls, filenames):
+        """Parses many Sentinel file names at once into columns
+
+        Along with the string columns of Base.parse_many, adds typed columns
+        'start_time', 'stop_time' (datetime64[s]), 'absolute_orbit',
+        and 'relative_orbit' (int)
+
+        Example:
+            >>> table = Sentinel.parse_many([
+            ...     'S1A_IW_SLC__1SDV_20180408T043025_20180408T043053_021371_024C9B_1B70.zip',
+            ...     'not_a_product.zip',
+            ...     'S1B_WV_OCN__2SSV_20180522T161319_20180522T164846_011036_014389_67D8'])
+            >>> print(table['mission'])
+            ['S1A' 'S1B']
+            >>> print(table['start_time'])
+            ['2018-04-08T04:30:25' '2018-05-22T16:13:19']
+            >>> print(table['relative_orbit'])
+            [124 160]
+        """
+        table = super(Sentinel, cls).parse_many(filenames)
+        for column, field in (('start_time', 'start datetime'), ('stop_time', 'stop datetime')):
+            # YYYYmmddTHHMMSS -> YYYY-mm-ddTHH:MM:SS, which numpy parses
+            iso = [s[:4] + '-' + s[4:6] + '-' + s[6:11] + ':' + s[11:13] + ':' + s[13:]
+                   for s in table[field]]
+            table[column] = np.array(iso, dtype='datetime64[s]')
+        absolute = table['orbit number'].astype(int)
+        table['absolute_orbit'] = absolute
+        table['relative_orbit'] = np.where(table['mission'] == 'S1A', (absolute - 73) % 175 + 1,
+                                           (absolute - 27) % 175 + 1)
+        return table
+
 
 class Uavsar(Base):
     """Uavsar reference for Polsar:
@@ -206,6 +280,7 @@ class Uavsar(Base):
         >>> parser = Uavsar(fname)
 
     """
+    __slots__ = ()
     FILE_REGEX = r'([\w\d]{6})_(\d{3})(\w+)_(\d{2})(\d{3})_(\d{3})_(\d{6})_(\w)(\d{3})(\w{0,4})_(XX|CX)_(\w{2})(_ML\dX\d)?'
     TIME_FMT = '%y%m%d'
     _FIELD_MEANINGS = (
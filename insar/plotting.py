@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+from insar import overviews
 from insar.log import get_log
 
 logger = get_log()
@@ -150,7 +151,8 @@ def view_stack(stack,
                cmap='seismic',
                title="",
                lat_lon=True,
-               rsc_data=None):
+               rsc_data=None,
+               overview=None):
     """Displays an image from a stack, allows you to click for timeseries
 
     Args:
@@ -168,6 +170,9 @@ def view_stack(stack,
         lat_lon (bool): Optional- Use latitude and longitude in legend
             If False, displays row/col of pixel
         rsc_data (dict): Optional- if lat_lon=True, data to calc the lat/lon
+        overview (ndarray): Optional- reduced 2D image to display instead of
+            a stack layer (see overviews.load_overview). Clicks still pick
+            full resolution pixels of stack, so stack can be a memmap
 
     Returns:
         None
@@ -188,7 +193,9 @@ def view_stack(stack,
 
     imagefig = plt.figure()
 
-    if isinstance(display_img, int):
+    if overview is not None:
+        img = overview
+    elif isinstance(display_img, int):
         img = stack[display_img, :, :]
     elif display_img == 'mean':
         img = np.mean(stack, axis=0)
@@ -196,7 +203,9 @@ def view_stack(stack,
         raise ValueError("display_img must be an int or 'mean'")
 
     shifted_cmap = make_shifted_cmap(img, cmap)
-    axes_image = plt.imshow(img, cmap=shifted_cmap)  # Type: AxesImage
+    # Extent in full resolution pixels, so clicks on an overview give stack indices
+    axes_image = plt.imshow(
+        img, cmap=shifted_cmap, extent=full_res_extent(stack.shape[-2:]))  # Type: AxesImage
 
     cbar = imagefig.colorbar(axes_image)
     cbar.set_label(label)
@@ -213,7 +222,7 @@ def view_stack(stack,
         if event.button != 1 or not event.inaxes:
             return
         plt.figure(timefig.number)
-        row, col = int(event.ydata), int(event.xdata)
+        row, col = int(round(event.ydata)), int(round(event.xdata))
         try:
             timeline = get_timeseries(row, col)
         except IndexError:  # Somehow clicked outside image, but in axis
@@ -234,3 +243,96 @@ def view_stack(stack,
 
     imagefig.canvas.mpl_connect('button_press_event', onclick)
     plt.show(block=True)
+
+
+def full_res_extent(shape):
+    """imshow extent placing pixel centers at full resolution (row, col) indices
+
+    Examples:
+        >>> full_res_extent((100, 200))
+        (-0.5, 199.5, 99.5, -0.5)
+    """
+    rows, cols = shape
+    return (-0.5, cols - 0.5, rows - 0.5, -0.5)
+
+
+def connect_zoom(axes_image, filename, factor, display_shape=overviews.DISPLAY_SHAPE):
+    """Swaps in full resolution pixels from filename when zoomed in on an overview
+
+    While the visible area of the full resolution raster fits on the
+    display, only that window is read from disk and shown. Zooming back
+    out returns to the overview image.
+
+    Args:
+        axes_image (AxesImage): image showing the overview, made with
+            extent=full_res_extent(shape)
+        filename (str): path to the full resolution raster
+        factor (int): reduction factor of the displayed overview
+        display_shape (tuple[int]): rows, cols of screen pixels
+
+    Returns:
+        callable: the callback connected to the axes limit changes
+    """
+    if factor == 1:
+        return None
+    ax = axes_image.axes
+    overview = axes_image.get_array()
+    rows, cols = overviews.full_shape(filename)
+    full_extent = full_res_extent((rows, cols))
+    state = {'window': None}
+
+    def on_lims_change(_ax):
+        (x0, x1), (y0, y1) = sorted(ax.get_xlim()), sorted(ax.get_ylim())
+        row_start, row_end = max(0, int(np.floor(y0 + 0.5))), min(rows, int(np.ceil(y1 + 0.5)))
+        col_start, col_end = max(0, int(np.floor(x0 + 0.5))), min(cols, int(np.ceil(x1 + 0.5)))
+        fits = (row_end - row_start <= display_shape[0] and col_end - col_start <= display_shape[1])
+
+        if fits and row_end > row_start and col_end > col_start:
+            window = ((row_start, row_end), (col_start, col_end))
+            if window == state['window']:
+                return
+            image = overviews.load_window(filename, window)
+            extent = (col_start - 0.5, col_end - 0.5, row_end - 0.5, row_start - 0.5)
+        elif state['window'] is not None:
+            window, image, extent = None, overview, full_extent
+        else:
+            return
+
+        state['window'] = window
+        axes_image.set_data(image)
+        # set_extent can autoscale the axes: keep the user's zoom
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        axes_image.set_extent(extent)
+        ax.set_xlim(xlim, emit=False)
+        ax.set_ylim(ylim, emit=False)
+        ax.figure.canvas.draw_idle()
+
+    ax.callbacks.connect('xlim_changed', on_lims_change)
+    ax.callbacks.connect('ylim_changed', on_lims_change)
+    return on_lims_change
+
+
+def view_raster(filename, display_shape=overviews.DISPLAY_SHAPE, title=None, **imshow_kwargs):
+    """Shows a raster using the overview level which fits the display
+
+    Full resolution data is read only for zoomed in windows (see connect_zoom).
+    Without overviews (made by overviews.build_overviews), a raster larger
+    than the display is multilooked down to it
+
+    Args:
+        filename (str): path to the raster
+        display_shape (tuple[int]): rows, cols of screen pixels
+        title (str): Optional- title for the figure (default: filename)
+        imshow_kwargs: extra keyword args passed to plt.imshow
+
+    Returns:
+        AxesImage: the displayed image
+    """
+    image, factor = overviews.load_overview(filename, display_shape)
+    shape = overviews.full_shape(filename) if factor > 1 else image.shape
+    plt.figure()
+    axes_image = plt.imshow(image, extent=full_res_extent(shape), **imshow_kwargs)
+    plt.colorbar()
+    plt.title(title or filename)
+    connect_zoom(axes_image, filename, factor, display_shape)
+    return axes_image
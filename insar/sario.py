@@ -4,12 +4,16 @@ Functions to assist input and output of SAR data
 Email: scott.stanie@utexas.edu
 """
 import collections
+import contextlib
 import glob
+import gzip
 import math
 import os
 import pprint
 import re
+import struct
 import sys
+import zipfile
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -33,6 +37,10 @@ REAL_EXTS = ['.amp', '.cor', '.mlc', '.grd']  # NOTE: .cor might only be real fo
 # Will end with `_ML5X5.grd`, e.g., for 5x5 downsampled
 
 ELEVATION_EXTS = ['.dem', '.hgt']
+# .hgt tiles can be loaded straight from the compressed downloads (e.g. N19W156.hgt.gz)
+COMPRESSED_EXTS = ['.gz', '.zip']
+# Number of rows to decompress at a time for compressed .hgt files
+HGT_BLOCK_ROWS = 256
 
 # These file types are not simple complex matrices: see load_stacked for detail
 STACKED_FILES = ['.cc', '.unw']
@@ -134,7 +142,73 @@ def load_file(filename, rsc_file=None, ann_info=None, verbose=False):
 load = load_file
 
 
-def load_elevation(filename):
+def _hgt_shape(num_bytes):
+    """Finds if we are using STRM1 (3601x3601) or SRTM3 (1201x1201) from file size"""
+    num_pixels = num_bytes // INT_16_BE.itemsize
+    if num_pixels == 3601 * 3601:
+        # STRM1- 1 arc second data, 30 meter data
+        return (3601, 3601)
+    elif num_pixels == 1201 * 1201:
+        # STRM3- 3 arc second data, 90 meter data
+        return (1201, 1201)
+    else:
+        raise ValueError("Invalid .hgt data size: must be square size 1201 or 3601")
+
+
+@contextlib.contextmanager
+def open_compressed_hgt(filename):
+    """Opens a .hgt.gz or .hgt.zip for streaming reads
+
+    Yields:
+        tuple[file, int]: the open (decompressing) file, and its uncompressed size
+    """
+    if get_file_ext(filename) == '.gz':
+        # gzip stores the uncompressed size (mod 2**32) in the last 4 bytes
+        with open(filename, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            num_bytes = struct.unpack('<I', f.read(4))[0]
+        with contextlib.closing(gzip.open(filename, 'rb')) as f:
+            yield f, num_bytes
+    else:
+        with contextlib.closing(zipfile.ZipFile(filename)) as zf:
+            info = next(i for i in zf.infolist() if get_file_ext(i.filename) == '.hgt')
+            with contextlib.closing(zf.open(info)) as f:
+                yield f, info.file_size
+
+
+def _read_compressed_hgt(filename, window, dtype, out):
+    """Decompresses only the rows in window of a .hgt.gz or .hgt.zip
+
+    Rows are decoded HGT_BLOCK_ROWS at a time into a small buffer, then
+    converted and clipped into the output, so the full tile is never in memory.
+    Decompression stops after the last row needed.
+    """
+    with open_compressed_hgt(filename) as (f, num_bytes):
+        nrows, ncols = _hgt_shape(num_bytes)
+        (row_start, row_end), (col_start, col_end) = window or ((0, nrows), (0, ncols))
+        row_start, row_end, _ = slice(row_start, row_end).indices(nrows)
+        col_start, col_end, _ = slice(col_start, col_end).indices(ncols)
+        if out is None:
+            out = np.empty((row_end - row_start, col_end - col_start), dtype=dtype or INT_16_BE)
+
+        row_bytes = ncols * INT_16_BE.itemsize
+        # Seeking forward in a compressed stream decodes and discards the skipped rows
+        f.seek(row_start * row_bytes)
+        block = np.empty((min(HGT_BLOCK_ROWS, row_end - row_start), ncols), dtype=INT_16_BE)
+        for block_start in range(row_start, row_end, HGT_BLOCK_ROWS):
+            num_rows = min(HGT_BLOCK_ROWS, row_end - block_start)
+            buf = memoryview(block).cast('B')[:num_rows * row_bytes]
+            if f.readinto(buf) != len(buf):
+                raise ValueError("{} is truncated".format(filename))
+            out_rows = slice(block_start - row_start, block_start - row_start + num_rows)
+            if dtype is None:
+                out[out_rows] = block[:num_rows, col_start:col_end]
+            else:
+                np.clip(block[:num_rows, col_start:col_end], 0, None, out=out[out_rows])
+    return out
+
+
+def load_elevation(filename, dtype=INT_16_LE, window=None, out=None):
     """Loads a digital elevation map from either .hgt file or .dem
 
     .hgt is the NASA SRTM files given. Documentation on format here:
@@ -144,36 +218,65 @@ def load_elevation(filename):
     .dem is format used by Zebker geo-coded and ROI-PAC SAR software
     Only difference is data is stored little-endian (like other SAR data)
 
+    The file is memory mapped, so only the bytes in `window` are read,
+    and only those are converted to `dtype`.
+    .hgt files can also be compressed as they are downloaded (.hgt.gz or .hgt.zip):
+    these are decompressed as a stream, stopping after the last row in `window`.
+
     Note on both formats: gaps in coverage are given by INT_MIN -32768,
     so either manually set data(data == np.min(data)) = 0,
         data = np.clip(data, 0, None), or when plotting, plt.imshow(data, vmin=0)
-    """
 
+    Args:
+        filename (str): path to .hgt, .hgt.gz, .hgt.zip, or .dem file
+        dtype (np.dtype): type of output array (default little-endian int16)
+            If None, returns a read-only memory mapped view in the file's own
+            byte order (>i2 for .hgt, <i2 for .dem) without any copying.
+            Note that the .hgt zero clipping is only done when converting.
+        window (tuple[tuple[int]]): optional ((row_start, row_end), (col_start, col_end))
+            to read only part of the image, following python slice rules
+        out (ndarray): optional array to write the (converted) window into,
+            e.g. a view of a larger stitched DEM. Must be the shape of the window.
+
+    Returns:
+        ndarray: 2D array of heights (`out`, if given)
+
+    Raises:
+        ValueError: if a .hgt file is not a valid size
+    """
     ext = get_file_ext(filename)
+    if ext in COMPRESSED_EXTS:
+        return _read_compressed_hgt(filename, window, dtype, out)
+
     data_type = INT_16_LE if ext == '.dem' else INT_16_BE
-    data = np.fromfile(filename, dtype=data_type)
-    # Make sure we're working with little endian
-    if data_type == INT_16_BE:
-        data = data.astype(INT_16_LE)
 
-    # Reshape to correct size.
-    # Either get info from .dem.rsc
+    # Get shape from .dem.rsc for .dem files
     if ext == '.dem':
         info = load_dem_rsc(filename)
-        dem_img = data.reshape((info['FILE_LENGTH'], info['WIDTH']))
-
-    # Or check if we are using STRM1 (3601x3601) or SRTM3 (1201x1201)
+        shape = (info['FILE_LENGTH'], info['WIDTH'])
     else:
-        if (data.shape[0] / 3601) == 3601:
-            # STRM1- 1 arc second data, 30 meter data
-            dem_img = data.reshape((3601, 3601))
-        elif (data.shape[0] / 1201) == 1201:
-            # STRM3- 3 arc second data, 90 meter data
-            dem_img = data.reshape((1201, 1201))
+        shape = _hgt_shape(os.path.getsize(filename))
+
+    dem_img = np.memmap(filename, dtype=data_type, mode='r', shape=shape)
+    if window is not None:
+        (row_start, row_end), (col_start, col_end) = window
+        dem_img = dem_img[row_start:row_end, col_start:col_end]
+
+    if out is not None:
+        if ext == '.hgt' and dtype is not None:
+            # Converts byte order and clips voids in the same pass as the copy
+            np.clip(dem_img, 0, None, out=out)
         else:
-            raise ValueError("Invalid .hgt data size: must be square size 1201 or 3601")
+            out[...] = dem_img
+        return out
+    elif dtype is None:
+        return dem_img
+
+    # Copy only the requested window, converting to requested byte order
+    dem_img = np.array(dem_img, dtype=dtype)
+    if ext == '.hgt':
         # TODO: makeDEM.m did this... do we always want this??
-        dem_img = np.clip(dem_img, 0, None)
+        np.clip(dem_img, 0, None, out=dem_img)
 
     return dem_img
 
@@ -307,6 +410,28 @@ def load_complex(filename, ann_info=None, rsc_data=None):
     return combine_real_imag(real_data, imag_data)
 
 
+def memmap_complex(filename, ann_info=None, rsc_data=None):
+    """Read-only memory mapped view of a complex file, without loading it
+
+    Rows are only read from disk when they are sliced, so strips of
+    large .geo or .slc files can be processed one at a time.
+    The number of rows comes from the file size.
+
+    Args:
+        filename (str): path to the file to open
+        rsc_data (dict): output from load_dem_rsc, gives width of file
+        ann_info (dict): data parsed from UAVSAR annotation file
+
+    Returns:
+        np.memmap: complex64 view with shape (rows, cols)
+    """
+    rows, cols = _get_file_rows_cols(ann_info=ann_info, rsc_data=rsc_data)
+    num_pixels = os.path.getsize(filename) // np.dtype(np.complex64).itemsize
+    if num_pixels % cols:
+        raise ValueError("Invalid number of cols (%s) for file size %s." % (cols, num_pixels))
+    return np.memmap(filename, dtype='<c8', mode='r', shape=(num_pixels // cols, cols))
+
+
 def load_stacked(filename, rsc_data, return_amp=False):
     """Helper function to load .unw and .cor files
 
@@ -1,6 +1,7 @@
 """
 Main command line entry point to manage all other sub commands
 """
+import datetime
 import os
 import click
 import insar
@@ -34,6 +35,11 @@ def cli(ctx, verbose, path):
     "-m",
     type=click.Choice(["S1A", "S1B"]),
     help="Sentinel satellite to download (None gets both S1A and S1B)")
+@click.option(
+    "--orbit-store",
+    type=click.Path(file_okay=False),
+    help="Directory of orbit files shared between projects. Orbits found"
+    " there are symlinked instead of downloaded; new downloads are saved there")
 @click.pass_obj
 def download(context, **kwargs):
     """Download Sentinel precise orbit files.
@@ -44,7 +50,7 @@ def download(context, **kwargs):
     Download EOFs for specific date, or searches for Sentinel files in --path.
     With no arguments, searches current directory for Sentinel 1 products
     """
-    insar.eof.main(context['path'], kwargs['mission'], kwargs['date'])
+    insar.eof.main(context['path'], kwargs['mission'], kwargs['date'], kwargs['orbit_store'])
 
 
 # COMMAND: DEM
@@ -72,13 +78,33 @@ def download(context, **kwargs):
     type=click.Choice(['NASA', 'AWS']),
     default='NASA',
     help="Source of SRTM data. See insar.dem docstring for more about data.")
+@click.option(
+    "--max-workers",
+    "-j",
+    default=4,
+    type=click.IntRange(1, 32),
+    help="Number of tiles to download at once (default=4)")
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Reuse a saved DEM made with the same bounds and rate (default: --cache)")
+@click.option(
+    "--reuse-superset",
+    is_flag=True,
+    help="If no exact match is saved, crop a saved DEM which covers the bounds")
+@click.option(
+    "--keep-compressed",
+    is_flag=True,
+    help="Keep downloaded tiles compressed in the cache: about 3x less disk, "
+    "but slower stitching")
 @click.pass_obj
-def dem(context, geojson, data_source, rate, output):
+def dem(context, geojson, data_source, rate, output, max_workers, cache, reuse_superset,
+        keep_compressed):
     """Stiches .hgt files to make one DEM and .dem.rsc file
 
     Pick a lat/lon bounding box for a DEM, and it will download
     the necessary SRTM1 tile, combine into one array,
-    then upsample using upsample.c
+    then upsample using bilinear interpolation
 
     Suggestion for box: http://geojson.io gives you geojson for any polygon
     Take the output of that and save to a file (e.g. mybox.geojson
@@ -89,10 +115,84 @@ def dem(context, geojson, data_source, rate, output):
 
         insar dem -g data/mybox.geojson -r 2 -o elevation.dem
 
-    Default out is elevation.dem for upsampled version, elevation_small.dem
+    Default out is elevation.dem for upsampled version.
     Also creates elevation.dem.rsc with start lat/lon, stride, and other info.
+
+    Finished DEMs are saved in ~/.cache/insar/products: running again with
+    the same geojson and rate links the saved DEM instead of rebuilding.
+    """
+    insar.dem.main(
+        geojson,
+        data_source,
+        rate,
+        output,
+        max_workers=max_workers,
+        use_cache=cache,
+        superset_ok=reuse_superset,
+        keep_compressed=keep_compressed)
+
+
+# COMMAND: CACHE
+@cli.group()
+@click.option(
+    "--cache-dir",
+    type=click.Path(exists=True, file_okay=False),
+    help="Directory of downloaded tiles (default ~/.cache/insar)")
+@click.pass_obj
+def cache(context, cache_dir):
+    """Manage the cache of downloaded SRTM tiles and finished DEMs.
+
+    Finished DEMs are listed as products/<key>.
+    The cache can be capped in size by setting INSAR_CACHE_MAX_SIZE (e.g. 20G).
     """
-    insar.dem.main(geojson, data_source, rate, output)
+    context['tile_cache'] = insar.cache.TileCache(cache_dir)
+
+
+@cache.command('list')
+@click.pass_obj
+def cache_list(context):
+    """List cached tiles and DEMs, most recently used first."""
+    tile_cache = context['tile_cache']
+    entries = tile_cache.entries()
+    # Product names (products/<key>) are longer than tile names
+    width = max([20] + [len(name) + 2 for name, _ in entries])
+    for tile_name, entry in entries:
+        last_access = datetime.datetime.fromtimestamp(entry['last_access'])
+        click.echo("{:<{}}{:>12}  {}".format(tile_name, width,
+                                             insar.cache.format_size(entry['size']),
+                                             last_access.strftime("%Y-%m-%d %H:%M:%S")))
+    click.echo("Total: {}".format(insar.cache.format_size(tile_cache.total_size())))
+
+
+@cache.command('prune')
+@click.option(
+    "--max-size",
+    "-s",
+    help="Size to shrink the cache to, e.g. 10G (default: INSAR_CACHE_MAX_SIZE)")
+@click.pass_obj
+def cache_prune(context, max_size):
+    """Remove least recently used tiles and DEMs until the cache is under a size."""
+    tile_cache = context['tile_cache']
+    if max_size is None and tile_cache.max_size is None:
+        raise click.UsageError("Need --max-size or INSAR_CACHE_MAX_SIZE to prune")
+    removed = tile_cache.prune(max_size=max_size)
+    for tile_name in removed:
+        click.echo("Removed {}".format(tile_name))
+    click.echo("Total: {}".format(insar.cache.format_size(tile_cache.total_size())))
+
+
+@cache.command('verify')
+@click.option(
+    "--remove/--no-remove",
+    default=True,
+    help="Delete tiles/DEMs which fail so they are made again (default: remove)")
+@click.pass_obj
+def cache_verify(context, remove):
+    """Check the size and checksum of each cached tile and DEM."""
+    bad_tiles = context['tile_cache'].verify(remove=remove)
+    for tile_name in bad_tiles:
+        click.echo("Failed: {}".format(tile_name))
+    click.echo("{} failed verification".format(len(bad_tiles)))
 
 
 # COMMAND: PROCESS
@@ -125,9 +225,16 @@ def parse_steps(ctx, param, value):
 @click.option(
     "--step",
     callback=parse_steps,
-    help="Run a one or a range of steps and exit. "
+    help="Run a one or a range of steps and exit, even if up to date. "
     "Examples:\n--step 4,5,7\n--step 3-6\n--step 1,9-10",
     required=False)
+@click.option("--force", is_flag=True, help="Rerun steps whose outputs are up to date")
+@click.option("--dry-run", is_flag=True, help="Show which steps would run or be skipped, and exit")
+@click.option(
+    "--check-hashes",
+    is_flag=True,
+    help="Also skip steps whose inputs are newer than their outputs, but hash "
+    "the same as when the step last ran")
 @click.option(
     '--geojson',
     '-g',
@@ -139,12 +246,16 @@ def parse_steps(ctx, param, value):
     "--max-temporal",
     type=int,
     default=500,
-    help="Maximum temporal baseline for igrams (fed to sbas_list)")
+    help="Maximum temporal baseline for igrams, in days")
 @click.option(
     "--max-spatial",
     type=int,
     default=500,
-    help="Maximum spatial baseline for igrams (fed to sbas_list)")
+    help="Maximum spatial baseline for igrams, in meters")
+@click.option(
+    "--connect",
+    is_flag=True,
+    help="Add igrams between consecutive dates where needed to connect all .geo files")
 @click.option(
     "--looks",
     type=int,
@@ -177,7 +288,9 @@ def parse_steps(ctx, param, value):
 def process(context, **kwargs):
     """Process stack of Sentinel interferograms.
 
-    Contains the steps from SLC .geo creation to SBAS deformation inversion"""
+    Contains the steps from SLC .geo creation to SBAS deformation inversion.
+    Steps whose outputs are newer than their inputs are skipped, and
+    independent steps run at the same time"""
     kwargs['verbose'] = context['verbose']
 
     insar.scripts.process.main(context['path'], kwargs)
@@ -210,12 +323,12 @@ def view_dem(demfile):
     """View a .dem file with matplotlib.
 
     Can list multiple .dem files to open in separate figures.
+    If overviews were made (insar overview), the level matching the
+    screen is shown, otherwise large files are multilooked to fit the
+    screen. Full resolution is loaded when zoomed in.
     """
     for fname in demfile:
-        dem = insar.sario.load_file(fname)
-        plt.figure()
-        plt.imshow(dem)
-        plt.colorbar()
+        insar.plotting.view_raster(fname)
 
     # Wait for windows to close to exit the script
     plt.show(block=True)
@@ -258,10 +371,18 @@ def animate(context, pause, ref_row, ref_col, save, display):
     Note: --ref-row and --ref-col only needed if the inversion
     has not already been done and saved as deformation.npy
     """
-    geolist, deformation = insar.timeseries.load_deformation(context['path'], ref_row, ref_col)
+    geolist, deformation = insar.timeseries.load_deformation(
+        context['path'], ref_row, ref_col, mmap=True)
+    if geolist is None or deformation is None:
+        return
+    overview = _load_stack_overview(context['path'])
     titles = [d.strftime("%Y-%m-%d") for d in geolist]
     insar.plotting.animate_stack(
-        deformation, pause_time=pause, display=display, titles=titles, save_title=save)
+        deformation if overview is None else overview,
+        pause_time=pause,
+        display=display,
+        titles=titles,
+        save_title=save)
 
 
 # COMMAND: view-stack
@@ -291,16 +412,56 @@ def view_stack(context, ref_row, ref_col, cmap, label, rowcol):
     Note: --ref-row and --ref-col only needed if the inversion
     has not already been done and saved as deformation.npy
     """
-    geolist, deformation = insar.timeseries.load_deformation(context['path'], ref_row, ref_col)
+    geolist, deformation = insar.timeseries.load_deformation(
+        context['path'], ref_row, ref_col, mmap=True)
     if geolist is None or deformation is None:
         return
+    overview = _load_stack_overview(context['path'])
     if rowcol:
         rsc_data = None
     else:
         rsc_data = insar.sario.load_dem_rsc(os.path.join(context['path'], 'dem.rsc'))
 
     insar.plotting.view_stack(
-        deformation, geolist, display_img=-1, label=label, cmap=cmap, rsc_data=rsc_data)
+        deformation,
+        geolist,
+        display_img=-1,
+        label=label,
+        cmap=cmap,
+        rsc_data=rsc_data,
+        overview=None if overview is None else overview[-1])
+
+
+def _load_stack_overview(path):
+    """Loads a reduced deformation.npy fitting the screen, if it is larger than the screen
+
+    Uses the overview levels if any were made, otherwise takes looks of the stack
+    """
+    deformation_file = os.path.join(path, 'deformation.npy')
+    if not os.path.exists(deformation_file):
+        return None
+    overview, factor = insar.overviews.load_overview(deformation_file, mmap=True)
+    return overview if factor > 1 else None
+
+
+# COMMAND: overview
+@cli.command()
+@click.argument("filenames", type=click.Path(exists=True, dir_okay=False), nargs=-1)
+@click.option(
+    "--min-size",
+    default=insar.overviews.MIN_SIZE,
+    help="Stop once levels fit in this many rows and cols (default {})".format(
+        insar.overviews.MIN_SIZE))
+def overview(filenames, min_size):
+    """Make reduced resolution copies of rasters for fast viewing.
+
+    Levels are saved to FILENAME.ovr/ and used by view-dem, view-stack and animate:
+
+        insar overview elevation.dem deformation.npy
+    """
+    for fname in filenames:
+        for outname in insar.overviews.build_overviews(fname, min_size=min_size):
+            click.echo(outname)
 
 
 # COMMAND: avg-stack
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-"""Change .unw outputs into .tif files using dishgtfile
+"""Change .unw outputs into colored GeoTIFF files
 
     Usage: convert_snaphu.py [--file "/path/to/unwrapped.unw"] [--output unwrapped.unw.tif]
         convert_snaph.py [--path "/path/to/igrams/"] # will convert all files in path
@@ -9,33 +9,28 @@
 """
 import argparse
 import sys
-import subprocess
 import os.path
-from os.path import abspath, dirname
+from os.path import dirname
 
 import insar.sario
+import insar.geotiff
 from insar.log import get_log
 
 UNWRAPPED_EXT = '.unw'
 logger = get_log()
 
 
-def unw_to_tif(filename, num_cols, num_rows, max_height):
-    """Uses dishgtfile program to convert a .unw to .tif"""
-    # The "1" is "firstline" option
-    convert_command = "dishgtfile {filename} {num_cols} 1 {num_rows} {max_height}"
-    convert_cmd = convert_command.format(
-        filename=filename, num_cols=num_cols, num_rows=num_rows, max_height=max_height)
-    logger.info("Running %s", convert_cmd)
-    subprocess.check_call(convert_cmd.split(' '))
+def unw_to_tif(filename, num_cols, num_rows, max_height, rsc_data=None):
+    """Converts a .unw to a georeferenced .unw.tif (in place of dishgtfile)
 
-    # Default output for dishgtfile is named "dishgt.tif" in current dir
-    # TODO: is there anyway to specify the name instead? cant find source code
-    output_name = "dishgt.tif"
-    newfile_name = filename + '.tif'  # full extension is .unw.tif
-    move_cmd = "mv {out} {new}".format(out=output_name, new=newfile_name)
-    logger.info("Running %s", move_cmd)
-    subprocess.check_call(move_cmd.split(' '))
+    Output is written next to the input, with full extension .unw.tif
+    """
+    if rsc_data is None:
+        rsc_data = {'WIDTH': num_cols, 'FILE_LENGTH': num_rows}
+    newfile_name = filename + '.tif'
+    logger.info("Converting %s to %s", filename, newfile_name)
+    return insar.geotiff.unw_to_tif(
+        filename, rsc_data, max_height=float(max_height), outname=newfile_name)
 
 
 def main():
@@ -49,6 +44,8 @@ def main():
         default=100,
         help="Maximum height/max absolute phase in .unw files "
         "(used for contour_interval option to dishgt)")
+    parser.add_argument(
+        "--processes", "-j", type=int, help="Number of files to convert at once (default: num CPUs)")
     args = parser.parse_args()
 
     if args.file and args.path:
@@ -70,9 +67,9 @@ def main():
 
     dem_rsc_file = os.path.join(dir_path, 'dem.rsc')
     rsc_data = insar.sario.load_dem_rsc(dem_rsc_file)
-    for file_ in files_to_convert:
-        logger.info("Converting %s", file_)
-        unw_to_tif(file_, rsc_data['WIDTH'], rsc_data['FILE_LENGTH'], args.max_height)
+    logger.info("Converting %s files", len(files_to_convert))
+    insar.geotiff.convert_files(
+        files_to_convert, rsc_data, processes=args.processes, max_height=float(args.max_height))
 
 
 if __name__ == '__main__':
@@ -8,34 +8,55 @@
     2. Create an upsampled DEM
     3. run sentinel_stack to produce .geo file for all sentinel .zips
     4. Post processing for sentinel stack (igrams folder prep)
-    5. create the sbas_list
-    6. run ps_sbas_igrams.py
+    5. choose the small baseline pairs (sbas_list)
+    6. form the igrams from the .geo pairs in sbas_list
     7. convert .int files to .tif
     8. run snaphu to unwrap all .int files
     9. Convert snaphu outputs to .tif files
     10. Run an SBAS inversion to get the LOS deformation
 
+    Each step declares the files it reads and writes (STEP_FILES), and the
+    steps it has to wait for (STEP_DEPENDS). Like make, a step is skipped
+    when all its outputs exist and are newer than its inputs, and steps
+    which don't depend on each other (e.g. 1 and 2) run at the same time.
+    A step also runs again when an option its outputs depend on (STEP_OPTIONS,
+    e.g. --rate for the DEM) changed since its last run.
+
 """
+import glob
+import json
 import math
 import sys
 import subprocess
 import os
+import threading
 import numpy as np
 
 import insar
+import insar.igrams
+import insar.pairs
+import insar.scripts.snaphu
+try:
+    from insar.engine import get_default_engine
+except (ImportError, SyntaxError):  # Needs python 3.5+
+    get_default_engine = None
 from insar.log import get_log, log_runtime
 from insar.utils import mkdir_p
 
 logger = get_log()
 SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Steps 5 onward read and write here, relative to the project directory
+IGRAM_DIR = 'igrams'
+# Options, and input fingerprints (for --check-hashes), of each step's last successful run
+STATE_FILE = '.insar_process.json'
 
 
-def download_eof(mission=None, date=None, **kwargs):
+def download_eof(mission=None, date=None, catalog=None, engine=None, **kwargs):
     """1. Download precision orbit files"""
-    insar.eof.main(mission=mission, date=date)
+    insar.eof.main(mission=mission, date=date, catalog=catalog, engine=engine)
 
 
-def create_dem(geojson=None, rate=1, data_source='NASA', **kwargs):
+def create_dem(geojson=None, rate=1, data_source='NASA', engine=None, **kwargs):
     """2. Download, upsample, and stich a DEM"""
     if not geojson:
         logger.error("For step 2: create_dem, --geojson is needed.")
@@ -43,7 +64,7 @@ def create_dem(geojson=None, rate=1, data_source='NASA', **kwargs):
     # Don't think this name needs to be an option for process
     output_name = 'elevation.dem'
     logger.info("Running: insar.dem:main")
-    insar.dem.main(geojson, data_source, rate, output_name)
+    insar.dem.main(geojson, data_source, rate, output_name, engine=engine)
 
 
 def run_sentinel_stack(**kwargs):
@@ -57,23 +78,26 @@ def prep_igrams_dir(clean=True, **kwargs):
         logger.info("Removing malformed .geo files missing data")
         insar.utils.clean_files(".geo", path=".", zero_threshold=0.50, test=False)
 
-    mkdir_p('igrams')
-    os.chdir('igrams')
-    logger.info("Changed directory to %s", os.path.realpath(os.getcwd()))
+    mkdir_p(IGRAM_DIR)
 
 
-def create_sbas_list(max_temporal=500, max_spatial=500, **kwargs):
-    """ 5.run the sbas_list script
+def create_sbas_list(max_temporal=500, max_spatial=500, connect=False, catalog=None, **kwargs):
+    """ 5. Choose the small baseline pairs of .geo files
 
-    Uses the outputs of the geo coded SLCS to find files with small baselines"""
+    See insar.pairs: writes sbas_list, intlist and geolist to the igrams directory"""
+    insar.pairs.create_sbas_list(
+        '.',
+        IGRAM_DIR,
+        max_temporal=max_temporal,
+        max_spatial=max_spatial,
+        connect=connect,
+        catalog=catalog)
 
-    sbas_cmd = '/usr/bin/env python ~/sentinel/sbas_list.py {} {}'.format(max_temporal, max_spatial)
-    logger.info(sbas_cmd)
-    subprocess.check_call(sbas_cmd, shell=True)
 
+def create_igrams(rate=1, looks=None, **kwargs):
+    """6. Form the igrams (.int, .cc) of every pair in sbas_list
 
-def run_ps_sbas_igrams(rate=1, looks=None, **kwargs):
-    """6. run the ps_sbas_igrams script"""
+    See insar.igrams: all pairs are made at once, reading each .geo once"""
 
     def calc_sizes(rate, width, length):
         xsize = int(math.floor(width / rate) * rate)
@@ -81,56 +105,48 @@ def run_ps_sbas_igrams(rate=1, looks=None, **kwargs):
         return (xsize, ysize)
 
     logger.info("Gathering file size info from elevation.dem.rsc")
-    elevation_dem_rsc_file = '../elevation.dem.rsc'
-    rsc_data = insar.sario.load_dem_rsc(elevation_dem_rsc_file)
+    rsc_data = insar.sario.load_dem_rsc('elevation.dem.rsc')
     xsize, ysize = calc_sizes(rate, rsc_data['WIDTH'], rsc_data['FILE_LENGTH'])
 
-    # the "1 1" is xstart ystart
     # Default number of looks is the upsampling rate so that
     # the igram is the size of the original DEM (elevation_small.dem)
     looks = looks or rate
-    logger.info("Running ps_sbas_igrams.py")
-    ps_sbas_cmd = "/usr/bin/env python ~/sentinel/ps_sbas_igrams.py sbas_list {rsc_file} 1 1 {xsize} {ysize} {looks}".format(
-        rsc_file=elevation_dem_rsc_file, xsize=xsize, ysize=ysize, looks=looks)
-    logger.info(ps_sbas_cmd)
-    subprocess.check_call(ps_sbas_cmd, shell=True)
-
-
-def convert_int_tif(**kwargs):
-    # TODO: Make this into the script like the convert_snaphu
-
-    # Default name by ps_sbas_igrams
-    igram_rsc = insar.sario.load_dem_rsc('dem.rsc')
-    convert_cmd = """for i in ./*.int ; do dismphfile "$i" {igram_width} ; mv dismph.tif `echo "$i" | sed 's/int$/tif/'` ; done""".format(
-        igram_width=igram_rsc['WIDTH'])
-    logger.info(convert_cmd)
-    subprocess.check_call(convert_cmd, shell=True)
+    insar.igrams.form_igrams(
+        os.path.join(IGRAM_DIR, 'sbas_list'),
+        'elevation.dem.rsc',
+        looks=looks,
+        xsize=xsize,
+        ysize=ysize,
+        outdir=IGRAM_DIR)
+
+
+def convert_int_tif(catalog=None, **kwargs):
+    """7. Convert .int files to .tif, all files converted in parallel"""
+    # Written by create_igrams
+    igram_rsc = insar.sario.load_dem_rsc(os.path.join(IGRAM_DIR, 'dem.rsc'))
+    if catalog is not None:
+        catalog.refresh()
+        int_files = catalog.find('*.int', directory=IGRAM_DIR)
+    else:
+        int_files = insar.sario.find_files(IGRAM_DIR, '*.int')
+    logger.info("Converting %s .int files to .tif", len(int_files))
+    insar.geotiff.convert_files(int_files, igram_rsc)
 
 
 def run_snaphu(lowpass=None, **kwargs):
-    """8. run snaphu to unwrap all .int files
+    """8. run snaphu to unwrap all .int files in the igrams directory
 
-    Assumes we are in the directory with all .unw files
-    """
-    # TODO: probably shouldn't call these like this? idk alternative right now
-    igram_rsc = insar.sario.load_dem_rsc('dem.rsc')
-    snaphu_script = os.path.join(SCRIPTS_DIR, 'run_snaphu.sh')
-    snaphu_cmd = '{filepath} {width} {lowpass}'.format(
-        filepath=snaphu_script, width=igram_rsc['WIDTH'], lowpass=lowpass)
-    logger.info(snaphu_cmd)
-    subprocess.check_call(snaphu_cmd, shell=True)
+    See insar.scripts.snaphu: runs several at once, skipping finished .unw files"""
+    insar.scripts.snaphu.run_all(IGRAM_DIR, lowpass=lowpass)
 
 
 def convert_snaphu_tif(max_height=None, **kwargs):
-    """9. Convert snaphu outputs to .tif files
-
-    Assumes we are in the directory with all .unw files
-    """
+    """9. Convert snaphu outputs in the igrams directory to .tif files"""
     snaphu_script = os.path.join(SCRIPTS_DIR, 'convert_snaphu.py')
     snaphu_cmd = 'python {filepath} --max-height {hgt}'.format(
         filepath=snaphu_script, hgt=max_height)
     logger.info(snaphu_cmd)
-    subprocess.check_call(snaphu_cmd, shell=True)
+    subprocess.check_call(snaphu_cmd, shell=True, cwd=IGRAM_DIR)
 
 
 def run_sbas_inversion(ref_row=None,
@@ -142,8 +158,8 @@ def run_sbas_inversion(ref_row=None,
                        **kwargs):
     """10. Perofrm SBAS inversion, save the deformation as .npy
 
-    Assumes we are in the directory with all .unw files"""
-    igram_path = os.path.realpath(os.getcwd())
+    Reads the .unw files in the igrams directory, and saves the outputs there"""
+    igram_path = os.path.realpath(IGRAM_DIR)
     geolist, phi_arr, deformation, varr, unw_stack = insar.timeseries.run_inversion(
         igram_path,
         reference=(ref_row, ref_col),
@@ -153,9 +169,9 @@ def run_sbas_inversion(ref_row=None,
         difference=difference,
         verbose=kwargs['verbose'])
     logger.info("Saving deformation.npy, velocity_array.npy, and geolist.npy")
-    np.save('deformation.npy', deformation)
-    np.save('velocity_array.npy', varr)
-    np.save('geolist.npy', geolist)
+    np.save(os.path.join(igram_path, 'deformation.npy'), deformation)
+    np.save(os.path.join(igram_path, 'velocity_array.npy'), varr)
+    np.save(os.path.join(igram_path, 'geolist.npy'), geolist)
 
 
 # List of functions that run each step
@@ -165,7 +181,7 @@ STEPS = [
     run_sentinel_stack,
     prep_igrams_dir,
     create_sbas_list,
-    run_ps_sbas_igrams,
+    create_igrams,
     convert_int_tif,
     run_snaphu,
     convert_snaphu_tif,
@@ -174,10 +190,206 @@ STEPS = [
 # Form string for help function "1:download_eof,2:..."
 STEP_LIST = ',\n'.join("%d:%s" % (num, func.__name__) for (num, func) in enumerate(STEPS, start=1))
 
+# (inputs, outputs) of each step: glob patterns relative to the project directory.
+# Fields like {geojson} are filled in from the process options
+STEP_FILES = {
+    'download_eof': (['S1*.zip'], ['S1*.EOF']),
+    'create_dem': (['{geojson}'], ['elevation.dem', 'elevation.dem.rsc']),
+    'run_sentinel_stack': (['S1*.zip', 'S1*.EOF', 'elevation.dem', 'elevation.dem.rsc'], ['*.geo']),
+    'prep_igrams_dir': (['*.geo'], [IGRAM_DIR]),
+    'create_sbas_list': (['*.geo', 'S1*.EOF'],
+                         [IGRAM_DIR + '/sbas_list', IGRAM_DIR + '/intlist', IGRAM_DIR + '/geolist']),
+    'create_igrams': ([IGRAM_DIR + '/sbas_list', '*.geo', 'elevation.dem.rsc'], [
+        IGRAM_DIR + '/*.int', IGRAM_DIR + '/*.cc', IGRAM_DIR + '/dem.rsc', IGRAM_DIR + '/intlist'
+    ]),
+    # *[0-9].tif: the .tifs from .ints (20180420_20180502.tif), not the .unw.tifs
+    'convert_int_tif': ([IGRAM_DIR + '/*.int', IGRAM_DIR + '/dem.rsc'], [IGRAM_DIR + '/*[0-9].tif']),
+    'run_snaphu': ([IGRAM_DIR + '/*.int', IGRAM_DIR + '/*.cc'], [IGRAM_DIR + '/*.unw']),
+    'convert_snaphu_tif': ([IGRAM_DIR + '/*.unw'], [IGRAM_DIR + '/*.unw.tif']),
+    'run_sbas_inversion': ([IGRAM_DIR + '/*.unw'], [
+        IGRAM_DIR + '/deformation.npy', IGRAM_DIR + '/velocity_array.npy',
+        IGRAM_DIR + '/geolist.npy'
+    ]),
+}
+# Process options each step's outputs depend on: changing one reruns the step
+STEP_OPTIONS = {
+    'download_eof': [],
+    'create_dem': ['geojson', 'rate'],
+    'run_sentinel_stack': [],
+    'prep_igrams_dir': [],
+    'create_sbas_list': ['max_temporal', 'max_spatial', 'connect'],
+    'create_igrams': ['rate', 'looks'],
+    'convert_int_tif': [],
+    'run_snaphu': ['lowpass'],
+    'convert_snaphu_tif': ['max_height'],
+    'run_sbas_inversion': ['ref_row', 'ref_col', 'window', 'alpha', 'constant_vel', 'difference'],
+}
+# Steps which must finish before each step can start
+STEP_DEPENDS = {
+    'download_eof': [],
+    'create_dem': [],
+    'run_sentinel_stack': ['download_eof', 'create_dem'],
+    'prep_igrams_dir': ['run_sentinel_stack'],
+    'create_sbas_list': ['prep_igrams_dir'],
+    'create_igrams': ['create_sbas_list'],
+    'convert_int_tif': ['create_igrams'],
+    'run_snaphu': ['create_igrams'],
+    'convert_snaphu_tif': ['run_snaphu'],
+    'run_sbas_inversion': ['run_snaphu'],
+}
+
+
+def _find_step_files(patterns, kwargs):
+    """Files matching a step's glob patterns, after filling in option fields"""
+    filenames = set()
+    for pattern in patterns:
+        filenames.update(glob.glob(pattern.format(**kwargs)))
+    return sorted(filenames)
+
+
+def _fingerprint(filename, old=None):
+    """[size, mtime, sha1] of a file, reusing the sha1 of old if size and mtime match"""
+    stat = os.stat(filename)
+    if old and old[:2] == [stat.st_size, stat.st_mtime]:
+        return old
+    return [stat.st_size, stat.st_mtime, insar.download.sha1_of(filename).hexdigest()]
+
+
+def _step_options(name, kwargs):
+    """The values of the options in STEP_OPTIONS for one step"""
+    return {option: kwargs.get(option) for option in STEP_OPTIONS[name]}
+
+
+def check_step(name, kwargs, state=None, check_hashes=False):
+    """Checks whether a step's outputs are up to date with its inputs
+
+    Outputs are up to date if they were made with the same options
+    (when the last run was recorded in state), they all exist, and they
+    either are newer than every input, or, with check_hashes, the
+    inputs hash the same as the last time the step ran.
+
+    Args:
+        name (str): name of the step function
+        kwargs (dict): process options, to fill in the file patterns
+        state (dict): contents of STATE_FILE: the 'options' and the
+            'inputs' fingerprints of each step's last run
+        check_hashes (bool): use the input fingerprints in state
+
+    Returns:
+        tuple[bool, str]: whether the step is up to date, and why (or why not)
+    """
+    state = state or {}
+    last_options = state.get('options', {}).get(name)
+    if last_options is not None:
+        options = _step_options(name, kwargs)
+        changed = sorted(k for k in options if options[k] != last_options.get(k))
+        if changed:
+            return False, "options changed: " + ', '.join(
+                "{} {} -> {}".format(k, last_options.get(k), options[k]) for k in changed)
+
+    input_patterns, output_patterns = STEP_FILES[name]
+    for pattern in output_patterns:
+        if not _find_step_files([pattern], kwargs):
+            return False, "no {}".format(pattern.format(**kwargs))
+
+    inputs = _find_step_files(input_patterns, kwargs)
+    if not inputs:
+        return True, "outputs exist"
+    outputs = _find_step_files(output_patterns, kwargs)
+    newest_input = max(inputs, key=os.path.getmtime)
+    oldest_output = min(outputs, key=os.path.getmtime)
+    if os.path.getmtime(newest_input) <= os.path.getmtime(oldest_output):
+        return True, "outputs newer than inputs"
+
+    last_inputs = state.get('inputs', {}).get(name) if check_hashes else None
+    if last_inputs and sorted(last_inputs) == inputs:
+        # Same size and sha1 (the mtimes differ, or we wouldn't be here)
+        fingerprints = [(_fingerprint(f, last_inputs[f]), last_inputs[f]) for f in inputs]
+        if all(new[0] == old[0] and new[2] == old[2] for new, old in fingerprints):
+            return True, "inputs unchanged since the last run"
+    return False, "{} newer than {}".format(newest_input, oldest_output)
+
+
+def plan_steps(step_list, kwargs, force=False, state=None, check_hashes=False):
+    """Groups steps into waves which can run at once, and predicts which will run
+
+    A step joins the current wave unless it depends on a step in it.
+    A step will run if forced, if it isn't up to date, or if a step
+    it depends on will run.
+
+    Args:
+        step_list (list[int]): indices into STEPS to consider, in order
+        kwargs (dict): process options
+        force (bool): run every step, even if up to date
+        state (dict): contents of STATE_FILE (see check_step)
+        check_hashes (bool): skip steps whose inputs hash the same as last time
+
+    Returns:
+        list[list[tuple]]: waves of (step index, will run, reason)
+    """
+    waves = []
+    will_run = set()
+    for stepnum in step_list:
+        name = STEPS[stepnum].__name__
+        ran_deps = [dep for dep in STEP_DEPENDS[name] if dep in will_run]
+        if force:
+            run, reason = True, "forced"
+        elif ran_deps:
+            run, reason = True, "{} will run".format(', '.join(ran_deps))
+        else:
+            up_to_date, reason = check_step(name, kwargs, state, check_hashes)
+            run = not up_to_date
+
+        wave_names = [STEPS[num].__name__ for num, _, _ in waves[-1]] if waves else []
+        if not waves or any(dep in wave_names for dep in STEP_DEPENDS[name]):
+            waves.append([])
+        waves[-1].append((stepnum, run, reason))
+        if run:
+            will_run.add(name)
+    return waves
+
+
+def _run_steps(funcs, kwargs):
+    """Runs the step functions in threads, raising the first error once all finish"""
+    if len(funcs) == 1:
+        funcs[0](**kwargs)
+        return
+
+    errors = []
+
+    def _run(func):
+        try:
+            func(**kwargs)
+        except BaseException as e:  # sys.exit from a step should stop the run too
+            logger.error("Step %s failed: %s", func.__name__, e)
+            errors.append(e)
+
+    threads = [threading.Thread(target=_run, args=(func, )) for func in funcs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _load_state():
+    if not os.path.exists(STATE_FILE):
+        return {}
+    with open(STATE_FILE) as f:
+        return json.load(f)
+
 
 @log_runtime
 def main(working_dir, kwargs):
-    # TODO: maybe let user specify individual steps?
+    """Runs the chosen steps in working_dir, skipping those already up to date
+
+    Steps chosen with --step always run. With --start, up to date steps
+    are skipped unless --force is passed. --dry-run only logs the plan.
+
+    Returns:
+        list[list[tuple]]: the plan of waves from plan_steps
+    """
     if working_dir != ".":
         logger.info("Changing directory to {}".format(working_dir))
         os.chdir(working_dir)
@@ -185,8 +397,43 @@ def main(working_dir, kwargs):
     # Use the --step option first, or else use the --start
     # Subtract 1 so that they are list indices, starting at 0
     step_list = [s - 1 for s in kwargs['step']] or range(kwargs['start'] - 1, len(STEPS))
-    logger.info("Running steps %s", ','.join(str(s + 1) for s in step_list))
-    for stepnum in step_list:
-        curfunc = STEPS[stepnum]
-        logger.info("Starting step %d: %s", stepnum + 1, curfunc.__name__)
-        curfunc(**kwargs)
+    force = bool(kwargs['step']) or kwargs.get('force', False)
+    check_hashes = kwargs.get('check_hashes', False)
+    state = _load_state()
+
+    plan = plan_steps(step_list, kwargs, force=force, state=state, check_hashes=check_hashes)
+    for wave_num, wave in enumerate(plan, start=1):
+        for stepnum, run, reason in wave:
+            logger.info("Wave %d: step %d: %s: %s (%s)", wave_num, stepnum + 1,
+                        STEPS[stepnum].__name__, "run" if run else "skip", reason)
+    if kwargs.get('dry_run'):
+        return plan
+
+    # Steps 1 and 2 run at once: one engine keeps their downloads under the same limits
+    kwargs['engine'] = get_default_engine() if get_default_engine else None
+    # Index of the project's files, shared by the steps which search for products.
+    # Steps in one wave run in threads: the catalog locks around its connection
+    with insar.catalog.Catalog('.') as catalog:
+        kwargs['catalog'] = catalog
+        for wave in plan:
+            # Check again: earlier steps may have written nothing new
+            funcs = []
+            for stepnum, _, _ in wave:
+                name = STEPS[stepnum].__name__
+                if force or not check_step(name, kwargs, state, check_hashes)[0]:
+                    logger.info("Starting step %d: %s", stepnum + 1, name)
+                    funcs.append(STEPS[stepnum])
+                else:
+                    logger.info("Skipping step %d: %s is up to date", stepnum + 1, name)
+            _run_steps(funcs, kwargs)
+
+            for func in funcs:
+                name = func.__name__
+                state.setdefault('options', {})[name] = _step_options(name, kwargs)
+                if check_hashes:
+                    inputs = _find_step_files(STEP_FILES[name][0], kwargs)
+                    old = state.setdefault('inputs', {}).get(name, {})
+                    state['inputs'][name] = {f: _fingerprint(f, old.get(f)) for f in inputs}
+            if funcs:
+                insar.cache.save_json(STATE_FILE, state)
+    return plan
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""Runs snaphu on every .int file in a directory, several at a time
+
+    Usage: snaphu.py [--path /path/to/igrams] [--lowpass 5] [--max-jobs 4] [--timeout 3600]
+
+Each 20180420_20180502.int is unwrapped using 20180420_20180502.cc
+for the correlation, into 20180420_20180502.unw. The igram width comes
+from dem.rsc in the same directory.
+
+Jobs are written to a hidden partial file and renamed when snaphu
+succeeds, so a .unw which exists (and is newer than its .int and .cc)
+is finished, and is skipped on the next run. Jobs which fail or run
+past the timeout are retried, and the number of jobs running at once
+is limited by the memory snaphu is expected to need for each.
+
+The snaphu and lowpass programs are found from the SNAPHU_PATH and
+LOWPASS_PATH environment variables, then the PATH, then ~/phase_upwrap/bin.
+"""
+from __future__ import division
+import argparse
+import collections
+import json
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import insar.sario
+from insar.download import partial_path
+from insar.log import get_log
+from insar.utils import which
+
+logger = get_log()
+
+SNAPHU_ENV = 'SNAPHU_PATH'
+LOWPASS_ENV = 'LOWPASS_PATH'
+DEFAULT_BIN_DIR = '~/phase_upwrap/bin'
+# Rough peak memory of snaphu per igram pixel (cost arrays, flows, and the data)
+BYTES_PER_PIXEL = 100
+# Fraction of the available memory the running jobs may use
+MEMORY_FRACTION = 0.8
+RETRIES = 1
+# Characters of a failed job's output to keep for the report
+OUTPUT_TAIL = 1000
+# Python 2's subprocess has no timeouts: jobs there run until they finish
+HAS_TIMEOUT = hasattr(subprocess, 'TimeoutExpired')
+
+# One unwrapping job: the inputs, and the .unw to write
+Job = collections.namedtuple('Job', ['intfile', 'ccfile', 'unwfile'])
+# Outcome of a job. status is 'done', 'skipped', 'failed', or 'timeout'
+JobResult = collections.namedtuple('JobResult',
+                                   ['intfile', 'unwfile', 'status', 'attempts', 'seconds', 'error'])
+
+
+def find_program(name, env_var, path=None):
+    """Path to an executable: path if passed, then $env_var, the PATH, or DEFAULT_BIN_DIR"""
+    for candidate in (path, os.environ.get(env_var), which(name)):
+        if candidate:
+            return candidate
+    return os.path.join(os.path.expanduser(DEFAULT_BIN_DIR), name)
+
+
+def find_jobs(igram_dir):
+    """Finds the .int files in igram_dir, and the .cc and .unw names for each
+
+    Examples:
+        >>> open('20180420_20180502.int', 'w').close()
+        >>> find_jobs('.')
+        [Job(intfile='./20180420_20180502.int', ccfile='./20180420_20180502.cc', \
+unwfile='./20180420_20180502.unw')]
+        >>> os.remove('20180420_20180502.int')
+    """
+    intfiles = sorted(insar.sario.find_files(igram_dir, '*.int'))
+    return [Job(f, f.replace('.int', '.cc'), f.replace('.int', '.unw')) for f in intfiles]
+
+
+def is_done(job):
+    """A job is done if its .unw is complete and newer than its inputs
+
+    A complete .unw has an amplitude and a phase float per pixel, the
+    same size as the .int (one complex64 per pixel)
+    """
+    if not os.path.exists(job.unwfile):
+        return False
+    if os.path.getsize(job.unwfile) != os.path.getsize(job.intfile):
+        return False
+    inputs = [f for f in (job.intfile, job.ccfile) if os.path.exists(f)]
+    return all(os.path.getmtime(job.unwfile) >= os.path.getmtime(f) for f in inputs)
+
+
+def available_memory():
+    """Bytes of memory available for new processes (None if unknown)
+
+    Reads MemAvailable from /proc/meminfo on Linux, else uses sysconf
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def max_concurrent_jobs(job_bytes, max_jobs=None, memory=None):
+    """Number of jobs to run at once: one per CPU, fewer if memory runs out
+
+    Args:
+        job_bytes (int): expected peak memory of one job
+        max_jobs (int): upper limit (default: number of CPUs)
+        memory (int): bytes available (default: available_memory())
+
+    Returns:
+        int: at least 1
+
+    Examples:
+        >>> max_concurrent_jobs(10 * 2**30, max_jobs=8, memory=32 * 2**30)
+        2
+        >>> max_concurrent_jobs(2**20, max_jobs=8, memory=32 * 2**30)
+        8
+    """
+    limit = max_jobs or mp.cpu_count()
+    memory = memory if memory is not None else available_memory()
+    if memory and job_bytes:
+        limit = min(limit, int(memory * MEMORY_FRACTION // job_bytes))
+    return max(limit, 1)
+
+
+def _run_command(cmd, timeout):
+    """Runs cmd, returning (status, error): status is 'done', 'failed' or 'timeout'"""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if timeout is None or not HAS_TIMEOUT:
+        output, _ = proc.communicate()
+    else:
+        try:
+            output, _ = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return 'timeout', "timed out after {} seconds".format(timeout)
+    if proc.returncode != 0:
+        tail = output.decode('utf-8', 'replace')[-OUTPUT_TAIL:]
+        return 'failed', "exit code {}: {}".format(proc.returncode, tail)
+    return 'done', None
+
+
+def run_job(job, width, snaphu_path, lowpass_path=None, box_size=None, timeout=None,
+            retries=RETRIES):
+    """Unwraps one igram, retrying failures and timeouts
+
+    Args:
+        job (Job): the files to unwrap
+        width (int): number of columns of the igram
+        snaphu_path (str): path to the snaphu executable
+        lowpass_path (str): path to the lowpass executable, used if box_size >= 2
+        box_size (int): size of the lowpass filter to run before unwrapping
+        timeout (float): seconds to let one attempt run (None for no limit)
+        retries (int): attempts to make after the first one fails
+
+    Returns:
+        JobResult
+    """
+    if is_done(job):
+        return JobResult(job.intfile, job.unwfile, 'skipped', 0, 0.0, None)
+
+    start = time.time()
+    part = partial_path(job.unwfile)
+    infile = job.intfile
+    for attempt in range(1, retries + 2):
+        status, error = 'done', None
+        if box_size and box_size >= 2:
+            # lowpass writes its output next to the input, as .int.lowpass
+            infile = job.intfile + '.lowpass'
+            if not (os.path.exists(infile) and
+                    os.path.getmtime(infile) >= os.path.getmtime(job.intfile)):
+                status, error = _run_command(
+                    [lowpass_path, job.intfile, str(width), str(box_size)], timeout)
+        if status == 'done':
+            cmd = [snaphu_path, '-s', infile, str(width), '-c', job.ccfile, '-o', part]
+            status, error = _run_command(cmd, timeout)
+        expected_size = os.path.getsize(job.intfile)
+        if status == 'done' and not os.path.exists(part):
+            status, error = 'failed', "no output written"
+        elif status == 'done' and os.path.getsize(part) != expected_size:
+            status, error = 'failed', "output is {} bytes, expected {}".format(
+                os.path.getsize(part), expected_size)
+        if status == 'done':
+            os.rename(part, job.unwfile)
+            break
+        logger.warning("Attempt %d on %s: %s", attempt, job.intfile, error)
+
+    if os.path.exists(part):
+        os.remove(part)
+    return JobResult(job.intfile, job.unwfile, status, attempt, time.time() - start, error)
+
+
+def summarize(results):
+    """Counts of each status, and runtime stats of the jobs which ran
+
+    Examples:
+        >>> results = [JobResult('a.int', 'a.unw', 'done', 1, 10.0, None),
+        ...            JobResult('b.int', 'b.unw', 'done', 2, 30.0, None),
+        ...            JobResult('c.int', 'c.unw', 'skipped', 0, 0.0, None)]
+        >>> stats = summarize(results)
+        >>> stats['done'], stats['skipped'], stats['mean_seconds'], stats['max_seconds']
+        (2, 1, 20.0, 30.0)
+    """
+    stats = collections.OrderedDict((s, 0) for s in ('done', 'skipped', 'failed', 'timeout'))
+    for result in results:
+        stats[result.status] += 1
+    times = [r.seconds for r in results if r.status != 'skipped']
+    stats['total_seconds'] = sum(times)
+    stats['mean_seconds'] = sum(times) / len(times) if times else 0.0
+    stats['max_seconds'] = max(times) if times else 0.0
+    return stats
+
+
+def run_all(igram_dir='.',
+            lowpass=None,
+            max_jobs=None,
+            timeout=None,
+            retries=RETRIES,
+            snaphu_path=None,
+            lowpass_path=None,
+            bytes_per_pixel=BYTES_PER_PIXEL,
+            raise_errors=True):
+    """Unwraps all .int files in igram_dir
+
+    Args:
+        igram_dir (str): directory with the .int, .cc and dem.rsc files
+        lowpass (int): box size of lowpass filter to run first (None or < 2 to skip)
+        max_jobs (int): most jobs to run at once (default: number of CPUs,
+            lowered to fit in the available memory)
+        timeout (float): seconds to let one attempt of one job run (ignored on Python 2)
+        retries (int): attempts to make after a job's first one fails
+        snaphu_path (str): snaphu executable (see find_program)
+        lowpass_path (str): lowpass executable (see find_program)
+        bytes_per_pixel (int): expected memory snaphu uses per igram pixel
+        raise_errors (bool): raise if any jobs failed, after all have run
+
+    Returns:
+        list[JobResult]: one per .int file, in name order
+
+    Raises:
+        RuntimeError: if raise_errors and any job still failed after its retries
+    """
+    jobs = find_jobs(igram_dir)
+    if not jobs:
+        logger.warning("No .int files found in %s", igram_dir)
+        return []
+    if timeout is not None and not HAS_TIMEOUT:
+        logger.warning("Timeouts need Python 3: running snaphu with no time limit")
+    width = insar.sario.load_dem_rsc(os.path.join(igram_dir, 'dem.rsc'))['WIDTH']
+    snaphu_path = find_program('snaphu', SNAPHU_ENV, snaphu_path)
+    lowpass_path = find_program('lowpass', LOWPASS_ENV, lowpass_path)
+
+    # All igrams in a stack are the same size: 8 bytes per pixel
+    pixels = max(os.path.getsize(job.intfile) for job in jobs) // 8
+    num_workers = min(max_concurrent_jobs(pixels * bytes_per_pixel, max_jobs), len(jobs))
+    logger.info("Unwrapping %s igrams with %s, %s at a time", len(jobs), snaphu_path, num_workers)
+
+    def _run(job):
+        return run_job(job, width, snaphu_path, lowpass_path, lowpass, timeout, retries)
+
+    pool = ThreadPool(processes=num_workers)
+    try:
+        results = []
+        for result in pool.imap_unordered(_run, jobs):
+            logger.info("%s: %s (%d attempts, %.1f seconds) (%d/%d)", result.unwfile,
+                        result.status, result.attempts, result.seconds, len(results) + 1,
+                        len(jobs))
+            results.append(result)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    results.sort(key=lambda r: r.intfile)
+    logger.info("snaphu summary: %s", json.dumps(summarize(results)))
+    failures = [r for r in results if r.status in ('failed', 'timeout')]
+    if failures and raise_errors:
+        raise RuntimeError("snaphu failed on {} igrams: {}".format(
+            len(failures), ', '.join(r.intfile for r in failures)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", "-p", default='.', help="Directory of .int and .cc files")
+    parser.add_argument(
+        "--lowpass", type=int, help="Box size of lowpass filter to run before unwrapping")
+    parser.add_argument(
+        "--max-jobs", "-j", type=int, help="Most jobs to run at once (default: num CPUs)")
+    parser.add_argument("--timeout", type=float, help="Seconds to allow each snaphu run")
+    parser.add_argument(
+        "--retries", type=int, default=RETRIES, help="Times to retry failed igrams")
+    parser.add_argument("--stats", help="Save each job's status and runtime to this .json file")
+    args = parser.parse_args()
+
+    results = run_all(
+        args.path,
+        lowpass=args.lowpass,
+        max_jobs=args.max_jobs,
+        timeout=args.timeout,
+        retries=args.retries,
+        raise_errors=False)
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump([r._asdict() for r in results], f, indent=2)
+    failures = [r.intfile for r in results if r.status in ('failed', 'timeout')]
+    if failures:
+        logger.error("snaphu failed on: %s", ', '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
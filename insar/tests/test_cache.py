@@ -0,0 +1,210 @@
+import unittest
+import os
+import tempfile
+import shutil
+import multiprocessing as mp
+from os.path import join
+from unittest import mock
+import numpy as np
+from numpy.testing import assert_array_equal
+from click.testing import CliRunner
+
+from insar import cache, dem, sario
+from insar.scripts import cli
+
+
+def _add_tiles(args):
+    """Adds tiles to a cache from another process"""
+    cache_dir, tile_names = args
+    tile_cache = cache.TileCache(cache_dir)
+    for tile_name in tile_names:
+        with open(join(cache_dir, tile_name), 'wb') as f:
+            f.write(b'x' * 10)
+        tile_cache.add(tile_name)
+
+
+class TestTileCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = cache.TileCache(self.cache_dir)
+        self.tile_names = ['N19W156.hgt', 'N19W155.hgt', 'N18W156.hgt']
+        for tile_name in self.tile_names:
+            self._write_tile(tile_name)
+            self.cache.add(tile_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _write_tile(self, tile_name, size=100):
+        with open(join(self.cache_dir, tile_name), 'wb') as f:
+            f.write(tile_name.encode('utf-8') * size)
+
+    def test_contains(self):
+        self.assertTrue(self.cache.contains('N19W156.hgt'))
+        self.assertFalse(self.cache.contains('N00W000.hgt'))
+
+        # Truncated file doesn't count
+        self._write_tile('N19W156.hgt', size=10)
+        self.assertFalse(self.cache.contains('N19W156.hgt'))
+
+        # Unindexed files only count if they are a full .hgt tile
+        self._write_tile('N00W000.hgt', size=10)
+        self.assertFalse(self.cache.contains('N00W000.hgt'))
+        with open(join(self.cache_dir, 'N01W000.hgt'), 'wb') as f:
+            f.write(b'\x00' * cache.HGT_SIZES[1])
+        self.assertTrue(self.cache.contains('N01W000.hgt'))
+        self.assertIn('N01W000.hgt', self.cache.load_index())
+
+    def test_concurrent_processes(self):
+        # Every process rereads the index holding the lock: no entries are lost
+        jobs = [(self.cache_dir, ['N{}W{}.hgt'.format(p, t) for t in range(20)]) for p in range(4)]
+        pool = mp.Pool(4)
+        try:
+            pool.map(_add_tiles, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        index = self.cache.load_index()
+        self.assertEqual(len(index), 3 + 4 * 20)
+
+    def test_prune_lru(self):
+        tile_size = self.cache.load_index()['N19W156.hgt']['size']
+        self.cache.touch(['N19W156.hgt'])
+        removed = self.cache.prune(max_size=2 * tile_size)
+        # N19W155 was least recently used
+        self.assertEqual(removed, ['N19W155.hgt'])
+        self.assertFalse(os.path.exists(join(self.cache_dir, 'N19W155.hgt')))
+        self.assertEqual(self.cache.total_size(), 2 * tile_size)
+
+        removed = self.cache.prune(max_size=0, keep=['N19W156.hgt'])
+        self.assertEqual(removed, ['N18W156.hgt'])
+        self.assertEqual([name for name, _ in self.cache.entries()], ['N19W156.hgt'])
+
+    def test_prune_no_cap(self):
+        self.assertEqual(self.cache.prune(), [])
+        capped = cache.TileCache(self.cache_dir, max_size='100B')
+        self.assertEqual(len(capped.prune()), 3)
+
+    def test_verify(self):
+        self.assertEqual(self.cache.verify(), [])
+        # Same size, different contents
+        with open(join(self.cache_dir, 'N18W156.hgt'), 'r+b') as f:
+            f.write(b'X')
+        os.remove(join(self.cache_dir, 'N19W155.hgt'))
+        self.assertEqual(self.cache.verify(remove=False), ['N18W156.hgt', 'N19W155.hgt'])
+        self.assertEqual(self.cache.verify(), ['N18W156.hgt', 'N19W155.hgt'])
+        self.assertEqual(list(self.cache.load_index()), ['N19W156.hgt'])
+
+    def test_cli(self):
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['cache', '--cache-dir', self.cache_dir, 'list'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('N19W156.hgt', result.output)
+
+        result = runner.invoke(cli.cli,
+                               ['cache', '--cache-dir', self.cache_dir, 'prune', '-s', '0'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(self.cache.load_index(), {})
+
+
+class TestProductCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.products = cache.ProductCache(self.cache_dir)
+        self.tile_names = ['N19W156.hgt']
+        # A small stitched DEM on the SRTM1 grid
+        self.stitched_rsc = dem.Stitcher(
+            self.tile_names, bounds=(-155.9, 19.8, -155.89, 19.81)).create_dem_rsc()
+        self.stitched = np.random.RandomState(1).randint(0, 4000, size=(self.stitched_rsc[
+            'FILE_LENGTH'], self.stitched_rsc['WIDTH'])).astype('<i2')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _make_product(self, rsc_data, stitched, rate, name):
+        outname = join(self.cache_dir, name)
+        dem.upsample_dem(stitched, rate).tofile(outname)
+        with open(outname + '.rsc', 'w') as f:
+            f.write(dem.upsample_dem_rsc(rate=rate, rsc_dict=rsc_data))
+        meta = {'rate': rate, 'data_source': 'AWS', 'stitched_rsc': rsc_data}
+        return outname, meta
+
+    def test_save_fetch(self):
+        key = self.products.make_key(self.tile_names, (-155.9, 19.8, -155.89, 19.81), 2, 'AWS')
+        outname, meta = self._make_product(self.stitched_rsc, self.stitched, 2, 'made.dem')
+        self.assertFalse(self.products.fetch(key, join(self.cache_dir, 'out.dem')))
+
+        self.products.save(key, outname, meta)
+        self.assertEqual(self.products.keys(), [key])
+        # Indexed with the tiles: same size cap and verification
+        entry = self.products.tiles.load_index()['products/' + key]
+        self.assertEqual(entry['size'], sum(
+            os.path.getsize(join(self.cache_dir, 'products', key, name))
+            for name in ('elevation.dem', 'elevation.dem.rsc', 'product.json')))
+        self.assertEqual(self.products.tiles.verify(), [])
+        fetched = join(self.cache_dir, 'out.dem')
+        self.assertTrue(self.products.fetch(key, fetched))
+        assert_array_equal(sario.load_elevation(fetched), sario.load_elevation(outname))
+        self.assertEqual(sario.load_dem_rsc(fetched), sario.load_dem_rsc(outname))
+        # Fetching again replaces the outputs
+        self.assertTrue(self.products.fetch(key, fetched))
+
+    def test_prune_products(self):
+        outname, meta = self._make_product(self.stitched_rsc, self.stitched, 2, 'made.dem')
+        with open(join(self.cache_dir, 'N19W156.hgt'), 'wb') as f:
+            f.write(b'x' * 100)
+        self.products.tiles.add('N19W156.hgt')
+        for key in ('old', 'new'):
+            self.products.save(key, outname, meta)
+        product_size = self.products.tiles.load_index()['products/old']['size']
+
+        # Capped: saving evicts the least recently used tile or DEM
+        products = cache.ProductCache(self.cache_dir, max_size=2 * product_size)
+        products.fetch('old', join(self.cache_dir, 'out.dem'))
+        products.save('newest', outname, meta)
+        self.assertEqual(sorted(products.keys()), ['newest', 'old'])
+        self.assertEqual(sorted(products.tiles.load_index()), ['products/newest', 'products/old'])
+        self.assertFalse(os.path.exists(join(self.cache_dir, 'products', 'new')))
+
+    def test_save_same_key(self):
+        key = 'samekey'
+        outname, meta = self._make_product(self.stitched_rsc, self.stitched, 2, 'made.dem')
+        self.products.save(key, outname, meta)
+        # Another process finished the same DEM between our check and rename
+        with mock.patch.object(self.products, 'load_meta', side_effect=[None, meta]):
+            self.products.save(key, outname, meta)
+        self.assertEqual(self.products.keys(), [key])
+        self.assertEqual(os.listdir(join(self.cache_dir, 'products')), [key])
+
+    def test_superset(self):
+        rate = 3
+        outname, meta = self._make_product(self.stitched_rsc, self.stitched, rate, 'big.dem')
+        self.products.save('bigkey', outname, meta)
+
+        # Area inside the first: crop of the stitched grid on the same SRTM pixels
+        sub_rsc = dem.Stitcher(
+            self.tile_names, bounds=(-155.897, 19.802, -155.893, 19.806)).create_dem_rsc()
+        row_off = int(round((sub_rsc['Y_FIRST'] - self.stitched_rsc['Y_FIRST']) / sub_rsc['Y_STEP']))
+        col_off = int(round((sub_rsc['X_FIRST'] - self.stitched_rsc['X_FIRST']) / sub_rsc['X_STEP']))
+        self.assertGreater(row_off, 0)
+        sub_stitched = self.stitched[row_off:row_off + sub_rsc['FILE_LENGTH'],
+                                     col_off:col_off + sub_rsc['WIDTH']]
+        fresh_name, _ = self._make_product(sub_rsc, sub_stitched, rate, 'fresh.dem')
+
+        self.assertEqual(self.products.find_superset(sub_rsc, rate, 'AWS'),
+                         ('bigkey', row_off, col_off))
+        self.assertIsNone(self.products.find_superset(sub_rsc, 2, 'AWS'))
+        self.assertIsNone(self.products.find_superset(sub_rsc, rate, 'NASA'))
+
+        cropped = join(self.cache_dir, 'cropped.dem')
+        self.assertTrue(self.products.fetch_superset(sub_rsc, rate, 'AWS', cropped))
+        cropped_dem, fresh_dem = sario.load_elevation(cropped), sario.load_elevation(fresh_name)
+        assert_array_equal(cropped_dem[:-1, :-1], fresh_dem[:-1, :-1])
+        # Last row/col can be off by rounding
+        self.assertLessEqual(np.abs(cropped_dem.astype(int) - fresh_dem).max(), 1)
+        self.assertEqual(sario.load_dem_rsc(cropped), sario.load_dem_rsc(fresh_name))
+
+        # Doesn't cover: a larger area
+        big_rsc = dem.Stitcher(
+            self.tile_names, bounds=(-155.95, 19.8, -155.89, 19.81)).create_dem_rsc()
+        self.assertIsNone(self.products.find_superset(big_rsc, rate, 'AWS'))
@@ -0,0 +1,104 @@
+import unittest
+import os
+import tempfile
+import shutil
+import datetime
+from os.path import join
+from unittest import mock
+
+from insar import catalog, eof
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sentinel_names = [
+            'S1A_IW_SLC__1SDV_20180420T043026_20180420T043054_021546_025211_81BE.zip',
+            'S1B_IW_SLC__1SDV_20180502T043026_20180502T043054_021721_025793_5C18.zip',
+        ]
+        self.igram_dir = join(self.root, 'igrams')
+        os.mkdir(self.igram_dir)
+        for name in self.sentinel_names + ['elevation.dem', 'S1_notes.txt']:
+            self._touch(join(self.root, name))
+        for name in ('20180420_20180502.int', '20180420_20180502.unw', 'dem.rsc'):
+            self._touch(join(self.igram_dir, name))
+        self.catalog = catalog.Catalog(self.root)
+        self._set_old_mtimes()
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.root)
+
+    def _touch(self, filename, size=10):
+        with open(filename, 'w') as f:
+            f.write('x' * size)
+
+    def _set_old_mtimes(self):
+        # Older than MTIME_SLACK, so the refresh trusts them
+        old = os.path.getmtime(self.root) - 100
+        for directory in (self.root, self.igram_dir):
+            os.utime(directory, (old, old))
+
+    def test_refresh_find(self):
+        self.assertEqual(self.catalog.refresh(), 2)
+        self.assertEqual(self.catalog.find('*.int', directory=self.igram_dir),
+                         [join(self.igram_dir, '20180420_20180502.int')])
+        self.assertEqual(self.catalog.find('S1*'), [join(self.root, n) for n in
+                                                   sorted(self.sentinel_names + ['S1_notes.txt'])])
+        self.assertEqual(self.catalog.find('S1*', kind='sentinel'),
+                         [join(self.root, n) for n in self.sentinel_names])
+        # The database itself is hidden
+        self.assertNotIn(catalog.DB_NAME, [os.path.basename(f) for f in self.catalog.find()])
+
+        rows = self.catalog.products('sentinel')
+        self.assertEqual([row['mission'] for row in rows], ['S1A', 'S1B'])
+        self.assertEqual(rows[0]['date'], '2018-04-20T04:30:26')
+        self.assertEqual(rows[0]['absolute_orbit'], 21546)
+        self.assertEqual(rows[0]['size'], 10)
+        igram = self.catalog.products('igram', directory=self.igram_dir)
+        self.assertEqual([(r['date'], r['date2']) for r in igram], [('2018-04-20', '2018-05-02')] * 2)
+
+    def test_incremental(self):
+        self.catalog.refresh()
+        # Nothing changed: no directory is listed again
+        with mock.patch('os.listdir') as listdir:
+            self.assertEqual(self.catalog.refresh(), 0)
+            listdir.assert_not_called()
+
+        # New file in one directory: only that one is relisted
+        self._touch(join(self.igram_dir, '20180502_20180514.int'))
+        self.assertEqual(self.catalog.refresh(), 1)
+        self.assertEqual(len(self.catalog.find('*.int', directory=self.igram_dir)), 2)
+
+        # Removed directories leave the catalog
+        shutil.rmtree(self.igram_dir)
+        self.catalog.refresh()
+        self.assertEqual(self.catalog.find('*', directory=self.igram_dir), [])
+
+        # Catalog persists between instances
+        self.catalog.close()
+        self.catalog = catalog.Catalog(self.root)
+        self.assertEqual(len(self.catalog.find('S1*', kind='sentinel')), 2)
+
+    def test_full_refresh(self):
+        self.catalog.refresh()
+        # Rewriting a file doesn't change the directory mtime
+        self._touch(join(self.root, 'elevation.dem'), size=50)
+        self.catalog.refresh()
+        self.assertEqual(self._size('elevation.dem'), 10)
+        self.catalog.refresh(full=True)
+        self.assertEqual(self._size('elevation.dem'), 50)
+
+    def _size(self, name):
+        query = "SELECT size FROM files WHERE name = ?"
+        return self.catalog.conn.execute(query, (name, )).fetchone()['size']
+
+    def test_find_sentinel_products(self):
+        # Catalog returns them in date order, the directory listing in any order
+        expected = sorted(zip(*eof.find_sentinel_products(self.root)))
+        dts, missions = eof.find_sentinel_products(self.root, catalog=self.catalog)
+        self.assertEqual(list(zip(dts, missions)), expected)
+        self.assertEqual(dts, [
+            datetime.datetime(2018, 4, 20, 4, 30, 26),
+            datetime.datetime(2018, 5, 2, 4, 30, 26)
+        ])
@@ -1,17 +1,26 @@
 import unittest
+import functools
+import gzip
+import http.server
 import json
 import tempfile
 import shutil
 from os.path import join, dirname
 import os
+import requests
 import responses
+import subprocess
+import threading
+import zipfile
+from unittest import mock
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 
-from insar import dem, geojson, sario
+from insar import cache, dem, download, geojson, sario, utils
 
 DATAPATH = join(dirname(__file__), 'data')
 NETRC_PATH = join(DATAPATH, 'netrc')
+UPSAMPLE_PATH = join(dirname(__file__), '..', '..', 'bin', 'upsample')
 
 
 class TestNetrc(unittest.TestCase):
@@ -62,11 +71,299 @@ class TestDownload(unittest.TestCase):
         d = dem.Downloader(
             [self.test_tile], netrc_file=NETRC_PATH, parallel_ok=False, cache_dir=self.cache_dir)
         d.download_all()
+        # Only the unzipped .hgt should be left, and recorded in the index
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), [self.test_tile, cache.INDEX_NAME])
+        self.assertIn(self.test_tile, cache.TileCache(self.cache_dir).load_index())
+        self.assertEqual(os.path.getsize(join(self.cache_dir, self.test_tile)), 2 * 1201 * 1201)
+        self.assertTrue(d._all_files_exist())
+
+    @responses.activate
+    def test_download_keep_compressed(self):
+        responses.add(responses.GET, self.hgt_url, body=self.sample_hgt_zip, status=200)
+        d = dem.Downloader([self.test_tile],
+                           netrc_file=NETRC_PATH,
+                           parallel_ok=False,
+                           cache_dir=self.cache_dir,
+                           keep_compressed=True)
+        d.download_all()
+        # Tile is kept compressed, and recorded in the index
+        zip_name = self.test_tile + '.zip'
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), [zip_name, cache.INDEX_NAME])
+        self.assertIn(zip_name, cache.TileCache(self.cache_dir).load_index())
+        self.assertTrue(d._all_files_exist())
+
+    @responses.activate
+    def test_download_aws_gz(self):
+        with zipfile.ZipFile(join(DATAPATH, self.test_tile + '.zip')) as zf:
+            hgt_data = zf.read(self.test_tile)
+        url = "https://s3.amazonaws.com/elevation-tiles-prod/skadi/N19/N19W156.hgt.gz"
+        responses.add(responses.GET, url, body=gzip.compress(hgt_data), status=200)
+        d = dem.Downloader(
+            [self.test_tile], data_source='AWS', parallel_ok=False, cache_dir=self.cache_dir)
+        d.download_all()
+        with open(join(self.cache_dir, self.test_tile), 'rb') as f:
+            self.assertEqual(f.read(), hgt_data)
+
+    def test_download_local_server(self):
+        # Serve AWS-style N19/N19W156.hgt.gz tiles from a local directory
+        serve_dir = tempfile.mkdtemp()
+        tile_names = ['N19W156.hgt', 'N19W155.hgt', 'N18W156.hgt']
+        for tile_name in tile_names:
+            if not os.path.exists(join(serve_dir, tile_name[:3])):
+                os.mkdir(join(serve_dir, tile_name[:3]))
+            with gzip.open(join(serve_dir, tile_name[:3], tile_name + '.gz'), 'wb') as f:
+                f.write(tile_name.encode('utf-8'))
+
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=serve_dir)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            d = dem.Downloader(
+                tile_names,
+                data_source='AWS',
+                cache_dir=self.cache_dir,
+                max_workers=2,
+                data_url='http://127.0.0.1:{}'.format(server.server_address[1]))
+            d.download_all()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(serve_dir)
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), sorted(tile_names + [cache.INDEX_NAME]))
+        for tile_name in tile_names:
+            with open(join(self.cache_dir, tile_name), 'rb') as f:
+                self.assertEqual(f.read(), tile_name.encode('utf-8'))
+
+    def test_download_nasa_auth_timeout(self):
+        # Without a netrc file: a first request to get the auth redirect
+        d = dem.Downloader([self.test_tile], netrc_file=join(self.cache_dir, 'netrc'),
+                           parallel_ok=False, cache_dir=self.cache_dir)
+        d.username, d.password = 'user', 'pass'
+        with mock.patch.object(d.session, 'get') as get:
+            get.return_value.url = 'https://urs.earthdata.nasa.gov/oauth/authorize'
+            d._download_hgt_tile(self.hgt_url)
+        # A stalled redirect shouldn't hang the download
+        self.assertEqual(get.call_count, 2)
+        for call in get.call_args_list:
+            self.assertEqual(call[1]['timeout'], download.TIMEOUT)
+
+    @responses.activate
+    def test_download_retry(self):
+        responses.add(responses.GET, self.hgt_url, status=503)
+        responses.add(responses.GET, self.hgt_url, body=self.sample_hgt_zip, status=200)
+        d = dem.Downloader(
+            [self.test_tile],
+            netrc_file=NETRC_PATH,
+            parallel_ok=False,
+            cache_dir=self.cache_dir,
+            backoff=0)
+        d.download_all()
+        self.assertEqual(len(responses.calls), 2)
         self.assertTrue(os.path.exists(join(d.cache_dir, self.test_tile)))
 
+    @responses.activate
+    def test_download_failure_leaves_no_file(self):
+        responses.add(responses.GET, self.hgt_url, status=404)
+        d = dem.Downloader(
+            [self.test_tile], netrc_file=NETRC_PATH, parallel_ok=False, cache_dir=self.cache_dir)
+        self.assertRaises(requests.HTTPError, d.download_all)
+        # Not retried, and no partial files
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    @responses.activate
+    def test_download_partial_tile(self):
+        # A truncated tile left from an old download shouldn't count as present
+        with open(join(self.cache_dir, self.test_tile), 'wb') as f:
+            f.write(b'\x00' * 1000)
+        responses.add(responses.GET, self.hgt_url, body=self.sample_hgt_zip, status=200)
+        d = dem.Downloader(
+            [self.test_tile], netrc_file=NETRC_PATH, parallel_ok=False, cache_dir=self.cache_dir)
+        self.assertFalse(d._all_files_exist())
+        d.download_all()
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(os.path.getsize(join(self.cache_dir, self.test_tile)), 2 * 1201 * 1201)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+class TestStitcher(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.tile_names = ['N19W156.hgt', 'N19W155.hgt', 'N18W156.hgt', 'N18W155.hgt']
+        self.tiles = []
+        for idx, tile_name in enumerate(self.tile_names):
+            tile = (np.arange(1201 * 1201).reshape((1201, 1201)) + 1000 * idx) % 5000 - 10
+            tile.astype('>i2').tofile(join(self.cache_dir, tile_name))
+            self.tiles.append(np.clip(tile, 0, None))
+
     def tearDown(self):
         shutil.rmtree(self.cache_dir)
 
+    def _expected(self):
+        # Stitch by stacking, then deleting repeated overlap row/col
+        top = np.hstack((self.tiles[0], self.tiles[1][:, 1:]))
+        bottom = np.hstack((self.tiles[2], self.tiles[3][:, 1:]))
+        return np.vstack((top, bottom[1:]))
+
+    def test_load_and_stitch(self):
+        for parallel_ok in (True, False):
+            s = dem.Stitcher(
+                self.tile_names, num_pixels=1201, cache_dir=self.cache_dir, parallel_ok=parallel_ok)
+            stitched = s.load_and_stitch()
+            self.assertEqual(stitched.shape, (2401, 2401))
+            self.assertEqual(stitched.dtype, np.dtype('<i2'))
+            assert_array_almost_equal(stitched, self._expected())
+
+    def test_load_and_stitch_compressed(self):
+        # Mix of tiles compressed like the NASA and AWS downloads
+        for idx, tile_name in enumerate(self.tile_names):
+            tile_path = join(self.cache_dir, tile_name)
+            with open(tile_path, 'rb') as f:
+                hgt_data = f.read()
+            os.remove(tile_path)
+            if idx % 2:
+                with gzip.open(tile_path + '.gz', 'wb') as f:
+                    f.write(hgt_data)
+            else:
+                with zipfile.ZipFile(tile_path + '.zip', 'w') as zf:
+                    zf.writestr(tile_name, hgt_data)
+
+        s = dem.Stitcher(self.tile_names, num_pixels=1201, cache_dir=self.cache_dir)
+        assert_array_almost_equal(s.load_and_stitch(), self._expected())
+
+        bounds = (-155.3, 18.8, -154.6, 19.1)
+        full_rsc = s.create_dem_rsc()
+        expected, _, _ = dem.crop_stitched_dem(bounds, self._expected(), full_rsc)
+        s = dem.Stitcher(self.tile_names, num_pixels=1201, cache_dir=self.cache_dir, bounds=bounds)
+        assert_array_almost_equal(s.load_and_stitch(), expected)
+
+    def test_load_and_stitch_needed_tiles(self):
+        os.remove(join(self.cache_dir, 'N18W155.hgt'))
+        s = dem.Stitcher(
+            self.tile_names,
+            num_pixels=1201,
+            cache_dir=self.cache_dir,
+            needed_tiles=self.tile_names[:3])
+        expected = self._expected()
+        expected[1201:, 1201:] = 0
+        assert_array_almost_equal(s.load_and_stitch(), expected)
+
+    def test_load_and_stitch_memmap(self):
+        s = dem.Stitcher(self.tile_names, num_pixels=1201, cache_dir=self.cache_dir)
+        outfile = join(self.cache_dir, 'stitched.dem')
+        stitched = s.load_and_stitch(outfile=outfile)
+        stitched.flush()
+        from_disk = np.fromfile(outfile, dtype='<i2').reshape(s.shape)
+        assert_array_almost_equal(from_disk, self._expected())
+
+    def test_load_and_stitch_bounds(self):
+        s = dem.Stitcher(self.tile_names, num_pixels=1201, cache_dir=self.cache_dir)
+        full_rsc = s.create_dem_rsc()
+        # Straddles the corner of all 4 tiles, and one which only touches the top-left
+        for bounds in [(-155.3, 18.8, -154.6, 19.1), (-155.9, 19.7, -155.6, 19.9)]:
+            expected, new_starts, new_sizes = dem.crop_stitched_dem(bounds, self._expected(),
+                                                                     full_rsc)
+            s = dem.Stitcher(
+                self.tile_names, num_pixels=1201, cache_dir=self.cache_dir, bounds=bounds)
+            self.assertEqual(s.shape, new_sizes)
+            assert_array_almost_equal(s.load_and_stitch(), expected)
+
+            rsc_data = s.create_dem_rsc()
+            self.assertEqual((rsc_data['X_FIRST'], rsc_data['Y_FIRST']), new_starts)
+            self.assertEqual((rsc_data['FILE_LENGTH'], rsc_data['WIDTH']), new_sizes)
+
+
+class TestUpsample(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.dem = np.random.RandomState(0).randint(-100, 3000, size=(13, 17)).astype('<i2')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @unittest.skipUnless(utils.which(UPSAMPLE_PATH), "bin/upsample not built (make upsample)")
+    def test_matches_upsample_c(self):
+        small_path = join(self.temp_dir, 'elevation_small.dem')
+        c_path = join(self.temp_dir, 'c_output.dem')
+        self.dem.tofile(small_path)
+        nrows, ncols = self.dem.shape
+        for rate in (2, 3, 5):
+            subprocess.check_call(
+                [UPSAMPLE_PATH, small_path, str(rate), str(ncols), str(nrows), c_path],
+                stdout=subprocess.DEVNULL)
+            expected = np.fromfile(c_path, dtype='<i2')
+            for block_rows in (1, 4, 256):
+                upsampled = dem.upsample_dem(self.dem, rate, block_rows=block_rows)
+                assert_array_equal(upsampled.ravel(), expected)
+
+    def test_upsample_outfile(self):
+        outfile = join(self.temp_dir, 'elevation.dem')
+        upsampled = dem.upsample_dem(self.dem, 3, outfile=outfile)
+        upsampled.flush()
+        self.assertEqual(upsampled.shape, (37, 49))
+        from_disk = np.fromfile(outfile, dtype='<i2').reshape(upsampled.shape)
+        assert_array_equal(from_disk, dem.upsample_dem(self.dem, 3))
+
+    def test_bicubic(self):
+        upsampled = dem.upsample_dem(self.dem, 4, method='bicubic', block_rows=3)
+        self.assertEqual(upsampled.shape, (49, 65))
+        # Original points are kept exactly
+        assert_array_equal(upsampled[::4, ::4], self.dem)
+        # Blocks of any size give the same output
+        for block_rows in (1, 8, 1000):
+            assert_array_equal(
+                dem.upsample_dem(self.dem, 4, method='bicubic', block_rows=block_rows),
+                upsampled)
+        self.assertRaises(ValueError, dem.upsample_dem, self.dem, 2, method='nearest')
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.temp_dir
+        cache_dir = cache.get_cache_dir()
+        tile = np.arange(3601 * 3601).reshape((3601, 3601)) % 3000
+        tile.astype('>i2').tofile(join(cache_dir, 'N19W156.hgt'))
+        self.geojson_path = join(DATAPATH, 'hawaii_small.geojson')
+
+    def tearDown(self):
+        if self.old_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache_home
+        shutil.rmtree(self.temp_dir)
+
+    def test_product_cache(self):
+        first = join(self.temp_dir, 'first.dem')
+        dem.main(self.geojson_path, 'AWS', 2, first)
+        second = join(self.temp_dir, 'second.dem')
+        with mock.patch.object(dem.Stitcher, 'load_and_stitch') as load_and_stitch:
+            dem.main(self.geojson_path, 'AWS', 2, second)
+            load_and_stitch.assert_not_called()
+        assert_array_equal(sario.load_elevation(first), sario.load_elevation(second))
+        # Polygon mask is saved for both, on the DEM's grid
+        mask = np.load(join(self.temp_dir, 'second_mask.npy'))
+        self.assertEqual(mask.shape, sario.load_elevation(second).shape)
+        self.assertTrue(mask.any())
+
+        # A different rate is not a cache hit
+        third = join(self.temp_dir, 'third.dem')
+        dem.main(self.geojson_path, 'AWS', 3, third)
+        self.assertEqual(len(cache.ProductCache().keys()), 2)
+
+        # Rebuilding over a linked product replaces the link instead of writing into it
+        products = cache.ProductCache()
+        product_files = [join(products.product_dir, key, 'elevation.dem') for key in products.keys()]
+        self.assertTrue(any(os.path.samefile(second, f) for f in product_files))
+        dem.main(self.geojson_path, 'AWS', 2, second, use_cache=False)
+        self.assertFalse(any(os.path.samefile(second, f) for f in product_files))
+
 
 class TestRsc(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,118 @@
+import unittest
+import os
+import tempfile
+import shutil
+import hashlib
+import threading
+from os.path import join
+import requests
+import responses
+
+from insar import download
+
+
+class TestDownloadFile(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.url = 'http://example.com/S1A_ORBIT.EOF'
+        self.body = b''.join(str(i).encode('utf-8') for i in range(10000))
+        self.sha1 = hashlib.sha1(self.body).hexdigest()
+        self.filename = join(self.temp_dir, 'S1A_ORBIT.EOF')
+        self.range_requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _serve_ranges(self, request):
+        """Serves self.body, honoring 'Range: bytes=N-' headers"""
+        range_header = request.headers.get('Range')
+        self.range_requests.append(range_header)
+        if not range_header:
+            return (200, {}, self.body)
+        start = int(range_header.split('=')[1].rstrip('-'))
+        if start >= len(self.body):
+            return (416, {}, b'')
+        return (206, {}, self.body[start:])
+
+    @responses.activate
+    def test_download_validated(self):
+        responses.add_callback(responses.GET, self.url, callback=self._serve_ranges)
+        num_bytes = download.download_file(
+            self.url, self.filename, size=len(self.body), sha1=self.sha1)
+        self.assertEqual(num_bytes, len(self.body))
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertEqual(os.listdir(self.temp_dir), ['S1A_ORBIT.EOF'])
+
+    @responses.activate
+    def test_resume_partial(self):
+        responses.add_callback(responses.GET, self.url, callback=self._serve_ranges)
+        # Left over from a killed run
+        with open(download.partial_path(self.filename), 'wb') as f:
+            f.write(self.body[:1000])
+
+        download.download_file(self.url, self.filename, size=len(self.body), sha1=self.sha1)
+        self.assertEqual(self.range_requests, ['bytes=1000-'])
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertFalse(os.path.exists(download.partial_path(self.filename)))
+
+    @responses.activate
+    def test_resume_not_satisfiable(self):
+        responses.add_callback(responses.GET, self.url, callback=self._serve_ranges)
+        # Longer than the file: server refuses the range, so start over
+        with open(download.partial_path(self.filename), 'wb') as f:
+            f.write(self.body + b'junk')
+
+        download.download_file(self.url, self.filename, backoff=0, sha1=self.sha1)
+        self.assertEqual(self.range_requests, ['bytes={}-'.format(len(self.body) + 4), None])
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+
+    @responses.activate
+    def test_bad_checksum(self):
+        responses.add(responses.GET, self.url, body=self.body[:-1])
+        self.assertRaises(
+            download.ValidationError,
+            download.download_file,
+            self.url,
+            self.filename,
+            retries=2,
+            backoff=0,
+            sha1=self.sha1)
+        # Retried, then nothing left behind
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    @responses.activate
+    def test_broken_transfer_keeps_partial(self):
+        responses.add(
+            responses.GET, self.url, body=requests.ConnectionError("Connection reset"))
+        self.assertRaises(
+            requests.ConnectionError,
+            download.download_file,
+            self.url,
+            self.filename,
+            retries=1,
+            backoff=0)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertFalse(os.path.exists(self.filename))
+
+    @responses.activate
+    def test_wait_for_other_download(self):
+        responses.add_callback(responses.GET, self.url, callback=self._serve_ranges)
+        results = []
+        with download.lock_partial(self.filename):
+            # Another process has the partial file: this download must wait
+            thread = threading.Thread(
+                target=lambda: results.append(download.download_file(self.url, self.filename)))
+            thread.start()
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+            with open(self.filename, 'wb') as f:
+                f.write(self.body)
+        thread.join()
+        # Finished by the other process, so not downloaded again
+        self.assertEqual(results, [len(self.body)])
+        self.assertEqual(self.range_requests, [])
+        self.assertEqual(os.listdir(self.temp_dir), ['S1A_ORBIT.EOF'])
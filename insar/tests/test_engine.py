@@ -0,0 +1,107 @@
+import unittest
+import asyncio
+import threading
+import time
+import functools
+
+from insar import engine
+
+
+class TestDownloadEngine(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.max_total = 0
+        self.starts = []
+
+    def _job(self, host, seconds=0.02):
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.max_running[host] = max(self.max_running.get(host, 0), self.running[host])
+            self.max_total = max(self.max_total, sum(self.running.values()))
+            self.starts.append((host, time.monotonic()))
+        time.sleep(seconds)
+        with self.lock:
+            self.running[host] -= 1
+        return host
+
+    def _jobs(self, hosts, **kwargs):
+        return [('http://{}/file{}'.format(host, i), functools.partial(self._job, host, **kwargs))
+                for i, host in enumerate(hosts)]
+
+    def test_run_order(self):
+        hosts = ['a.com', 'b.com'] * 5
+        results = engine.DownloadEngine(max_workers=4, rate_limit=None).run(self._jobs(hosts))
+        self.assertEqual(results, hosts)
+        self.assertEqual(engine.DownloadEngine().run([]), [])
+
+    def test_limits(self):
+        hosts = ['a.com'] * 8 + ['b.com'] * 8
+        eng = engine.DownloadEngine(max_workers=6, per_host=2, rate_limit=None)
+        eng.run(self._jobs(hosts))
+        self.assertEqual(self.max_running, {'a.com': 2, 'b.com': 2})
+
+    def test_limits_across_runs(self):
+        # Two threads running jobs at once share the same per-host limit
+        eng = engine.DownloadEngine(max_workers=6, per_host=2, rate_limit=None)
+        results = {}
+
+        def _run(name, hosts):
+            results[name] = eng.run(self._jobs(hosts))
+
+        threads = [
+            threading.Thread(target=_run, args=('first', ['a.com'] * 6)),
+            threading.Thread(target=_run, args=('second', ['a.com'] * 3 + ['b.com'] * 3)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eng.close()
+        self.assertEqual(self.max_running['a.com'], 2)
+        self.assertEqual(results, {
+            'first': ['a.com'] * 6,
+            'second': ['a.com'] * 3 + ['b.com'] * 3
+        })
+
+    def test_run_limit(self):
+        eng = engine.DownloadEngine(max_workers=4, per_host=4, rate_limit=None)
+        eng.run(self._jobs(['a.com'] * 4 + ['b.com'] * 4), limit=1)
+        self.assertEqual(self.max_total, 1)
+
+    def test_default_engine(self):
+        self.assertIs(engine.get_default_engine(), engine.get_default_engine())
+
+    def test_rate_limit(self):
+        eng = engine.DownloadEngine(max_workers=10, per_host=10, rate_limit=50)
+        eng.run(self._jobs(['a.com'] * 6 + ['b.com'] * 6, seconds=0))
+        for host in ('a.com', 'b.com'):
+            starts = sorted(t for h, t in self.starts if h == host)
+            # 5 gaps of 1/50 seconds between the 6 starts
+            self.assertGreater(starts[-1] - starts[0], 0.09)
+
+    def test_progress(self):
+        reports = []
+        eng = engine.DownloadEngine(progress=lambda *args: reports.append(args), rate_limit=None)
+        eng.run(self._jobs(['a.com', 'a.com', 'b.com'], seconds=0))
+        self.assertEqual(sorted(r[0] for r in reports), [1, 2, 3])
+        self.assertTrue(all(r[1] == 3 for r in reports))
+
+    def test_failure_cancels_rest(self):
+        def fail():
+            raise ValueError("bad file")
+
+        jobs = [('http://a.com/bad', fail)] + self._jobs(['a.com'] * 20)
+        eng = engine.DownloadEngine(max_workers=1, per_host=1, rate_limit=None)
+        self.assertRaises(ValueError, eng.run, jobs)
+        self.assertLess(len(self.starts), 20)
+
+    def test_cancel(self):
+        eng = engine.DownloadEngine(max_workers=2, per_host=2, rate_limit=None)
+        timer = threading.Timer(0.1, eng.cancel)
+        timer.start()
+        self.assertRaises(asyncio.CancelledError, eng.run, self._jobs(['a.com'] * 50, seconds=0.05))
+        timer.join()
+        self.assertLess(len(self.starts), 50)
+        self.assertEqual(self.running['a.com'], 0)
@@ -3,9 +3,17 @@ import tempfile
 import shutil
 import datetime
 import os
+import re
+import json
+import hashlib
 import responses
+from unittest import mock
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
 
-from insar import eof
+from insar import download, eof
 
 
 class TestEOF(unittest.TestCase):
@@ -103,7 +111,7 @@ class TestEOF(unittest.TestCase):
             eof_path = os.path.join(temp_dir, eof_name)
             self.assertFalse(os.path.exists(eof_path))
 
-            eof.download_eofs(orbit_dates, save_dir=temp_dir)
+            eof.download_eofs(orbit_dates, save_dir=temp_dir, batch=False)
             self.assertTrue(os.path.exists(eof_path))
 
             # Now read the file and make sure it's the same
@@ -112,3 +120,212 @@ class TestEOF(unittest.TestCase):
             self.assertEqual(eof_contents, self.sample_eof)
         finally:
             shutil.rmtree(temp_dir)
+
+
+def _orbit_result(mission, start):
+    """API result for a POEORB valid from start for 26 hours"""
+    stop = start + datetime.timedelta(hours=26)
+    name = '{}_OPER_AUX_POEORB_OPOD_{}_V{}_{}.EOF'.format(
+        mission, (stop + datetime.timedelta(days=19)).strftime('%Y%m%dT%H%M%S'),
+        start.strftime('%Y%m%dT%H%M%S'), stop.strftime('%Y%m%dT%H%M%S'))
+    return {
+        'remote_url': 'http://aux.sentinel1.eo.esa.int/POEORB/' + name,
+        'physical_name': name,
+        'validity_start': start.strftime('%Y-%m-%dT%H:%M:%S'),
+        'validity_stop': stop.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+class TestBatchSearch(unittest.TestCase):
+    page_size = 10
+
+    def setUp(self):
+        # One orbit per mission per day, starting at 22:59:42 the day before
+        first = datetime.datetime(2018, 3, 31, 22, 59, 42)
+        self.orbits = [
+            _orbit_result(mission, first + datetime.timedelta(days=day))
+            for day in range(60) for mission in ('S1A', 'S1B')
+        ]
+        responses.add_callback(
+            responses.GET,
+            re.compile(r'https://qc\.sentinel1\.eo\.esa\.int/api/v1/.*'),
+            callback=self._fake_api)
+
+    @property
+    def search_calls(self):
+        return [call.request.url for call in responses.calls if 'api/v1' in call.request.url]
+
+    def _fake_api(self, request):
+        """Filters and paginates self.orbits like the QC API"""
+        params = {k: v[0] for k, v in parse_qs(urlparse(request.url).query).items()}
+        matches = [
+            o for o in self.orbits if o['validity_start'] < params['validity_start__lt']
+            and o['validity_stop'] > params['validity_stop__gt']
+        ]
+        page = int(params.get('page', 1))
+        results = matches[(page - 1) * self.page_size:page * self.page_size]
+        next_url = None
+        if page * self.page_size < len(matches):
+            next_url = re.sub(r'&page=\d+', '', request.url) + '&page={}'.format(page + 1)
+        body = {'count': len(matches), 'next': next_url, 'results': results}
+        return (200, {}, json.dumps(body))
+
+    @responses.activate
+    def test_query_orbits_pages(self):
+        results = eof.query_orbits(datetime.datetime(2018, 4, 10), datetime.datetime(2018, 4, 20))
+        # Orbits starting 4/8 22:59 to 4/20 22:59 overlap [4/10, 4/21): 13 days, 3 pages
+        self.assertEqual(len(results), 26)
+        self.assertEqual(len(self.search_calls), 3)
+        self.assertEqual(len(set(r['remote_url'] for r in results)), 26)
+
+    @responses.activate
+    def test_find_eof_links(self):
+        orbit_dts = [
+            datetime.datetime(2018, 4, 1, 4, 30, 26) + datetime.timedelta(days=12 * i)
+            for i in range(5)
+        ]
+        missions = ['S1A', 'S1B', 'S1A', 'S1B', 'S1A']
+        links = eof.find_eof_links(orbit_dts, missions)
+        self.assertEqual(len(links), 5)
+        # One range search, with however many pages it needs
+        self.assertTrue(all('page=' in url for url in self.search_calls[1:]))
+        for link, dt, mission in zip(links, orbit_dts, missions):
+            name = link.split('/')[-1]
+            self.assertTrue(name.startswith(mission))
+            self.assertIn('V' + (dt - datetime.timedelta(days=1)).strftime('%Y%m%d'), name)
+
+        # No mission given: both are returned
+        self.assertEqual(len(eof.find_eof_links(orbit_dts[:1])), 2)
+
+    def test_orbit_index_overlap(self):
+        index = eof.OrbitIndex(self.orbits)
+        # 23:30 is in two S1A windows: the one it is furthest inside is used
+        dt = datetime.datetime(2018, 4, 5, 23, 30)
+        self.assertEqual(len(index.covering(dt, 'S1A')), 2)
+        self.assertIn('V20180404T225942', index.find(dt, 'S1A'))
+        self.assertIsNone(index.find(datetime.datetime(2019, 1, 1), 'S1A'))
+
+    @responses.activate
+    def test_download_eofs_batch(self):
+        responses.add(
+            responses.GET,
+            re.compile(r'http://aux\.sentinel1\.eo\.esa\.int/POEORB/.*'),
+            body='<Earth_Explorer_File/>')
+        temp_dir = tempfile.mkdtemp()
+        try:
+            orbit_dts = [datetime.datetime(2018, 4, d, 4, 30, 26) for d in range(2, 30)]
+            eof.download_eofs(orbit_dts, missions=['S1A'] * len(orbit_dts), save_dir=temp_dir)
+            self.assertEqual(len(os.listdir(temp_dir)), len(orbit_dts))
+            self.assertEqual(len([u for u in self.search_calls if 'page=' not in u]), 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @responses.activate
+    def test_download_eofs_store(self):
+        responses.add(
+            responses.GET,
+            re.compile(r'http://aux\.sentinel1\.eo\.esa\.int/POEORB/.*'),
+            body='<Earth_Explorer_File/>')
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = eof.OrbitStore(os.path.join(temp_dir, 'store'))
+            orbit_dts = [datetime.datetime(2018, 4, d, 4, 30, 26) for d in (2, 14)]
+            for project in ('project1', 'project2'):
+                project_dir = os.path.join(temp_dir, project)
+                os.mkdir(project_dir)
+                eof.download_eofs(orbit_dts, ['S1A', 'S1B'], project_dir, orbit_store=store)
+                names = sorted(os.listdir(project_dir))
+                self.assertEqual([n[:3] for n in names], ['S1A', 'S1B'])
+                self.assertTrue(all(os.path.islink(os.path.join(project_dir, n)) for n in names))
+                if project == 'project1':
+                    num_calls = len(responses.calls)
+            # Second project found everything in the store
+            self.assertEqual(len(responses.calls), num_calls)
+            self.assertEqual(len(store.load_index()), 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_store_env(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            dt = datetime.datetime(2018, 4, 2, 4, 30, 26)
+            store_dir = os.path.join(temp_dir, 'store')
+            with mock.patch.dict(os.environ, {eof.ORBIT_STORE_ENV: store_dir}), \
+                    mock.patch.object(eof, 'download_eofs') as download_eofs:
+                eof.main(mission='S1A', date=dt)
+            # The env var alone turns on the store
+            self.assertEqual(download_eofs.call_args[1]['orbit_store'].store_dir, store_dir)
+            with mock.patch.dict(os.environ, clear=True), \
+                    mock.patch.object(eof, 'download_eofs') as download_eofs:
+                eof.main(mission='S1A', date=dt)
+            self.assertIsNone(download_eofs.call_args[1]['orbit_store'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @responses.activate
+    def test_download_eofs_checked(self):
+        body = b'<Earth_Explorer_File/>'
+        for orbit in self.orbits:
+            orbit.update(size=len(body), hash=hashlib.sha1(body).hexdigest())
+        responses.add(
+            responses.GET, re.compile(r'http://aux\.sentinel1\.eo\.esa\.int/POEORB/.*'), body=body)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            orbit_dts = [datetime.datetime(2018, 4, 2, 4, 30, 26)]
+            eof.download_eofs(orbit_dts, missions=['S1A'], save_dir=temp_dir)
+            self.assertEqual(len(os.listdir(temp_dir)), 1)
+
+            # Corrupted transfer: retried, then fails without leaving a file
+            for orbit in self.orbits:
+                orbit['size'] += 1
+            with mock.patch.object(eof, 'BACKOFF', 0):
+                self.assertRaises(
+                    download.ValidationError,
+                    eof.download_eofs, [datetime.datetime(2018, 4, 20, 4, 30, 26)], ['S1A'],
+                    save_dir=temp_dir)
+            self.assertEqual(len(os.listdir(temp_dir)), 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestOrbitStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = eof.OrbitStore(os.path.join(self.temp_dir, 'store'))
+        first = datetime.datetime(2018, 3, 31, 22, 59, 42)
+        for day in range(10):
+            name = _orbit_result('S1A', first + datetime.timedelta(days=day))['physical_name']
+            with open(self.store.path(name), 'w') as f:
+                f.write('<Earth_Explorer_File/>')
+        open(self.store.path('notes.txt'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_scan_find(self):
+        self.assertIsNone(self.store.find(datetime.datetime(2018, 4, 3, 4, 30), 'S1A'))
+        self.assertEqual(len(self.store.scan()), 10)
+        self.assertEqual(self.store.scan(), [])
+        path = self.store.find(datetime.datetime(2018, 4, 3, 4, 30), 'S1A')
+        self.assertIn('_V20180402T225942_', path)
+        self.assertIsNone(self.store.find(datetime.datetime(2018, 4, 3, 4, 30), 'S1B'))
+        self.assertIsNone(self.store.find(datetime.datetime(2018, 5, 3, 4, 30), 'S1A'))
+
+        # Deleted files leave the index
+        os.remove(path)
+        self.store.scan()
+        self.assertEqual(len(self.store.load_index()), 9)
+        self.assertIsNone(self.store.find(datetime.datetime(2018, 4, 3, 4, 30), 'S1A'))
+
+    def test_link_all(self):
+        self.store.scan()
+        orbit_dts = [datetime.datetime(2018, 4, d, 4, 30) for d in (1, 5, 20)]
+        missing_dts, missing_missions = self.store.link_all(orbit_dts, ['S1A', 'S1B', 'S1A'],
+                                                            self.temp_dir)
+        self.assertEqual(missing_dts, orbit_dts[1:])
+        self.assertEqual(missing_missions, ['S1B', 'S1A'])
+        links = [n for n in os.listdir(self.temp_dir) if n.endswith('.EOF')]
+        self.assertEqual(len(links), 1)
+        self.assertEqual(
+            os.path.realpath(os.path.join(self.temp_dir, links[0])),
+            os.path.realpath(self.store.path(links[0])))
@@ -1,8 +1,11 @@
 import unittest
 import tempfile
 import json
+import numpy as np
+from numpy.testing import assert_array_equal
 
-from insar.geojson import read_json, parse_coordinates, bounding_box, print_coordinates
+from insar.geojson import (read_json, parse_coordinates, bounding_box, print_coordinates,
+                           contains_point, intersects_box, rasterize)
 
 
 class TestGeojson(unittest.TestCase):
@@ -40,3 +43,63 @@ class TestGeojson(unittest.TestCase):
     def test_print_coordinates(self):
         desired_string = "-156.0,18.7,-154.6,18.7,-154.6,20.3,-156.0,20.3,-156.0,18.7"
         self.assertEqual(desired_string, print_coordinates(self.geojson))
+
+
+class TestPolygon(unittest.TestCase):
+    def setUp(self):
+        # L-shape covering the left column and bottom row of a 3x3 degree area
+        self.l_shape = {
+            "type":
+            "Polygon",
+            "coordinates": [[[0.5, 0.5], [2.5, 0.5], [2.5, 1.5], [1.5, 1.5], [1.5, 2.5],
+                             [0.5, 2.5], [0.5, 0.5]]]
+        }
+
+    def test_intersects_box(self):
+        tiles = [(lon, lat, lon + 1, lat + 1) for lat in (2, 1, 0) for lon in (0, 1, 2)]
+        touching = [intersects_box(self.l_shape, tile) for tile in tiles]
+        expected = [True, True, False, True, True, True, True, True, True]
+        self.assertEqual(touching, expected)
+        # Box entirely inside, and entirely surrounding, the polygon
+        self.assertTrue(intersects_box(self.l_shape, (0.6, 0.6, 0.7, 0.7)))
+        self.assertTrue(intersects_box(self.l_shape, (-10, -10, 10, 10)))
+        self.assertFalse(intersects_box(self.l_shape, (1.6, 1.6, 2.4, 2.4)))
+
+    def test_rasterize(self):
+        rsc_data = {
+            'WIDTH': 30,
+            'FILE_LENGTH': 30,
+            'X_FIRST': 0.05,
+            'Y_FIRST': 2.95,
+            'X_STEP': 0.1,
+            'Y_STEP': -0.1
+        }
+        mask = rasterize(self.l_shape, rsc_data)
+        lons = rsc_data['X_FIRST'] + np.arange(30) * rsc_data['X_STEP']
+        lats = rsc_data['Y_FIRST'] + np.arange(30) * rsc_data['Y_STEP']
+        expected = [[contains_point(self.l_shape, lon, lat) for lon in lons] for lat in lats]
+        assert_array_equal(mask, expected)
+        self.assertEqual(mask.sum(), 300)
+
+    def test_rasterize_hole(self):
+        with_hole = {
+            "type": "Feature",
+            "geometry": {
+                "type":
+                "Polygon",
+                "coordinates": [[[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]],
+                                [[1, 1], [3, 1], [3, 3], [1, 3], [1, 1]]]
+            }
+        }
+        rsc_data = {
+            'WIDTH': 4,
+            'FILE_LENGTH': 4,
+            'X_FIRST': 0.5,
+            'Y_FIRST': 3.5,
+            'X_STEP': 1.0,
+            'Y_STEP': -1.0
+        }
+        expected = np.ones((4, 4), dtype=bool)
+        expected[1:3, 1:3] = False
+        assert_array_equal(rasterize(with_hole, rsc_data), expected)
+        self.assertFalse(intersects_box(with_hole, (1.5, 1.5, 2.5, 2.5)))
@@ -0,0 +1,85 @@
+import unittest
+import os
+import struct
+import tempfile
+import shutil
+import numpy as np
+from numpy.testing import assert_array_equal
+from PIL import Image
+
+from insar import geotiff
+
+
+class TestGeotiff(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.rsc_data = {
+            'WIDTH': 300,
+            'FILE_LENGTH': 280,
+            'X_FIRST': -156.0,
+            'Y_FIRST': 20.0,
+            'X_STEP': 0.000277777777,
+            'Y_STEP': -0.000277777777,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_save_geotiff(self):
+        image = np.arange(280 * 300, dtype=np.float32).reshape((280, 300))
+        outname = os.path.join(self.temp_dir, 'test.tif')
+        geotiff.save_geotiff(outname, image, rsc_data=self.rsc_data, tile_size=128)
+
+        im = Image.open(outname)
+        assert_array_equal(np.array(im), image)
+        # Full image, then overviews of 140x150 and 70x75 (which fits in one tile)
+        self.assertEqual(im.n_frames, 3)
+        im.seek(1)
+        self.assertEqual(im.size, (150, 140))
+
+    def test_compressed_rgb(self):
+        image = np.random.randint(0, 255, size=(50, 40, 3)).astype(np.uint8)
+        outname = os.path.join(self.temp_dir, 'test.tif')
+        geotiff.save_geotiff(outname, image, compress=True)
+        im = Image.open(outname)
+        assert_array_equal(np.array(im), image)
+
+    def test_convert_files(self):
+        rows, cols = self.rsc_data['FILE_LENGTH'], self.rsc_data['WIDTH']
+        int_files = []
+        for idx in range(3):
+            fname = os.path.join(self.temp_dir, '2018010{}_20180201.int'.format(idx))
+            igram = np.exp(1j * np.linspace(0, 10, rows * cols)).astype(np.complex64)
+            igram.tofile(fname)
+            int_files.append(fname)
+
+        unw_name = os.path.join(self.temp_dir, '20180101_20180201.unw')
+        np.ones((rows, 2 * cols), dtype=np.float32).tofile(unw_name)
+
+        # max_height only applies to the .unw
+        outnames = geotiff.convert_files(
+            int_files + [unw_name], self.rsc_data, processes=2, max_height=5)
+        expected = [f[:-len('.int')] + '.tif' for f in int_files] + [unw_name + '.tif']
+        self.assertEqual(outnames, expected)
+        for outname in outnames:
+            im = Image.open(outname)
+            self.assertEqual(im.mode, 'RGB')
+            self.assertEqual(im.size, (cols, rows))
+
+        # Check the georeferencing tags are attached to the main image
+        with open(outnames[0], 'rb') as f:
+            contents = f.read()
+        self.assertEqual(contents[:4], b'II*\x00')
+        tiepoint = struct.pack('<6d', 0, 0, 0, -156.0, 20.0, 0)
+        self.assertIn(tiepoint, contents)
+
+    def test_int_outname(self):
+        rsc_data = dict(self.rsc_data, WIDTH=4, FILE_LENGTH=3)
+        int_dir = os.path.join(self.temp_dir, '.internal')
+        os.mkdir(int_dir)
+        fname = os.path.join(int_dir, '20180101_20180201.int')
+        np.ones((3, 4), dtype=np.complex64).tofile(fname)
+        # Only the extension is replaced, not the .int in the directory name
+        outname = geotiff.int_to_tif(fname, rsc_data)
+        self.assertEqual(outname, os.path.join(int_dir, '20180101_20180201.tif'))
+        self.assertTrue(os.path.exists(fname))
@@ -0,0 +1,126 @@
+import unittest
+import os
+import tempfile
+import shutil
+from os.path import join
+from unittest import mock
+
+import numpy as np
+
+from insar import igrams, sario, utils, timeseries
+
+
+class TestFormIgrams(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.igram_dir = join(self.temp_dir, 'igrams')
+        os.mkdir(self.igram_dir)
+        self.rsc_file = join(self.temp_dir, 'elevation.dem.rsc')
+        self.rsc_data = {
+            'WIDTH': 7,
+            'FILE_LENGTH': 9,
+            'X_FIRST': -155.0,
+            'Y_FIRST': 19.0,
+            'X_STEP': 0.0002,
+            'Y_STEP': -0.0002,
+        }
+        with open(self.rsc_file, 'w') as f:
+            f.write(sario.format_dem_rsc(self.rsc_data))
+
+        np.random.seed(1)
+        self.geos, self.slcs = [], []
+        for date in ('20180420', '20180502', '20180514'):
+            name = 'S1A_IW_SLC__1SDV_{0}T043026_{0}T043054_021546_025211_81BE.geo'.format(date)
+            slc = (np.random.randn(9, 7) + 1j * np.random.randn(9, 7)).astype(np.complex64)
+            slc.tofile(join(self.temp_dir, name))
+            self.geos.append(name)
+            self.slcs.append(slc)
+        self.sbas_file = join(self.igram_dir, 'sbas_list')
+        with open(self.sbas_file, 'w') as f:
+            for i, j in ((0, 1), (0, 2), (1, 2)):
+                f.write('../{} ../{} {}.0 0.0\n'.format(self.geos[i], self.geos[j], 12 * (j - i)))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _expected(self, i, j, looks, rows, cols):
+        slc1, slc2 = self.slcs[i][:rows, :cols], self.slcs[j][:rows, :cols]
+        igram = utils.take_looks(slc1 * np.conj(slc2), looks, looks)
+        power1 = utils.take_looks(np.abs(slc1)**2, looks, looks)
+        power2 = utils.take_looks(np.abs(slc2)**2, looks, looks)
+        return igram, np.abs(igram) / np.sqrt(power1 * power2)
+
+    def test_form_igrams(self):
+        # Tiny strips: several strips per file, and pairs sharing each SLC strip
+        made = igrams.form_igrams(self.sbas_file, self.rsc_file, looks=2, memory=3 * 7 * 8 * 2)
+        names = ['20180420_20180502', '20180420_20180514', '20180502_20180514']
+        self.assertEqual(made, [join(self.igram_dir, n + '.int') for n in names])
+        self.assertEqual(timeseries.read_intlist(self.igram_dir, parse=False), made)
+
+        igram_rsc = sario.load_dem_rsc(join(self.igram_dir, 'dem.rsc'))
+        self.assertEqual((igram_rsc['FILE_LENGTH'], igram_rsc['WIDTH']), (4, 3))
+        self.assertAlmostEqual(igram_rsc['X_STEP'], 0.0004)
+        self.assertEqual(igram_rsc['X_FIRST'], -155.0)
+
+        for (i, j), name in zip(((0, 1), (0, 2), (1, 2)), names):
+            expected_igram, expected_cor = self._expected(i, j, 2, 8, 6)
+            igram = sario.load_complex(join(self.igram_dir, name + '.int'), rsc_data=igram_rsc)
+            np.testing.assert_array_almost_equal(igram, expected_igram, decimal=5)
+            amp, cor = sario.load_stacked(
+                join(self.igram_dir, name + '.cc'), igram_rsc, return_amp=True)
+            np.testing.assert_array_almost_equal(cor, expected_cor, decimal=5)
+            self.assertTrue(np.all(amp > 0))
+        # sbas_list, dem.rsc, intlist, and the igrams: no partial files left
+        self.assertEqual(len(os.listdir(self.igram_dir)), 3 + 2 * 3)
+
+    def test_skip_done(self):
+        igrams.form_igrams(self.sbas_file, self.rsc_file, xsize=4, ysize=5)
+        igram_rsc = sario.load_dem_rsc(join(self.igram_dir, 'dem.rsc'))
+        self.assertEqual((igram_rsc['FILE_LENGTH'], igram_rsc['WIDTH']), (5, 4))
+        self.assertEqual(igrams.form_igrams(self.sbas_file, self.rsc_file, xsize=4, ysize=5), [])
+
+        # An updated .geo remakes only the pairs using it
+        geo = join(self.temp_dir, self.geos[2])
+        mtime = os.path.getmtime(join(self.igram_dir, '20180420_20180502.int')) + 10
+        os.utime(geo, (mtime, mtime))
+        made = igrams.form_igrams(self.sbas_file, self.rsc_file, xsize=4, ysize=5)
+        self.assertEqual([os.path.basename(f) for f in made],
+                         ['20180420_20180514.int', '20180502_20180514.int'])
+        os.utime(geo, (mtime - 100, mtime - 100))
+
+        # Other looks: the old igrams have the wrong shape for the new dem.rsc
+        made = igrams.form_igrams(self.sbas_file, self.rsc_file, looks=2, xsize=4, ysize=5)
+        self.assertEqual(len(made), 3)
+        igram_rsc = sario.load_dem_rsc(join(self.igram_dir, 'dem.rsc'))
+        self.assertEqual((igram_rsc['FILE_LENGTH'], igram_rsc['WIDTH']), (2, 2))
+        for intfile in made:
+            self.assertEqual(os.path.getsize(intfile), 2 * 2 * 8)
+        # A .int of the wrong size (e.g. cut short) is remade even if dem.rsc matches
+        with open(made[0], 'wb') as f:
+            f.write(b'x' * 8)
+        self.assertEqual(
+            igrams.form_igrams(self.sbas_file, self.rsc_file, looks=2, xsize=4, ysize=5),
+            made[:1])
+
+    def test_rerun_after_interrupt(self):
+        igrams.form_igrams(self.sbas_file, self.rsc_file)
+        old_rsc = sario.load_dem_rsc(join(self.igram_dir, 'dem.rsc'))
+        # Same shape on a shifted grid: the old igrams pass is_done
+        with open(self.rsc_file, 'w') as f:
+            f.write(sario.format_dem_rsc(dict(self.rsc_data, X_FIRST=-154.0)))
+        # Stopped part way (e.g. the disk filled up)
+        with mock.patch.object(igrams, '_write_rows', side_effect=OSError("No space left")):
+            self.assertRaises(OSError, igrams.form_igrams, self.sbas_file, self.rsc_file)
+        self.assertEqual(sario.load_dem_rsc(join(self.igram_dir, 'dem.rsc')), old_rsc)
+
+        self.assertEqual(len(igrams.form_igrams(self.sbas_file, self.rsc_file)), 3)
+        igram_rsc = sario.load_dem_rsc(join(self.igram_dir, 'dem.rsc'))
+        self.assertEqual(igram_rsc['X_FIRST'], -154.0)
+        self.assertEqual(igrams.form_igrams(self.sbas_file, self.rsc_file), [])
+
+    def test_memmap_complex(self):
+        slc = sario.memmap_complex(join(self.temp_dir, self.geos[0]), rsc_data=self.rsc_data)
+        self.assertIsInstance(slc, np.memmap)
+        np.testing.assert_array_equal(slc, self.slcs[0])
+        self.assertRaises(ValueError, sario.memmap_complex, join(self.temp_dir, self.geos[0]),
+                          rsc_data=dict(self.rsc_data, WIDTH=8))
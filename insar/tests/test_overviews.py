@@ -0,0 +1,112 @@
+import unittest
+import os
+import tempfile
+import shutil
+from os.path import join
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+import matplotlib.pyplot as plt
+from click.testing import CliRunner
+
+from insar import overviews, plotting, sario, utils
+from insar.scripts import cli
+
+
+class TestOverviews(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.rsc_data = {
+            'WIDTH': 100,
+            'FILE_LENGTH': 60,
+            'X_FIRST': -155.0,
+            'Y_FIRST': 20.0,
+            'X_STEP': 0.001,
+            'Y_STEP': -0.001,
+            'X_UNIT': 'degrees',
+            'Y_UNIT': 'degrees',
+            'Z_OFFSET': 0,
+            'Z_SCALE': 1,
+            'PROJECTION': 'LL'
+        }
+        self.dem = np.random.RandomState(0).randint(0, 4000, size=(60, 100)).astype('<i2')
+        self.dem_file = join(self.temp_dir, 'elevation.dem')
+        self.dem.tofile(self.dem_file)
+        with open(self.dem_file + '.rsc', 'w') as f:
+            f.write(sario.format_dem_rsc(self.rsc_data))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_build_dem(self):
+        outnames = overviews.build_overviews(self.dem_file, min_size=20)
+        self.assertEqual(outnames, [
+            overviews.overview_path(self.dem_file, 2),
+            overviews.overview_path(self.dem_file, 4),
+            overviews.overview_path(self.dem_file, 8)
+        ])
+        self.assertEqual(overviews.list_factors(self.dem_file), [2, 4, 8])
+
+        level = sario.load_file(outnames[0])
+        self.assertEqual(level.shape, (30, 50))
+        self.assertEqual(level.dtype, self.dem.dtype)
+        self.assertEqual(level[0, 0], np.round(np.mean(self.dem[:2, :2])))
+
+        rsc_data = sario.load_dem_rsc(outnames[1] + '.rsc')
+        self.assertEqual((rsc_data['FILE_LENGTH'], rsc_data['WIDTH']), (15, 25))
+        self.assertAlmostEqual(rsc_data['X_STEP'], 0.004)
+        self.assertAlmostEqual(rsc_data['Y_STEP'], -0.004)
+        # First pixel is the center of the first 4x4 block
+        self.assertAlmostEqual(rsc_data['X_FIRST'], -155.0 + 0.0015)
+        self.assertAlmostEqual(rsc_data['Y_FIRST'], 20.0 - 0.0015)
+
+    def test_build_stack(self):
+        stack = np.random.RandomState(1).randn(4, 40, 30).astype(np.float32)
+        stack_file = join(self.temp_dir, 'deformation.npy')
+        np.save(stack_file, stack)
+        outnames = overviews.build_overviews(stack_file, min_size=16)
+        self.assertEqual(len(outnames), 2)
+        level = np.load(outnames[-1])
+        self.assertEqual(level.shape, (4, 10, 8))
+        assert_array_almost_equal(level[2, 0, 0], np.mean(stack[2, :4, :4]), decimal=5)
+
+    def test_load_overview(self):
+        overviews.build_overviews(self.dem_file, min_size=20)
+        image, factor = overviews.load_overview(self.dem_file, display_shape=(10, 20))
+        self.assertEqual(factor, 4)
+        self.assertEqual(image.shape, (15, 25))
+
+        image, factor = overviews.load_overview(self.dem_file, display_shape=(100, 200))
+        self.assertEqual(factor, 1)
+        assert_array_equal(image, self.dem)
+
+        # Without levels, the raster is multilooked to fit the display
+        shutil.rmtree(self.dem_file + overviews.OVERVIEW_EXT)
+        image, factor = overviews.load_overview(self.dem_file, display_shape=(10, 20))
+        self.assertEqual(factor, 5)
+        assert_array_equal(image, utils.take_looks(self.dem, 5, 5))
+
+        window = overviews.load_window(self.dem_file, ((10, 20), (30, 45)))
+        assert_array_equal(window, self.dem[10:20, 30:45])
+
+    def test_view_raster_zoom(self):
+        plt.ioff()
+        overviews.build_overviews(self.dem_file, min_size=20)
+        axes_image = plotting.view_raster(self.dem_file, display_shape=(10, 20))
+        self.assertEqual(axes_image.get_array().shape, (15, 25))
+        ax = axes_image.axes
+
+        # Zoom in until the window fits the display: full resolution pixels
+        ax.set_xlim(29.5, 44.5)
+        ax.set_ylim(19.5, 9.5)
+        assert_array_equal(axes_image.get_array(), self.dem[10:20, 30:45])
+        self.assertEqual(ax.get_xlim(), (29.5, 44.5))
+
+        ax.set_xlim(-0.5, 99.5)
+        ax.set_ylim(59.5, -0.5)
+        self.assertEqual(axes_image.get_array().shape, (15, 25))
+        plt.close('all')
+
+    def test_cli(self):
+        result = CliRunner().invoke(cli.cli, ['overview', '--min-size', '20', self.dem_file])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(os.path.exists(overviews.overview_path(self.dem_file, 8)))
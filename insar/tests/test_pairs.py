@@ -0,0 +1,120 @@
+import unittest
+import os
+import tempfile
+import shutil
+import datetime
+from os.path import join
+
+import numpy as np
+
+from insar import pairs, timeseries
+
+OSV = """  <OSV>
+    <TAI>TAI={tai}</TAI>
+    <UTC>UTC={utc}</UTC>
+    <UT1>UT1={utc}</UT1>
+    <Absolute_Orbit>+21546</Absolute_Orbit>
+    <X unit="m">{x:.6f}</X>
+    <Y unit="m">{y:.6f}</Y>
+    <Z unit="m">{z:.6f}</Z>
+    <VX unit="m/s">{vx:.6f}</VX>
+    <VY unit="m/s">{vy:.6f}</VY>
+    <VZ unit="m/s">{vz:.6f}</VZ>
+    <Quality>NOMINAL</Quality>
+  </OSV>
+"""
+RADIUS = 7.0e6
+SPEED = 7500.0
+
+
+class TestPairs(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.igram_dir = join(self.temp_dir, 'igrams')
+        os.mkdir(self.igram_dir)
+        self.dates = ['20180420', '20180502', '20180514', '20180526']
+        # Distance of each orbit from the first, across the flight direction
+        self.offsets = [0, 100, 700, 50]
+        for date, offset in zip(self.dates, self.offsets):
+            name = 'S1A_IW_SLC__1SDV_{0}T043026_{0}T043054_021546_025211_81BE.geo'.format(date)
+            open(join(self.temp_dir, name), 'w').close()
+            self._write_eof(date, offset)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _eof_name(self, date):
+        day = datetime.datetime.strptime(date, '%Y%m%d')
+        start = (day - datetime.timedelta(days=1)).strftime('%Y%m%dT225942')
+        stop = (day + datetime.timedelta(days=1)).strftime('%Y%m%dT005942')
+        return 'S1A_OPER_AUX_POEORB_OPOD_20180601T120000_V{}_{}.EOF'.format(start, stop)
+
+    def _write_eof(self, date, offset):
+        """Circular orbit in the x-y plane, shifted by offset meters along z"""
+        day = datetime.datetime.strptime(date, '%Y%m%d')
+        omega = SPEED / RADIUS
+        osvs = []
+        for seconds in range(4 * 3600, 5 * 3600, 10):
+            utc = (day + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.%f')
+            angle = omega * seconds
+            osvs.append(OSV.format(tai=utc, utc=utc, x=RADIUS * np.cos(angle),
+                                   y=RADIUS * np.sin(angle), z=offset,
+                                   vx=-SPEED * np.sin(angle), vy=SPEED * np.cos(angle), vz=0))
+        with open(join(self.temp_dir, self._eof_name(date)), 'w') as f:
+            f.write('<Data_Block type="xml">\n<List_of_OSVs count="{}">\n{}</List_of_OSVs>\n'
+                    '</Data_Block>\n'.format(len(osvs), ''.join(osvs)))
+
+    def _dates(self, chosen):
+        return [(os.path.basename(g1)[17:25], os.path.basename(g2)[17:25])
+                for g1, g2, _, _ in chosen]
+
+    def _read_sbas_list(self):
+        with open(join(self.igram_dir, 'sbas_list')) as f:
+            return [line.split() for line in f.read().splitlines()]
+
+    def test_create_sbas_list(self):
+        chosen = pairs.create_sbas_list(self.temp_dir, self.igram_dir, max_temporal=24,
+                                        max_spatial=200)
+        self.assertEqual(self._dates(chosen), [('20180420', '20180502'), ('20180502', '20180526')])
+        self.assertEqual([temporal for _, _, temporal, _ in chosen], [12, 24])
+        self.assertAlmostEqual(chosen[0][3], 100, places=3)
+        self.assertAlmostEqual(chosen[1][3], 50, places=3)
+
+        lines = self._read_sbas_list()
+        self.assertTrue(lines[0][0].startswith('../S1A_IW_SLC__1SDV_20180420'))
+        self.assertEqual([float(line[2]) for line in lines], [12, 24])
+        self.assertEqual(
+            timeseries.read_intlist(self.igram_dir, parse=False),
+            [join(self.igram_dir, '20180420_20180502.int'),
+             join(self.igram_dir, '20180502_20180526.int')])
+        # 20180514 isn't used by any igram
+        self.assertEqual(
+            timeseries.read_geolist(self.igram_dir),
+            [datetime.date(2018, 4, 20), datetime.date(2018, 5, 2), datetime.date(2018, 5, 26)])
+
+    def test_connect(self):
+        chosen = pairs.create_sbas_list(self.temp_dir, self.igram_dir, max_temporal=24,
+                                        max_spatial=200, connect=True)
+        self.assertEqual(self._dates(chosen), [('20180420', '20180502'), ('20180502', '20180514'),
+                                               ('20180502', '20180526')])
+        self.assertAlmostEqual(chosen[1][3], 600, places=3)
+        self.assertEqual(len(timeseries.read_geolist(self.igram_dir)), 4)
+
+    def test_missing_orbit(self):
+        os.remove(join(self.temp_dir, self._eof_name('20180514')))
+        chosen = pairs.create_sbas_list(self.temp_dir, self.igram_dir, max_temporal=12,
+                                        max_spatial=200)
+        self.assertEqual([spatial for _, _, _, spatial in chosen][1:], [0, 0])
+        self.assertEqual(len(chosen), 3)
+
+    def test_select_pairs(self):
+        # Many acquisitions: same pairs as checking every pair one at a time
+        np.random.seed(0)
+        start = datetime.date(2015, 1, 1)
+        dates = [start + datetime.timedelta(days=12 * k) for k in range(300)]
+        offsets = np.random.randn(300, 3) * 100
+        chosen = pairs.select_pairs(dates, offsets, max_temporal=120, max_spatial=150)
+        expected = [(i, j) for i in range(300) for j in range(i + 1, 300)
+                    if (dates[j] - dates[i]).days <= 120
+                    and np.linalg.norm(offsets[j] - offsets[i]) <= 150]
+        self.assertEqual([(i, j) for i, j, _, _ in chosen], expected)
@@ -37,3 +37,25 @@ class TestSentinel(unittest.TestCase):
 
     def test_mission(self):
         self.assertEqual(self.parser.mission, 'S1A')
+
+    def test_slots(self):
+        # Fields are parsed once, and no per-instance __dict__ is made
+        self.assertEqual(self.parser._fields, self.parser.full_parse())
+        self.assertFalse(hasattr(self.parser, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.parser, 'other', 1)
+
+    def test_parse_many(self):
+        other = 'S1B_IW_SLC__1SDV_20180420T043026_20180420T043054_010546_0133F4_A1B2.zip'
+        table = Sentinel.parse_many(['/path/' + self.filename, 'asdf.zip', other])
+        self.assertEqual(list(table['filename']), ['/path/' + self.filename, other])
+        self.assertEqual(list(table['mission']), ['S1A', 'S1B'])
+        self.assertEqual(table['start_time'].tolist(),
+                         [self.parser.start_time, Sentinel(other).start_time])
+        self.assertEqual(table['stop_time'].tolist()[0], self.parser.stop_time)
+        self.assertEqual(list(table['absolute_orbit']), [21371, 10546])
+        self.assertEqual(list(table['relative_orbit']),
+                         [self.parser.relative_orbit, Sentinel(other).relative_orbit])
+
+        empty = Sentinel.parse_many(['asdf'])
+        self.assertEqual(len(empty['filename']), 0)
+        self.assertEqual(len(empty['start_time']), 0)
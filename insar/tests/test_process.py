@@ -0,0 +1,152 @@
+import unittest
+import os
+import tempfile
+import shutil
+import sqlite3
+import threading
+from os.path import join
+from unittest import mock
+
+from insar.scripts import process
+
+
+class TestProcessPlan(unittest.TestCase):
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        os.mkdir('igrams')
+        self.kwargs = {'geojson': None, 'step': [], 'start': 1}
+
+    def tearDown(self):
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.temp_dir)
+
+    def _touch(self, filename, age=0):
+        """Makes filename with an mtime of age seconds ago"""
+        with open(filename, 'w') as f:
+            f.write(filename)
+        mtime = 1000000000 - age
+        os.utime(filename, (mtime, mtime))
+
+    def _names(self, wave):
+        return [process.STEPS[num].__name__ for num, _, _ in wave]
+
+    def test_waves(self):
+        plan = process.plan_steps(range(len(process.STEPS)), self.kwargs)
+        self.assertEqual([[num + 1 for num, _, _ in wave] for wave in plan],
+                         [[1, 2], [3], [4], [5], [6], [7, 8], [9, 10]])
+        # Nothing made yet: everything runs
+        self.assertTrue(all(run for wave in plan for _, run, _ in wave))
+
+    def test_skip_up_to_date(self):
+        for name in ('20180420_20180502.int', '20180420_20180502.cc', 'dem.rsc'):
+            self._touch(join('igrams', name), age=100)
+        self._touch('igrams/20180420_20180502.unw', age=50)
+        self._touch('igrams/20180420_20180502.tif', age=50)
+
+        plan = process.plan_steps(range(6, 10), self.kwargs)
+        runs = {process.STEPS[num].__name__: (run, reason)
+                for wave in plan for num, run, reason in wave}
+        self.assertFalse(runs['convert_int_tif'][0])
+        self.assertFalse(runs['run_snaphu'][0])
+        self.assertTrue(runs['convert_snaphu_tif'][0])
+        self.assertEqual(runs['convert_snaphu_tif'][1], 'no igrams/*.unw.tif')
+
+        # A newer input makes the step, and the steps after it, run again
+        self._touch('igrams/20180420_20180502.int', age=10)
+        plan = process.plan_steps(range(6, 10), self.kwargs)
+        runs = {process.STEPS[num].__name__: run for wave in plan for num, run, _ in wave}
+        self.assertEqual(runs, {
+            'convert_int_tif': True,
+            'run_snaphu': True,
+            'convert_snaphu_tif': True,
+            'run_sbas_inversion': True
+        })
+        self._touch('igrams/20180420_20180502.int', age=100)
+        plan = process.plan_steps(range(6, 10), self.kwargs, force=True)
+        self.assertTrue(all(run for wave in plan for _, run, _ in wave))
+
+    def test_check_hashes(self):
+        self._touch('igrams/20180420_20180502.unw', age=100)
+        self._touch('igrams/20180420_20180502.unw.tif', age=50)
+        self.assertTrue(process.check_step('convert_snaphu_tif', self.kwargs)[0])
+
+        unw_file = 'igrams/20180420_20180502.unw'
+        state = {'inputs': {'convert_snaphu_tif': {unw_file: process._fingerprint(unw_file)}}}
+        # Same contents, newer mtime: only the hash check still skips it
+        self._touch(unw_file, age=10)
+        self.assertFalse(process.check_step('convert_snaphu_tif', self.kwargs)[0])
+        self.assertFalse(process.check_step('convert_snaphu_tif', self.kwargs, state)[0])
+        self.assertTrue(
+            process.check_step('convert_snaphu_tif', self.kwargs, state, check_hashes=True)[0])
+
+        with open(unw_file, 'a') as f:
+            f.write('changed')
+        self.assertFalse(
+            process.check_step('convert_snaphu_tif', self.kwargs, state, check_hashes=True)[0])
+
+    def test_options_changed(self):
+        self._touch('box.geojson', age=100)
+        self._touch('elevation.dem', age=50)
+        self._touch('elevation.dem.rsc', age=50)
+        self.kwargs.update(geojson='box.geojson', rate=1)
+        made = []
+
+        def create_dem(**kwargs):
+            made.append(kwargs['rate'])
+
+        steps = list(process.STEPS)
+        steps[1] = create_dem
+        with mock.patch.object(process, 'STEPS', steps):
+            process.main('.', dict(self.kwargs, step=[2]))
+        self.assertEqual(made, [1])
+        state = process._load_state()
+        self.assertEqual(state['options']['create_dem'], {'geojson': 'box.geojson', 'rate': 1})
+
+        # Same rate: the DEM is up to date. A new rate makes it, and what uses it, run again
+        plan = process.plan_steps(range(1, 3), self.kwargs, state=state)
+        self.assertFalse(plan[0][0][1])
+        plan = process.plan_steps(range(1, 3), dict(self.kwargs, rate=2), state=state)
+        self.assertEqual(plan[0][0][1:], (True, 'options changed: rate 1 -> 2'))
+        self.assertTrue(plan[1][0][1])
+
+    def test_main_shared_engine(self):
+        self.kwargs.update(step=[1, 2], geojson='box.geojson')
+        with mock.patch('insar.eof.main') as eof_main, mock.patch('insar.dem.main') as dem_main:
+            process.main('.', self.kwargs)
+        # The orbit and DEM downloads run at once under the same limits
+        self.assertIs(eof_main.call_args[1]['engine'], dem_main.call_args[1]['engine'])
+        self.assertIsNotNone(dem_main.call_args[1]['engine'])
+
+    def test_main_concurrent(self):
+        barrier = threading.Barrier(2, timeout=5)
+        ran = []
+
+        catalogs = []
+
+        def convert_int_tif(**kwargs):
+            barrier.wait()  # Times out unless both steps run at once
+            for _ in range(20):  # Both threads use the one catalog connection
+                kwargs['catalog'].refresh(full=True)
+            catalogs.append(kwargs['catalog'])
+            ran.append('convert_int_tif')
+
+        def run_snaphu(**kwargs):
+            barrier.wait()
+            for _ in range(20):
+                kwargs['catalog'].find('*.int')
+            ran.append('run_snaphu')
+
+        steps = list(process.STEPS)
+        steps[6], steps[7] = convert_int_tif, run_snaphu
+        with mock.patch.object(process, 'STEPS', steps):
+            self.kwargs['step'] = [7, 8]
+            plan = process.main('.', dict(self.kwargs, dry_run=True))
+            self.assertEqual(ran, [])
+            self.assertEqual([self._names(wave) for wave in plan], [['convert_int_tif', 'run_snaphu']])
+
+            process.main('.', self.kwargs)
+        self.assertEqual(sorted(ran), ['convert_int_tif', 'run_snaphu'])
+        # Closed once the steps finish
+        self.assertRaises(sqlite3.ProgrammingError, catalogs[0].find)
@@ -1,8 +1,11 @@
 import unittest
 from collections import OrderedDict
+import gzip
 import os
 from os.path import join, dirname, exists
 import shutil
+import tempfile
+import zipfile
 import numpy as np
 from numpy.testing import assert_array_almost_equal
 
@@ -131,3 +134,54 @@ class TestLoading(unittest.TestCase):
         os.remove(save_path)
         self.assertFalse(exists(save_path))
         self.assertFalse(exists(new_dem_rsc))
+
+    def test_load_elevation_window(self):
+        loaded_dem = sario.load_elevation(self.dem_path, window=((1, 3), (1, 2)))
+        expected_dem = np.array([[1414], [1415]], dtype='<i2')
+        assert_array_almost_equal(expected_dem, loaded_dem)
+
+        try:
+            temp_dir = tempfile.mkdtemp()
+            hgt_path = join(temp_dir, 'N19W156.hgt')
+            hgt = np.arange(1201 * 1201).reshape((1201, 1201)) % 3000 - 5
+            hgt.astype('>i2').tofile(hgt_path)
+
+            raw = sario.load_elevation(hgt_path, dtype=None)
+            self.assertIsInstance(raw, np.memmap)
+            self.assertEqual(raw.dtype, np.dtype('>i2'))
+            self.assertEqual(raw[0, 0], -5)
+
+            window = sario.load_elevation(hgt_path, window=((0, 2), (3, 7)))
+            self.assertEqual(window.dtype, np.dtype('<i2'))
+            assert_array_almost_equal(window, np.clip(hgt[:2, 3:7], 0, None))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_elevation_compressed(self):
+        hgt = np.arange(1201 * 1201).reshape((1201, 1201)) % 3000 - 5
+        try:
+            temp_dir = tempfile.mkdtemp()
+            gz_path = join(temp_dir, 'N19W156.hgt.gz')
+            with gzip.open(gz_path, 'wb') as f:
+                f.write(hgt.astype('>i2').tobytes())
+            zip_path = join(temp_dir, 'N19W156.hgt.zip')
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr('N19W156.hgt', hgt.astype('>i2').tobytes())
+
+            for path in (gz_path, zip_path):
+                assert_array_almost_equal(sario.load_elevation(path), np.clip(hgt, 0, None))
+                # Spans more than one block of decompressed rows
+                window = ((250, 700), (3, 7))
+                loaded = sario.load_elevation(path, window=window)
+                assert_array_almost_equal(loaded, np.clip(hgt[250:700, 3:7], 0, None))
+
+                raw = sario.load_elevation(path, dtype=None, window=((0, 2), (0, 2)))
+                self.assertEqual(raw.dtype, np.dtype('>i2'))
+                self.assertEqual(raw[0, 0], -5)
+
+                out = np.zeros((5, 10), dtype='<i2')
+                sario.load_elevation(path, window=((1, 3), (0, 4)), out=out[2:4, 1:5])
+                assert_array_almost_equal(out[2:4, 1:5], np.clip(hgt[1:3, :4], 0, None))
+                self.assertEqual(out.sum(), out[2:4, 1:5].sum())
+        finally:
+            shutil.rmtree(temp_dir)
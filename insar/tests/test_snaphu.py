@@ -0,0 +1,94 @@
+import unittest
+import os
+import sys
+import stat
+import tempfile
+import shutil
+from os.path import join
+from unittest import mock
+
+from insar import sario
+from insar.scripts import snaphu
+
+# Stand-in for snaphu with the same arguments: snaphu -s INFILE WIDTH -c CCFILE -o OUTFILE
+# Copies INFILE to OUTFILE. Behavior for each INFILE is set by files next to it:
+# INFILE.sleep holds seconds to sleep first, INFILE.fail makes the first call fail
+STUB = """#!{python}
+import os, shutil, sys, time
+infile, outfile = sys.argv[2], sys.argv[sys.argv.index('-o') + 1]
+if os.path.exists(infile + '.sleep'):
+    time.sleep(float(open(infile + '.sleep').read()))
+if os.path.exists(infile + '.fail'):
+    os.remove(infile + '.fail')
+    sys.exit("stub failure")
+shutil.copyfile(infile, outfile)
+"""
+
+
+class TestSnaphu(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.stub = join(self.temp_dir, 'snaphu_stub')
+        with open(self.stub, 'w') as f:
+            f.write(STUB.format(python=sys.executable))
+        os.chmod(self.stub, os.stat(self.stub).st_mode | stat.S_IEXEC)
+
+        self.igram_dir = join(self.temp_dir, 'igrams')
+        os.mkdir(self.igram_dir)
+        with open(join(self.igram_dir, 'dem.rsc'), 'w') as f:
+            f.write(sario.format_dem_rsc({'WIDTH': 4, 'FILE_LENGTH': 2}))
+        self.names = ['20180420_20180502', '20180420_20180514', '20180502_20180514']
+        for name in self.names:
+            for ext, size in (('.int', 64), ('.cc', 64)):
+                with open(join(self.igram_dir, name + ext), 'wb') as f:
+                    f.write(os.urandom(size))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _path(self, name, ext):
+        return join(self.igram_dir, name + ext)
+
+    def test_run_all(self):
+        results = snaphu.run_all(self.igram_dir, max_jobs=2, snaphu_path=self.stub)
+        self.assertEqual([r.status for r in results], ['done'] * 3)
+        for name in self.names:
+            with open(self._path(name, '.int'), 'rb') as f:
+                intdata = f.read()
+            with open(self._path(name, '.unw'), 'rb') as f:
+                self.assertEqual(f.read(), intdata)
+        # No partial files left
+        self.assertEqual(len(os.listdir(self.igram_dir)), 1 + 3 * 3)
+
+        # Finished igrams are skipped, new ones run
+        os.remove(self._path(self.names[1], '.unw'))
+        results = snaphu.run_all(self.igram_dir, snaphu_path=self.stub)
+        self.assertEqual([r.status for r in results], ['skipped', 'done', 'skipped'])
+        stats = snaphu.summarize(results)
+        self.assertEqual((stats['done'], stats['skipped']), (1, 2))
+
+    def test_retry(self):
+        open(self._path(self.names[0], '.int.fail'), 'w').close()
+        results = snaphu.run_all(self.igram_dir, snaphu_path=self.stub, retries=1)
+        self.assertEqual([(r.status, r.attempts) for r in results],
+                         [('done', 2), ('done', 1), ('done', 1)])
+
+    def test_timeout(self):
+        with open(self._path(self.names[2], '.int.sleep'), 'w') as f:
+            f.write('10')
+        self.assertRaises(
+            RuntimeError, snaphu.run_all, self.igram_dir, snaphu_path=self.stub, timeout=0.5)
+
+        results = snaphu.run_all(
+            self.igram_dir, snaphu_path=self.stub, timeout=0.5, retries=0, raise_errors=False)
+        self.assertEqual([r.status for r in results], ['skipped', 'skipped', 'timeout'])
+        self.assertLess(results[2].seconds, 5)
+        self.assertFalse(os.path.exists(self._path(self.names[2], '.unw')))
+
+    def test_no_timeout_support(self):
+        with open(self._path(self.names[2], '.int.sleep'), 'w') as f:
+            f.write('1')
+        # Python 2 can't time out a job: it runs to the end instead
+        with mock.patch.object(snaphu, 'HAS_TIMEOUT', False):
+            results = snaphu.run_all(self.igram_dir, snaphu_path=self.stub, timeout=0.2)
+        self.assertEqual([r.status for r in results], ['done', 'done', 'done'])
@@ -23,6 +23,23 @@ class TestHelpers(unittest.TestCase):
         downsampled = utils.downsample_im(self.im)
         self.assertTrue(downsampled, np.array([[.1], [3]]))
 
+    def test_take_looks(self):
+        image = np.arange(30.).reshape((5, 6))
+        out = utils.take_looks(image, 2, 2)
+        self.assertEqual(out.shape, (3, 3))
+        self.assertEqual(out[0, 0], np.mean(image[:2, :2]))
+        # Edge row only has one row of pixels
+        self.assertEqual(out[2, 1], np.mean(image[4, 2:4]))
+        stack = np.stack([image, 2 * image])
+        assert_array_equal(utils.take_looks(stack, 2, 2)[1], 2 * out)
+        # Reading in strips gives the same result
+        assert_array_equal(utils.take_looks(stack, 2, 2, strip_rows=1), utils.take_looks(stack, 2, 2))
+        # Memory mapped input
+        with tempfile.NamedTemporaryFile(suffix='.npy') as f:
+            np.save(f.name, stack)
+            assert_array_equal(utils.take_looks(np.load(f.name, mmap_mode='r'), 2, 2), [out, 2 * out])
+        assert_array_equal(utils.take_looks(image, 2, 4, edges='trim'), [[4.5], [16.5]])
+
     def test_split_array_into_blocks(self):
         # Even shape test
         long_arr = np.arange(12).reshape((6, 2))
@@ -73,3 +90,110 @@ class TestHelpers(unittest.TestCase):
             self.assertIsNone(utils.which('non_existent_program'))
         finally:
             shutil.rmtree(temp_dir)
+
+
+class TestCleanFiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.good = os.path.join(self.temp_dir, 'S1A_20180420.geo')
+        self.bad = os.path.join(self.temp_dir, 'S1A_20180502.geo')
+        good_data = np.ones((200, 500), dtype=np.complex64)
+        good_data[:20] = 0
+        good_data.tofile(self.good)
+        bad_data = np.zeros((200, 500), dtype=np.complex64)
+        # Only one part of a pixel being zero doesn't make it zero
+        bad_data[:60] = 1j
+        bad_data.tofile(self.bad)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_percent_zero_chunks(self):
+        for chunk_size in (100, 8 * 333, 10**6):
+            self.assertEqual(utils.percent_zero(self.good, chunk_size=chunk_size), 0.1)
+            self.assertEqual(utils.percent_zero(self.bad, chunk_size=chunk_size), 0.7)
+
+    def test_sample_percent_zero(self):
+        estimate, low, high = utils.sample_percent_zero(self.bad, num_blocks=200, block_size=50,
+                                                        seed=0)
+        self.assertTrue(low <= 0.7 <= high)
+        self.assertTrue(low > 0.5)
+
+    def test_clean_files(self):
+        for sample in (False, True):
+            bad_files = utils.clean_files('.geo', path=self.temp_dir, sample=sample, max_procs=2)
+            self.assertEqual(bad_files, [self.bad])
+            self.assertTrue(os.path.exists(self.bad))
+
+        utils.clean_files('.geo', path=self.temp_dir, test=False)
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'bad_geo')), ['S1A_20180502.geo'])
+        self.assertTrue(os.path.exists(self.good))
+
+
+class TestSplitAndSave(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.int_file = os.path.join(self.temp_dir, 'brazos_01.int')
+        with open(os.path.join(self.temp_dir, 'brazos_01.ann'), 'w') as f:
+            f.write("slt.set_rows      (pixels)     = 11     ; slant range data lines\n")
+            f.write("slt.set_cols      (pixels)     = 3      ; slant range data samples\n")
+        self.data = (np.arange(33) + 1j * np.arange(33)).astype(np.complex64).reshape((11, 3))
+        self.data.tofile(self.int_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_split_and_save(self):
+        expected = utils.split_array_into_blocks(self.data)
+        for max_workers in (1, 3):
+            newpaths = utils.split_and_save(self.int_file, max_workers=max_workers)
+            self.assertEqual(newpaths,
+                             [self.int_file.replace('.int', '.{}.int'.format(i)) for i in (1, 2, 3, 4)])
+            for path, block in zip(newpaths, expected):
+                assert_array_equal(np.fromfile(path, np.complex64).reshape((-1, 3)), block)
+
+        views = utils.block_views(self.int_file)
+        self.assertEqual([v.shape for v in views], [b.shape for b in expected])
+        for view, block in zip(views, expected):
+            assert_array_equal(view, block)
+
+
+class TestCombineCorAmp(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.rows, self.cols = 7, 4
+        self.amps, self.cors = [], []
+        for idx, name in enumerate(('brazos_01', 'brazos_02')):
+            with open(os.path.join(self.temp_dir, name + '.ann'), 'w') as f:
+                f.write("slt.set_rows      (pixels)     = 7      ; slant range data lines\n")
+                f.write("slt.set_cols      (pixels)     = 4      ; slant range data samples\n")
+            state = np.random.RandomState(idx)
+            igram = (state.randn(self.rows, self.cols) + 1j * state.randn(self.rows, self.cols))
+            igram.astype(np.complex64).tofile(os.path.join(self.temp_dir, name + '.int'))
+            cor = state.rand(self.rows, self.cols).astype(np.float32)
+            cor.tofile(os.path.join(self.temp_dir, name + '.cor'))
+            self.amps.append(np.abs(igram.astype(np.complex64)))
+            self.cors.append(cor)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_combine_cor_amp(self):
+        corfile = os.path.join(self.temp_dir, 'brazos_01.cor')
+        for strip_rows in (2, 100):
+            cor_with_amp, outfile = utils.combine_cor_amp(corfile, strip_rows=strip_rows)
+            self.assertEqual(outfile, corfile.replace('.cor', '_withamp.cor'))
+            # Rows of amplitude and correlation alternate
+            data = np.fromfile(outfile, np.float32).reshape((self.rows, 2 * self.cols))
+            assert_array_equal(data[:, :self.cols], self.amps[0])
+            assert_array_equal(data[:, self.cols:], self.cors[0])
+            assert_array_equal(cor_with_amp, data)
+
+    def test_combine_all_cor_amp(self):
+        outfiles = utils.combine_all_cor_amp(self.temp_dir, max_procs=2)
+        self.assertEqual([os.path.basename(f) for f in outfiles],
+                         ['brazos_01_withamp.cor', 'brazos_02_withamp.cor'])
+        data = np.fromfile(outfiles[1], np.float32).reshape((self.rows, 2 * self.cols))
+        assert_array_equal(data[:, self.cols:], self.cors[1])
+        # Running again doesn't combine the outputs
+        self.assertEqual(len(utils.combine_all_cor_amp(self.temp_dir)), 2)
@@ -481,9 +481,12 @@ def save_deformation(igram_path, deformation, geolist):
     np.save(os.path.join(igram_path, 'geolist.npy'), geolist)
 
 
-def load_deformation(igram_path, ref_row=None, ref_col=None, alpha=0, difference=False):
+def load_deformation(igram_path, ref_row=None, ref_col=None, alpha=0, difference=False,
+                     mmap=False):
     try:
-        deformation = np.load(os.path.join(igram_path, 'deformation.npy'))
+        # mmap=True leaves a saved deformation.npy on disk, reading layers/pixels as used
+        deformation = np.load(
+            os.path.join(igram_path, 'deformation.npy'), mmap_mode='r' if mmap else None)
         # geolist is a list of datetimes: encoding must be bytes
         geolist = np.load(os.path.join(igram_path, 'geolist.npy'), encoding='bytes')
 
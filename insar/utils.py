@@ -11,6 +11,7 @@ import os
 import shutil
 import numpy as np
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 
 import insar.sario
 from insar.log import get_log, log_runtime
@@ -52,14 +53,98 @@ def which(program):
     return None
 
 
+# Rows of input read at a time by the strip-wise functions (take_looks, combine_cor_amp)
+STRIP_ROWS = 1024
+
+
+def take_looks(image, row_looks, col_looks, func='mean', edges='partial',
+               strip_rows=STRIP_ROWS):
+    """Multilooks an image: averages non-overlapping row_looks x col_looks blocks
+
+    Works on the last two axes, so a 3D stack is reduced layer by layer.
+    The input is read strip_rows rows at a time, so a memory mapped
+    image (np.memmap, np.load(mmap_mode='r')) never has more than one strip
+    in memory as a float array. Complex images are averaged as complex
+    numbers; integer images are rounded back to their original type.
+
+    Args:
+        image (ndarray): 2D image, or 3D stack of images
+        row_looks (int): rows in each block
+        col_looks (int): cols in each block
+        func (str): 'mean', or 'nanmean' to ignore nans (blocks of all
+            nans stay nan)
+        edges (str): 'partial' to average the blocks on the bottom/right
+            edges over only the pixels present, or 'trim' to drop them
+        strip_rows (int): number of input rows to read at a time
+
+    Returns:
+        ndarray: the reduced image, same dtype as image
+
+    Examples:
+        >>> a = np.arange(20.).reshape((4, 5))
+        >>> print(take_looks(a, 2, 2))
+        [[ 3.   5.   6.5]
+         [13.  15.  16.5]]
+        >>> print(take_looks(a, 2, 2, edges='trim'))
+        [[ 3.  5.]
+         [13. 15.]]
+        >>> print(take_looks(np.array([[1, np.nan], [3, 4]]), 2, 2, func='nanmean'))
+        [[2.66666667]]
+        >>> print(take_looks(np.array([[1j, 1], [2, 1 - 1j]]), 1, 2))
+        [[0.5+0.5j]
+         [1.5-0.5j]]
+    """
+    if func not in ('mean', 'nanmean'):
+        raise ValueError("func must be 'mean' or 'nanmean', not {}".format(func))
+    if edges not in ('partial', 'trim'):
+        raise ValueError("edges must be 'partial' or 'trim', not {}".format(edges))
+
+    rows, cols = image.shape[-2:]
+    if edges == 'trim':
+        rows, cols = rows - rows % row_looks, cols - cols % col_looks
+    out_rows, out_cols = -(-rows // row_looks), -(-cols // col_looks)
+    lead_shape = image.shape[:-2]
+    out = np.empty(lead_shape + (out_rows, out_cols), dtype=image.dtype)
+    sum_type = np.complex128 if np.iscomplexobj(image) else np.float64
+
+    # Pixels per block along each axis, for the 'mean' counts of edge blocks
+    col_counts = np.minimum(col_looks, cols - col_looks * np.arange(out_cols))
+    strip_rows = max(strip_rows // row_looks, 1) * row_looks
+    for row_start in range(0, rows, strip_rows):
+        row_end = min(row_start + strip_rows, rows)
+        strip_out = -(-(row_end - row_start) // row_looks)
+        padded = np.zeros(lead_shape + (strip_out * row_looks, out_cols * col_looks), sum_type)
+        padded[..., :row_end - row_start, :cols] = image[..., row_start:row_end, :cols]
+        block_shape = lead_shape + (strip_out, row_looks, out_cols, col_looks)
+
+        if func == 'nanmean':
+            nans = np.isnan(padded)
+            padded[nans] = 0
+            counts = (~nans).reshape(block_shape).sum(axis=(-3, -1))
+        else:
+            row_counts = np.minimum(row_looks, row_end - row_start - row_looks * np.arange(strip_out))
+            counts = np.outer(row_counts, col_counts)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = padded.reshape(block_shape).sum(axis=(-3, -1)) / counts
+        if np.issubdtype(image.dtype, np.integer):
+            means = np.round(means)
+        out_start = row_start // row_looks
+        out[..., out_start:out_start + strip_out, :] = means
+    return out
+
+
 def downsample_im(image, rate=10):
     """Takes a numpy matrix of an image and returns a smaller version
 
+    Averages rate x rate blocks (see take_looks), rather than taking every
+    rate-th pixel, which aliases noisy images
+
     Args:
         image (ndarray) 2D array of an image
         rate (int) the reduction rate to downsample
     """
-    return image[::rate, ::rate]
+    return take_looks(image, rate, rate)
 
 
 def floor_float(num, ndigits):
@@ -93,14 +178,41 @@ def log(image):
 db = log
 
 
-def percent_zero(filepath=None, arr=None):
+# Bytes read at a time when counting zeros in a file
+ZERO_CHUNK_SIZE = 2**24
+# Sampling defaults for sample_percent_zero: blocks read, and entries per block
+SAMPLE_BLOCKS = 64
+SAMPLE_BLOCK_SIZE = 2**14
+
+
+def _entry_dtype(filepath):
+    """Data type of one pixel of filepath, as stored on disk
+
+    Returns None for stacked files (.unw, .cc), which need the file
+    width to separate the amplitude from the data
+    """
+    ext = insar.sario.get_file_ext(filepath)
+    if ext in insar.sario.ELEVATION_EXTS:
+        return insar.sario.INT_16_LE  # Endianness doesn't matter for zeros
+    elif ext in insar.sario.STACKED_FILES:
+        return None
+    # Sentinel files are complex (see sario.load_file)
+    elif ext in insar.sario.SENTINEL_EXTS or insar.sario.is_complex(filepath):
+        return np.dtype('<c8')
+    else:
+        return insar.sario.FLOAT_32_LE
+
+
+def percent_zero(filepath=None, arr=None, chunk_size=ZERO_CHUNK_SIZE):
     """Function to give the percentage of a file that is exactly zero
 
-    Used as a quality assessment check
+    Used as a quality assessment check. Files are read in chunks of raw
+    bytes, so nothing the size of the whole file is loaded
 
     Args:
         filepath (str): path to file to check
         arr (ndarray): pre-loaded array to check
+        chunk_size (int): bytes to read from filepath at a time
 
     Returns:
         float: decimal from 0 to 1, ratio of zeros to total entries
@@ -109,24 +221,122 @@ def percent_zero(filepath=None, arr=None):
         >>> a = np.array([[1 + 1j, 0.0], [1, 0.0001]])
         >>> print(percent_zero(arr=a))
         0.25
+        >>> a.astype(np.complex64).tofile('test.geo')
+        >>> print(percent_zero('test.geo'))
+        0.25
+        >>> os.remove('test.geo')
+    """
+    if arr is not None:
+        return float(np.count_nonzero(arr == 0)) / arr.size
+
+    dtype = _entry_dtype(filepath)
+    if dtype is None:
+        return percent_zero(arr=insar.sario.load(filepath))
+
+    num_zero = num_total = 0
+    count = max(chunk_size // dtype.itemsize, 1)
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = np.fromfile(f, dtype=dtype, count=count)
+            if chunk.size == 0:
+                break
+            num_zero += int(np.count_nonzero(chunk == 0))
+            num_total += chunk.size
+    return num_zero / num_total if num_total else 0.0
+
+
+def sample_percent_zero(filepath,
+                        num_blocks=SAMPLE_BLOCKS,
+                        block_size=SAMPLE_BLOCK_SIZE,
+                        confidence=0.99,
+                        seed=None):
+    """Estimates percent_zero of a file from randomly placed blocks of it
+
+    Zeros in SLCs come in large contiguous areas (missing bursts,
+    swaths off the edge of the DEM grid), so each block's zero ratio is
+    taken as one sample. The bound is the normal confidence interval of
+    their mean, with the finite population correction for blocks drawn
+    without replacement.
+
+    Args:
+        filepath (str): path to file to check
+        num_blocks (int): number of blocks to read
+        block_size (int): number of pixels per block
+        confidence (float): confidence level of the returned bounds
+        seed (int): seed for choosing the blocks
+
+    Returns:
+        tuple[float, float, float]: estimate, lower bound, upper bound.
+            If the blocks would cover most of the file, the whole file
+            is counted instead, and all three are the exact ratio
+
+    Example:
+        >>> a = np.zeros(100000, dtype=np.complex64)
+        >>> a[:50000] = 1
+        >>> a.tofile('test.geo')
+        >>> estimate, low, high = sample_percent_zero('test.geo', block_size=100, seed=1)
+        >>> low < 0.5 < high
+        True
+        >>> sample_percent_zero('test.geo', block_size=1000)
+        (0.5, 0.5, 0.5)
+        >>> os.remove('test.geo')
+    """
+    dtype = _entry_dtype(filepath)
+    num_entries = os.path.getsize(filepath) // dtype.itemsize if dtype is not None else 0
+    total_blocks = num_entries // block_size
+    if dtype is None or 2 * num_blocks >= total_blocks:
+        pct = percent_zero(filepath)
+        return pct, pct, pct
+
+    from scipy.stats import norm
+    starts = np.random.RandomState(seed).choice(total_blocks, num_blocks, replace=False)
+    ratios = np.empty(num_blocks)
+    # Mapping only touches the pages of the blocks read
+    data = np.memmap(filepath, dtype=dtype, mode='r', shape=(num_entries, ))
+    for idx, start in enumerate(np.sort(starts) * block_size):
+        ratios[idx] = np.count_nonzero(data[start:start + block_size] == 0) / block_size
+    del data
+
+    estimate = float(ratios.mean())
+    fpc = math.sqrt((total_blocks - num_blocks) / (total_blocks - 1))
+    std_err = float(ratios.std(ddof=1)) / math.sqrt(num_blocks) * fpc
+    margin = float(norm.ppf(0.5 + confidence / 2)) * std_err
+    return estimate, max(estimate - margin, 0.0), min(estimate + margin, 1.0)
+
+
+def is_mostly_zero(filepath, zero_threshold=0.50, sample=False, **sample_kwargs):
+    """Checks if the ratio of zeros in filepath is above zero_threshold
+
+    Args:
+        filepath (str): path to file to check
+        zero_threshold (float): between 0 and 1, the highest ratio allowed
+        sample (bool): estimate the ratio with sample_percent_zero first.
+            Only when the confidence interval contains zero_threshold is
+            the whole file counted
+        sample_kwargs: passed to sample_percent_zero
+
+    Returns:
+        tuple[bool, float]: whether the file is above the threshold, and
+            the ratio of zeros (estimated, if decided by sampling)
     """
-    if filepath:
-        arr = insar.sario.load(filepath)
-    return (np.sum(arr == 0) / arr.size)
+    if sample:
+        estimate, low, high = sample_percent_zero(filepath, **sample_kwargs)
+        if low > zero_threshold or high <= zero_threshold:
+            return estimate > zero_threshold, estimate
+        logger.debug("Sampled {} too close to threshold: counting all".format(filepath))
+    pct = percent_zero(filepath)
+    return pct > zero_threshold, pct
 
 
-def _check_and_move(fp, zero_threshold, test, mv_dir):
+def _check_file(args):
     """Wrapper func for clean_files multiprocessing"""
-    logger.debug("Checking {}".format(fp))
-    pct = percent_zero(filepath=fp)
-    if pct > zero_threshold:
-        logger.info("Moving {} for having {:.2f}% zeros to {}".format(fp, 100 * pct, mv_dir))
-        if not test:
-            shutil.move(fp, mv_dir)
+    filepath, zero_threshold, sample = args
+    logger.debug("Checking {}".format(filepath))
+    return (filepath, ) + is_mostly_zero(filepath, zero_threshold, sample=sample)
 
 
 @log_runtime
-def clean_files(ext, path=".", zero_threshold=0.50, test=True):
+def clean_files(ext, path=".", zero_threshold=0.50, test=True, sample=False, max_procs=None):
     """Move files of type ext from path with a high pct of zeros
 
     Args:
@@ -135,23 +345,45 @@ def clean_files(ext, path=".", zero_threshold=0.50, test=True):
         zero_threshold (float): between 0 and 1, threshold to delete files
             if they contain greater ratio of zeros
         test (bool): If true, doesn't delete files, just lists
+        sample (bool): decide from random blocks of each file when the
+            result is clear (see is_mostly_zero)
+        max_procs (int): most files checked at once (default: cpu_count())
+
+    Returns:
+        list[str]: the files found to have too many zeros
     """
 
     file_glob = os.path.join(path, "*{}".format(ext))
     logger.info("Searching {} for files with zero threshold {}".format(file_glob, zero_threshold))
+    filepaths = sorted(glob.glob(file_glob))
+    if not filepaths:
+        return []
 
     # Make a folder to store the bad geos
     mv_dir = os.path.join(path, 'bad_{}'.format(ext.replace('.', '')))
     mkdir_p(mv_dir) if not test else logger.info("Test mode: not moving files.")
 
-    max_procs = mp.cpu_count() // 2
-    pool = mp.Pool(processes=max_procs)
-    results = [
-        pool.apply_async(_check_and_move, (fp, zero_threshold, test, mv_dir))
-        for fp in glob.glob(file_glob)
-    ]
-    # Now ask for results so processes launch
-    [res.get() for res in results]
+    # Checking is mostly reading: one process per cpu keeps the disk busy
+    num_procs = min(max_procs or mp.cpu_count(), len(filepaths))
+    pool = mp.Pool(processes=num_procs)
+    try:
+        args = [(fp, zero_threshold, sample) for fp in filepaths]
+        results = pool.map(_check_file, args)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    bad_files = []
+    for fp, is_bad, pct in results:
+        if is_bad:
+            logger.info("Moving {} for having {:.2f}% zeros to {}".format(fp, 100 * pct, mv_dir))
+            bad_files.append(fp)
+            if not test:
+                shutil.move(fp, mv_dir)
+    return bad_files
 
 
 def split_array_into_blocks(data):
@@ -167,7 +399,61 @@ def split_array_into_blocks(data):
     return blocks
 
 
-def split_and_save(filename):
+# Bytes copied at a time when splitting files
+COPY_CHUNK_SIZE = 2**24
+
+
+def _block_row_ranges(rows, cols):
+    """Row (start, end) of each block, matching split_array_into_blocks
+
+    Examples:
+        >>> _block_row_ranges(7, 2)
+        [(0, 2), (2, 4), (4, 6), (6, 7)]
+    """
+    num_blocks = int(math.ceil(rows / cols))
+    # Like np.array_split: the first (rows % num_blocks) blocks get one extra row
+    base, extra = divmod(rows, num_blocks)
+    ranges = []
+    start = 0
+    for idx in range(num_blocks):
+        end = start + base + (1 if idx < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def _uavsar_layout(filename):
+    """On disk data type, rows, and cols of a UAVSAR data file
+
+    Cols come from the .ann file, rows from the file size (like sario.load_file)
+    """
+    ann_info = insar.sario.parse_ann_file(filename)
+    if not ann_info:
+        raise ValueError("{} needs its .ann file for width info.".format(filename))
+    dtype = np.dtype('<c8') if insar.sario.is_complex(filename) else insar.sario.FLOAT_32_LE
+    cols = ann_info['cols']
+    rows, remainder = divmod(os.path.getsize(filename), cols * dtype.itemsize)
+    if remainder:
+        raise ValueError("Invalid number of cols ({}) for size of {}".format(cols, filename))
+    return dtype, rows, cols
+
+
+def _copy_bytes(args):
+    """Copies num_bytes starting at offset from src to a new file dest"""
+    src, dest, offset, num_bytes = args
+    logger.info("Saving {}".format(dest))
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        fin.seek(offset)
+        while num_bytes > 0:
+            chunk = fin.read(min(num_bytes, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise IOError("{} ended before byte {}".format(src, offset + num_bytes))
+            fout.write(chunk)
+            num_bytes -= len(chunk)
+    return dest
+
+
+def split_and_save(filename, max_workers=1):
     """Creates several files from one long data file
 
     Saves them with same filename with .1,.2,.3... at end before ext
@@ -175,26 +461,51 @@ def split_and_save(filename):
         brazos_14937_17087-002_17088-003_0001d_s01_L090HH_01.1.int
         brazos_14937_17087-002_17088-003_0001d_s01_L090HH_01.2.int...
 
+    Blocks are the same as split_array_into_blocks on the loaded file,
+    but their bytes are copied straight from the file, so the data is
+    never loaded. The .ann file must be in the same directory.
+
+    Args:
+        filename (str): path to the UAVSAR data file
+        max_workers (int): number of blocks to write at once
+
     Output:
         newpaths (list[str]): full paths to new files created
     """
-
-    data = insar.sario.load_file(filename)
-    blocks = split_array_into_blocks(data)
+    dtype, rows, cols = _uavsar_layout(filename)
+    row_bytes = cols * dtype.itemsize
 
     ext = insar.sario.get_file_ext(filename)
-    newpaths = []
-
-    for idx, block in enumerate(blocks, start=1):
+    jobs = []
+    for idx, (start, end) in enumerate(_block_row_ranges(rows, cols), start=1):
         fname = filename.replace(ext, ".{}{}".format(str(idx), ext))
-        print("Saving {}".format(fname))
-        insar.sario.save(fname, block)
-        newpaths.append(fname)
+        jobs.append((filename, fname, start * row_bytes, (end - start) * row_bytes))
 
-    return newpaths
+    if max_workers > 1:
+        pool = ThreadPool(processes=min(max_workers, len(jobs)))
+        try:
+            return pool.map(_copy_bytes, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [_copy_bytes(job) for job in jobs]
 
 
-def combine_cor_amp(corfilename, save=True):
+def block_views(filename):
+    """Read-only views of the blocks split_and_save would write, without writing any
+
+    Returns:
+        list[np.memmap]: one memory mapped array per block
+    """
+    dtype, rows, cols = _uavsar_layout(filename)
+    row_bytes = cols * dtype.itemsize
+    return [
+        np.memmap(filename, dtype=dtype, mode='r', offset=start * row_bytes, shape=(end - start, cols))
+        for start, end in _block_row_ranges(rows, cols)
+    ]
+
+
+def combine_cor_amp(corfilename, strip_rows=STRIP_ROWS):
     """Takes a .cor file from UAVSAR (which doesn't contain amplitude),
     and creates a new file with amplitude data interleaved for dishgt
 
@@ -202,12 +513,18 @@ def combine_cor_amp(corfilename, save=True):
       where 3300 is number of columns/samples, and we want the first 5000 rows. the final
       1 is needed for the contour interval to set a max of 1 for .cor data
 
+    Each output row is one row of amplitude (|.int|) followed by the same
+    row of correlation, the layout sario.load_stacked reads. Matching strips
+    of the .int and .cor are read and written at a time, so memory use
+    doesn't grow with the file size.
+
     Inputs:
         corfilename (str): string filename of the .cor from UAVSAR
-        save (bool): True if you want to save the combined array
+        strip_rows (int): number of rows to read and write at a time
 
     Returns:
-        cor_with_amp (np.ndarray) combined correlation + amplitude (as complex64)
+        cor_with_amp (np.memmap): read-only view of the output,
+            amplitude in cor_with_amp[:, :cols], correlation in cor_with_amp[:, cols:]
         outfilename (str): same name as corfilename, but _withamp.cor
             Saves a new file under outfilename
     Note: .ann and .int files must be in same directory as .cor
@@ -216,14 +533,59 @@ def combine_cor_amp(corfilename, save=True):
     assert ext == '.cor', 'corfilename must be a .cor file'
 
     intfilename = corfilename.replace('.cor', '.int')
-
-    intdata = insar.sario.load_file(intfilename)
-    amp = np.abs(intdata)
-
-    cordata = insar.sario.load_file(corfilename)
-    # For dishgt, it expects the two matrices stacked [[amp]; [cor]]
-    cor_with_amp = np.vstack((amp, cordata))
+    int_dtype, rows, cols = _uavsar_layout(intfilename)
+    cor_dtype, cor_rows, cor_cols = _uavsar_layout(corfilename)
+    if (rows, cols) != (cor_rows, cor_cols):
+        raise ValueError("{} is {} x {}, but {} is {} x {}".format(
+            intfilename, rows, cols, corfilename, cor_rows, cor_cols))
 
     outfilename = corfilename.replace('.cor', '_withamp.cor')
-    insar.sario.save(outfilename, cor_with_amp)
+    logger.info("Saving {}".format(outfilename))
+    strip = np.empty((strip_rows, 2 * cols), dtype=insar.sario.FLOAT_32_LE)
+    with open(intfilename, 'rb') as fint, open(corfilename, 'rb') as fcor, \
+            open(outfilename, 'wb') as fout:
+        for row_start in range(0, rows, strip_rows):
+            num_rows = min(strip_rows, rows - row_start)
+            out = strip[:num_rows]
+            intdata = np.fromfile(fint, dtype=int_dtype, count=num_rows * cols)
+            np.abs(intdata.reshape((num_rows, cols)), out=out[:, :cols])
+            cordata = np.fromfile(fcor, dtype=cor_dtype, count=num_rows * cols)
+            out[:, cols:] = cordata.reshape((num_rows, cols))
+            out.tofile(fout)
+
+    cor_with_amp = np.memmap(
+        outfilename, dtype=insar.sario.FLOAT_32_LE, mode='r', shape=(rows, 2 * cols))
     return cor_with_amp, outfilename
+
+
+def _combine_cor_amp_file(corfilename):
+    """Wrapper func for combine_all_cor_amp multiprocessing"""
+    return combine_cor_amp(corfilename)[1]
+
+
+@log_runtime
+def combine_all_cor_amp(path=".", max_procs=None):
+    """Runs combine_cor_amp on every UAVSAR .cor file in path
+
+    Args:
+        path (str): directory with the .cor, .int and .ann files
+        max_procs (int): most files combined at once (default: cpu_count())
+
+    Returns:
+        list[str]: the _withamp.cor files written
+    """
+    corfiles = sorted(f for f in glob.glob(os.path.join(path, "*.cor"))
+                      if not f.endswith('_withamp.cor'))
+    if not corfiles:
+        return []
+
+    pool = mp.Pool(processes=min(max_procs or mp.cpu_count(), len(corfiles)))
+    try:
+        outfiles = pool.map(_combine_cor_amp_file, corfiles)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return outfiles
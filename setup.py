@@ -1,29 +1,4 @@
 import setuptools
-from setuptools.command.develop import develop
-from setuptools.command.install import install
-from subprocess import check_call
-
-
-# Classes for running "make" to compile the bin/upsample
-class PostDevelopCommand(develop):
-    """Post-installation for development mode, installs from Makefile."""
-
-    def run(self):
-        print("=========================================================")
-        check_call("make")
-        print("=========================================================")
-        develop.run(self)
-
-
-class PostInstallCommand(install):
-    """Post-installation for installation mode."""
-
-    def run(self):
-        print("=========================================================")
-        check_call("make")
-        print("=========================================================")
-        install.run(self)
-
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
@@ -39,11 +14,6 @@ setuptools.setup(
     url="https://github.com/scottstanie/insar",
     packages=setuptools.find_packages(),
     include_package_data=True,
-    # Extra command to compile the upsample.c script
-    cmdclass={
-        "develop": PostDevelopCommand,
-        "install": PostInstallCommand,
-    },
     classifiers=(
         "Programming Language :: Python",
         "Programming Language :: Python :: 2.7",
@@ -51,7 +21,6 @@ setuptools.setup(
         "Programming Language :: Python :: 3.4",
         "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: 3.6",
-        "Programming Language :: C",
         "License :: OSI Approved :: MIT License",
         "Topic :: Scientific/Engineering",
         "Intended Audience :: Science/Research",
@@ -62,5 +31,4 @@ setuptools.setup(
             "insar=insar.scripts.cli:cli",
         ],
     },
-    data_files=[("bin", ["bin/upsample"])],
     zip_safe=False)